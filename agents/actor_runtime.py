@@ -0,0 +1,454 @@
+import atexit
+import hashlib
+import os
+import queue
+import secrets
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from multiprocessing import Pipe, get_context
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Dict, List, Optional, Set, Tuple
+
+from pydantic_bp.core import Character, CharacterMemoryUnit, Scene
+from utils.cancellation import POLL_SECONDS, CancelToken, bind_token, current_token
+
+
+# CHARACTER_ACTORS=local runs the character actors on threads behind pipes (tests, one process),
+# CHARACTER_ACTORS=processes in worker processes over sockets. Unset, moment_runner calls character_turn directly
+ACTOR_MODE = os.getenv("CHARACTER_ACTORS", "")
+ACTOR_WORKERS = int(os.getenv("CHARACTER_ACTOR_WORKERS", str(min(4, os.cpu_count() or 1))))
+# Workers started on other machines with `python -m agents.actor_runtime worker`, the coordinator waits for them
+ACTOR_REMOTE_WORKERS = int(os.getenv("CHARACTER_ACTOR_REMOTE_WORKERS", "0"))
+ACTOR_LISTEN = os.getenv("CHARACTER_ACTOR_LISTEN", "127.0.0.1:0")
+ACTOR_AUTHKEY = os.getenv("CHARACTER_ACTOR_AUTHKEY", "")
+ACTOR_SHARD_DIR = os.getenv("CHARACTER_ACTOR_SHARDS", "actor_shards")
+# Seconds a worker has to answer a cancelled turn, after that it is dropped
+CANCEL_GRACE = 10.0
+
+
+class ActorError(RuntimeError):
+    pass
+
+
+class WorkerLost(ActorError):
+    pass
+
+
+def memory_fingerprint(character: Character) -> str:
+    '''
+    Identifies the memory and goals of a character, the coordinator and the actor compare it before a turn.
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    for unit in character.shortterm_memory:
+        digest.update(f"{unit.who_said}\x1f{unit.dialogue}\x1f{unit.action}\x1e".encode())
+    digest.update("\x1d".join(character.longterm_memory).encode())
+    digest.update("\x1d".join(character.shorttime_goals).encode())
+    return digest.hexdigest()
+
+
+def profile_stub(character: Character) -> Character:
+    # Other cast members only appear in the prompt with their profile, their memory stays with their own actor
+    return character.model_copy(update={"shortterm_memory": [], "longterm_memory": []})
+
+
+def _address(value: str) -> Tuple[str, int]:
+    host, port = value.rsplit(":", 1)
+    return host, int(port)
+
+
+def _recorded_calls() -> List[dict]:
+    # LLM calls a worker process recorded in memory (LLM_CASSETTE_BUFFER), they go back with the reply
+    from utils.model import cassette
+
+    return cassette.drain() if cassette is not None else []
+
+
+class ActorWorker:
+    '''
+    Hosts character actors: the character with its memory and its turn logic. Messages are handled
+    one at a time from the connection to the coordinator:
+
+        ("load", story_id, character)                                  -> ("ok",)
+        ("turn", story_id, ref, fingerprint, scene, stubs, remaining)  -> ("unit", memory_unit, shorttime_goals, calls) | ("stale",) | ("error", message, calls)
+        ("cancel", reason)                                             one way, stops the turn being handled
+        ("observe", story_id, ref, memory_unit)                        one way, another cast member acted
+        ("checkpoint",)                                                one way, writes the changed actors to the shard
+        ("stop",)
+
+    A turn runs under a cancel token with the seconds left of the story deadline, so it stops at its
+    next safe point like a turn in the coordinator would. calls are the LLM calls recorded by the turn.
+
+    Each worker checkpoints its actors to its own shard database, so a restarted worker picks them
+    up again. An actor whose memory differs from the story state answers stale and is reloaded.
+    '''
+
+    def __init__(self, worker_id: str, shard_dir: Optional[str] = ACTOR_SHARD_DIR):
+        self.worker_id = worker_id
+        self.shard_dir = shard_dir
+        self.actors: Dict[Tuple[str, str], Character] = {}
+        self.dirty: Set[Tuple[str, str]] = set()
+        self.shard = None
+        # Token of the last turn read, a cancel from the coordinator trips it
+        self._turn_token: Optional[CancelToken] = None
+
+    def _open_shard(self):
+        # Opened on the thread that serves, sqlite connections stay on their thread
+        if not self.shard_dir:
+            return
+        os.makedirs(self.shard_dir, exist_ok=True)
+        self.shard = sqlite3.connect(os.path.join(self.shard_dir, f"{self.worker_id}.db"))
+        self.shard.execute(
+            """
+            CREATE TABLE IF NOT EXISTS actors (
+                story_id TEXT NOT NULL,
+                ref TEXT NOT NULL,
+                character TEXT NOT NULL,
+                updated_at TEXT NOT NULL,
+                PRIMARY KEY (story_id, ref)
+            )
+            """
+        )
+        self.shard.commit()
+
+    def _actor(self, key: Tuple[str, str]) -> Optional[Character]:
+        actor = self.actors.get(key)
+        if actor is None and self.shard is not None:
+            row = self.shard.execute("SELECT character FROM actors WHERE story_id = ? AND ref = ?", key).fetchone()
+            if row is not None:
+                actor = self.actors[key] = Character.model_validate_json(row[0])
+        return actor
+
+    def checkpoint(self) -> int:
+        if self.shard is None or not self.dirty:
+            return 0
+        now = datetime.now(timezone.utc).isoformat()
+        self.shard.executemany(
+            "INSERT OR REPLACE INTO actors (story_id, ref, character, updated_at) VALUES (?, ?, ?, ?)",
+            [(*key, self.actors[key].model_dump_json(), now) for key in self.dirty if key in self.actors],
+        )
+        self.shard.commit()
+        written = len(self.dirty)
+        self.dirty.clear()
+        return written
+
+    def handle(self, message: tuple, token: Optional[CancelToken] = None) -> Optional[tuple]:
+        kind = message[0]
+        if kind == "load":
+            _, story_id, character = message
+            self.actors[(story_id, character.ref)] = character
+            self.dirty.add((story_id, character.ref))
+            return ("ok",)
+        if kind == "turn":
+            _, story_id, ref, fingerprint, scene, stubs, remaining = message
+            actor = self._actor((story_id, ref))
+            if actor is None or memory_fingerprint(actor) != fingerprint:
+                return ("stale",)
+            # Imported here, the LLM clients of the worker are created on its first turn
+            from agents.character_agent import character_turn
+
+            cast = [actor if stub.ref == ref else stub for stub in stubs]
+            try:
+                with bind_token(token or CancelToken(story_id, remaining)):
+                    unit = character_turn(scene, cast, actor)
+            except Exception as error:
+                # The turn did not happen, the actor is reloaded from the story state on the retry
+                self.actors.pop((story_id, ref), None)
+                return ("error", f"{type(error).__name__}: {error}", _recorded_calls())
+            self.dirty.add((story_id, ref))
+            return ("unit", unit, list(actor.shorttime_goals), _recorded_calls())
+        if kind == "observe":
+            _, story_id, ref, unit = message
+            actor = self._actor((story_id, ref))
+            if actor is not None:
+                actor.update_shortterm_memory(unit)
+                self.dirty.add((story_id, ref))
+            return None
+        if kind == "checkpoint":
+            self.checkpoint()
+            return None
+        raise ValueError(f"Unknown actor message {kind}")
+
+    def _read(self, connection: Connection, inbox: "queue.Queue[tuple]"):
+        # Reads ahead of the message being handled, so a cancel reaches the turn while it runs
+        while True:
+            try:
+                message = connection.recv()
+            except (EOFError, OSError):
+                message = ("stop",)
+            if message[0] == "cancel":
+                if self._turn_token is not None:
+                    self._turn_token.cancel(message[1])
+                continue
+            token = None
+            if message[0] == "turn":
+                token = self._turn_token = CancelToken(message[1], message[6])
+            inbox.put((message, token))
+            if message[0] == "stop":
+                return
+
+    def serve(self, connection: Connection):
+        inbox: "queue.Queue[tuple]" = queue.Queue()
+        threading.Thread(target=self._read, args=(connection, inbox), name=f"actor-reader-{self.worker_id}", daemon=True).start()
+        self._open_shard()
+        try:
+            while True:
+                message, token = inbox.get()
+                if message[0] == "stop":
+                    break
+                reply = self.handle(message, token)
+                if reply is not None:
+                    connection.send(reply)
+        finally:
+            self.checkpoint()
+            connection.close()
+
+
+def run_worker(address, authkey: bytes, worker_id: str, shard_dir: Optional[str] = ACTOR_SHARD_DIR):
+    '''
+    Entry point of a worker process, local or on another machine.
+    '''
+    connection = Client(address, authkey=authkey)
+    connection.send(("hello", worker_id))
+    ActorWorker(worker_id, shard_dir).serve(connection)
+
+
+class ActorSystem:
+    '''
+    Coordinator side of the character actors. moment_runner dispatches each turn to the worker that
+    hosts the acting character, placed by a stable hash of story and character, and mirrors the
+    result into the story state (goals of the actor, shortterm memory of the cast) like character_turn
+    does, so env_agent checkpoints stay complete. The other cast members observe the turn on their actors.
+
+    Messages to a worker are sent under its lock, turns of different stories on other workers run in parallel.
+    '''
+
+    def __init__(self, mode: str = ACTOR_MODE, workers: int = ACTOR_WORKERS, shard_dir: Optional[str] = ACTOR_SHARD_DIR,
+                 remote_workers: int = ACTOR_REMOTE_WORKERS, listen: str = ACTOR_LISTEN, authkey: str = ACTOR_AUTHKEY):
+        if mode not in ("local", "processes"):
+            raise ValueError(f"Unknown actor mode {mode}, expected local or processes")
+        self.mode = mode
+        self.workers = workers
+        self.shard_dir = shard_dir
+        self.remote_workers = remote_workers
+        self.listen = listen
+        self.authkey = authkey.encode() if authkey else secrets.token_bytes(16)
+        self._connections: List[Connection] = []
+        self._locks: List[threading.Lock] = []
+        self._threads: List[threading.Thread] = []
+        self._processes = []
+
+    def start(self) -> "ActorSystem":
+        connections = {}
+        if self.mode == "local":
+            for index in range(self.workers):
+                worker_id = f"worker-{index}"
+                parent, child = Pipe()
+                thread = threading.Thread(target=ActorWorker(worker_id, self.shard_dir).serve, args=(child,), name=f"actor-{worker_id}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+                connections[worker_id] = parent
+        else:
+            listener = Listener(_address(self.listen), authkey=self.authkey)
+            if self.remote_workers:
+                print(f"Waiting for {self.remote_workers} remote actor workers on {listener.address[0]}:{listener.address[1]}")
+            # Spawned, forking the coordinator would copy its threads and open connections
+            context = get_context("spawn")
+            # With LLM_MODE=record the workers keep their calls in memory and send them back with each turn,
+            # only the coordinator writes the cassette file
+            os.environ["LLM_CASSETTE_BUFFER"] = "1"
+            try:
+                for index in range(self.workers):
+                    process = context.Process(target=run_worker, args=(listener.address, self.authkey, f"worker-{index}", self.shard_dir), daemon=True)
+                    process.start()
+                    self._processes.append(process)
+            finally:
+                del os.environ["LLM_CASSETTE_BUFFER"]
+            for _ in range(self.workers + self.remote_workers):
+                connection = listener.accept()
+                _, worker_id = connection.recv()
+                connections[worker_id] = connection
+            listener.close()
+
+        # Sorted by worker id, so a character lands on the same worker and shard after a restart
+        self._connections = [connections[worker_id] for worker_id in sorted(connections)]
+        self._locks = [threading.Lock() for _ in self._connections]
+        return self
+
+    def stop(self):
+        for connection, lock in zip(self._connections, self._locks):
+            if connection is None:
+                continue
+            with lock:
+                try:
+                    connection.send(("stop",))
+                except OSError:
+                    pass
+        for thread in self._threads:
+            thread.join(10)
+        for process in self._processes:
+            process.join(10)
+        self._connections, self._locks, self._threads, self._processes = [], [], [], []
+
+    def _worker(self, story_id: str, ref: str) -> int:
+        # Placed among the workers still connected, the characters of a dropped one are reloaded on the others
+        live = [index for index, connection in enumerate(self._connections) if connection is not None]
+        if not live:
+            raise ActorError("No actor workers left")
+        digest = hashlib.blake2b(f"{story_id}\x1f{ref}".encode(), digest_size=8).digest()
+        return live[int.from_bytes(digest, "big") % len(live)]
+
+    def _drop(self, index: int, reason: str):
+        # Called under the lock of the worker
+        connection, self._connections[index] = self._connections[index], None
+        print(f"Actor worker {index} dropped: {reason}")
+        try:
+            connection.close()
+        except OSError:
+            pass
+
+    def _reply(self, index: int, connection: Connection, token: Optional[CancelToken]) -> tuple:
+        '''
+        Waits for the reply of a worker. A cancelled story or one past its deadline cancels the turn on the
+        worker, which answers with an error at its next safe point.
+        '''
+        cancelled_at = None
+        while not connection.poll(POLL_SECONDS):
+            if token is None:
+                continue
+            if cancelled_at is None:
+                remaining = token.remaining()
+                if token.cancelled or (remaining is not None and remaining <= 0):
+                    connection.send(("cancel", token.reason or "exceeded its deadline"))
+                    cancelled_at = time.monotonic()
+            elif time.monotonic() - cancelled_at > CANCEL_GRACE:
+                # Its late reply would answer the next call, the worker is not used again
+                self._drop(index, f"did not stop its turn within {CANCEL_GRACE:.0f}s of the cancel")
+                token.check()
+                raise WorkerLost(f"Actor worker {index} did not stop its turn")
+        return connection.recv()
+
+    def _call(self, index: int, message: tuple, token: Optional[CancelToken] = None) -> tuple:
+        with self._locks[index]:
+            connection = self._connections[index]
+            if connection is None:
+                raise WorkerLost(f"Actor worker {index} was dropped")
+            try:
+                connection.send(message)
+                return self._reply(index, connection, token)
+            except (EOFError, OSError) as error:
+                self._drop(index, f"{type(error).__name__}: {error}")
+                raise WorkerLost(f"Actor worker {index} is gone: {type(error).__name__}: {error}") from error
+            except KeyboardInterrupt:
+                # The reply still on its way would answer the next call
+                self._drop(index, "interrupted while waiting for its reply")
+                raise
+
+    def _send(self, index: int, message: tuple):
+        with self._locks[index]:
+            connection = self._connections[index]
+            if connection is None:
+                return
+            try:
+                connection.send(message)
+            except OSError as error:
+                self._drop(index, f"{type(error).__name__}: {error}")
+
+    @staticmethod
+    def _record(calls: List[dict]):
+        # Calls recorded by a worker process go on the cassette of the coordinator
+        if calls:
+            from utils.model import cassette
+
+            if cassette is not None:
+                cassette.extend(calls)
+
+    def _turn(self, index: int, story_id: str, scene: Scene, cast: List[Character], character: Character,
+              token: Optional[CancelToken]) -> tuple:
+        remaining = None
+        if token is not None:
+            token.check()
+            remaining = token.remaining()
+        message = ("turn", story_id, character.ref, memory_fingerprint(character), scene, [profile_stub(member) for member in cast], remaining)
+        reply = self._call(index, message, token)
+        if reply[0] == "stale":
+            # First turn of the character on this worker, or its memory was consolidated meanwhile
+            self._call(index, ("load", story_id, character))
+            reply = self._call(index, message, token)
+        return reply
+
+    def turn(self, story_id: str, scene: Scene, cast: List[Character], character: Character) -> CharacterMemoryUnit:
+        '''
+        One turn of the character on its actor, same contract as character_turn. The cancel token of the
+        running story goes with the turn. When the worker of the character is lost the turn did not
+        happen, it is retried once on the worker the character is placed on next.
+        '''
+        token = current_token()
+        try:
+            reply = self._turn(self._worker(story_id, character.ref), story_id, scene, cast, character, token)
+        except WorkerLost:
+            reply = self._turn(self._worker(story_id, character.ref), story_id, scene, cast, character, token)
+        if reply[0] in ("unit", "error"):
+            self._record(reply[-1])
+        if reply[0] != "unit":
+            # A turn stopped by the cancel or the deadline of the story raises them like a turn in the graph would
+            if token is not None:
+                token.check()
+            raise ActorError(f"Turn of {character.ref} failed on its actor: {reply[1] if len(reply) > 1 else reply[0]}")
+
+        _, unit, goals, _ = reply
+        character.shorttime_goals = goals
+        for member in cast:
+            member.update_shortterm_memory(unit)
+            if member is not character:
+                self._send(self._worker(story_id, member.ref), ("observe", story_id, member.ref, unit))
+        return unit
+
+    def checkpoint(self):
+        '''
+        Workers write their changed actors to their shards, without waiting for it.
+        '''
+        for index in range(len(self._connections)):
+            self._send(index, ("checkpoint",))
+
+
+_actor_system = None
+_actor_system_lock = threading.Lock()
+
+
+def get_actor_system() -> Optional[ActorSystem]:
+    '''
+    The actor system of the process, started on first use. None when CHARACTER_ACTORS is not set.
+    '''
+    global _actor_system
+    if not ACTOR_MODE:
+        return None
+    if _actor_system is None:
+        with _actor_system_lock:
+            if _actor_system is None:
+                _actor_system = ActorSystem().start()
+                atexit.register(_actor_system.stop)
+    return _actor_system
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run a character actor worker that joins a coordinator started with CHARACTER_ACTORS=processes.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    worker = subparsers.add_parser("worker")
+    worker.add_argument("--connect", required=True, help="host:port of the coordinator (CHARACTER_ACTOR_LISTEN)")
+    worker.add_argument("--id", required=True, help="Worker id, keeps the same characters and shard across restarts")
+    worker.add_argument("--shards", default=ACTOR_SHARD_DIR)
+    args = parser.parse_args()
+
+    if not ACTOR_AUTHKEY:
+        raise SystemExit("Set CHARACTER_ACTOR_AUTHKEY to the key of the coordinator")
+    # Calls recorded with LLM_MODE=record go to the cassette of the coordinator
+    os.environ["LLM_CASSETTE_BUFFER"] = "1"
+    run_worker(_address(args.connect), ACTOR_AUTHKEY.encode(), args.id, args.shards)
+
+
+if __name__ == "__main__":
+    main()
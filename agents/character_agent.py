@@ -1,60 +1,92 @@
+from functools import lru_cache
 from pydantic import BaseModel, Field
 from typing import Optional, List
-from langchain_core.messages import SystemMessage, HumanMessage
 from langgraph.graph import StateGraph, END
 
-from pydantic_bp.core import Character, CharacterMemoryUnit, Scene
+from pydantic_bp.core import Character, CharacterMemoryUnit, EngineModel, Scene
+from pydantic_bp.world import repair_indexes
 from utils.model import lite_llm
+from utils.prompt_builder import APPEND_ONLY, KEEP_FIRST, KEEP_LATEST, STABLE, VOLATILE, PromptBuilder, characters_fragment, scene_fragment
 
 
-class CharacterAgentState(BaseModel):
+class CharacterAgentState(EngineModel):
     scene: Scene
+    # Scene cast resolved from the story character table
+    cast: List[Character]
     current_character: Character
     new_memory_unit: Optional[CharacterMemoryUnit] = Field(default=None)
 
 
 
-def character_agent(state: CharacterAgentState) -> CharacterAgentState:
-    sysmet_prompt = state.current_character.system_message()
-
-    class CharacterResponse(BaseModel):
-        dialogue: str = Field(..., description="Your dialogue in this scene.")
-        action: str = Field(..., description="Your action in this scene.")
-        who_listens: List[int] = Field(..., description="List of characters indexes who are listening to you in this moment. 0 based indexes as per the scene characters list.")
-        shortterm_goals: List[str] = Field(description="Your updated shortterm goals after this moment. add or remove goals as necessary.")
-        longterm_memory: List[str] = Field(description="Any new facts or events to be added to your longterm memory. Just add very importantce events. dont repeat existing memories. othervise leave it empty. and alse memory_factor affects how much you remember. If memory_factor is low, you may forget some details. even important ones.")
-
+def character_prompt(scene: Scene, cast: List[Character], character: Character) -> PromptBuilder:
+    '''
+    Profile and scene cast first, then the moments of the scene which only grow,
+    then the memories and goals of the character which change every turn.
+    '''
+    prompt = PromptBuilder("character_agent", prefix_key=f"character_agent:{character.id or character.name}")
+    prompt.system(character.profile_message())
+
+    # Over the context budget, older memories go first, then older longterm facts, the scene start and the cast
+    prompt.add(f"Scene Description: {scene.description}", STABLE)
+    prompt.add(f"Available characters to interact with:\n{characters_fragment('character_agent', cast)}", STABLE, "cast", 3, KEEP_FIRST)
+    if character.longterm_memory:
+        memories = "\n".join(f"- {memory}" for memory in character.longterm_memory)
+        prompt.add(f"Your longterm memory:\n{memories}", STABLE, "longterm_memory", 1, KEEP_LATEST)
+    prompt.add(f"What happened in the scene so far:\n{scene_fragment('character_agent', scene)}", APPEND_ONLY, "scene", 2, KEEP_LATEST)
+
+    # Shortterm memory from before this scene, the scene moments are already in the prompt
+    in_scene = {(unit.who_said, unit.dialogue, unit.action) for moment in scene.moments for unit in moment.situations}
+    earlier = [unit for unit in character.shortterm_memory if (unit.who_said, unit.dialogue, unit.action) not in in_scene]
+    if earlier:
+        lines = [f"- {unit.who_said} -> {', '.join(unit.who_listens) or 'nobody'}: \"{unit.dialogue}\" [{unit.action}]" for unit in earlier]
+        prompt.add("Your recent memories:\n" + "\n".join(lines), VOLATILE, "recent_memories", 0, KEEP_LATEST)
+    prompt.add(character.goals_message(), VOLATILE)
+    prompt.add("What do you do in this moment?", VOLATILE)
+    return prompt
+
+
+class CharacterResponse(BaseModel):
+    dialogue: str = Field(..., description="Your dialogue in this scene.")
+    action: str = Field(..., description="Your action in this scene.")
+    who_listens: List[int] = Field(..., description="List of characters indexes who are listening to you in this moment. 0 based indexes as per the scene characters list.")
+    shortterm_goals: List[str] = Field(description="Your updated shortterm goals after this moment. add or remove goals as necessary.")
+
+
+def character_turn(scene: Scene, cast: List[Character], character: Character) -> CharacterMemoryUnit:
+    '''
+    One turn of a character in the scene, a plain call on the shared scene and character objects.
+    Updates the goals of the character and the shortterm memory of the cast in place.
+    '''
     character_llm = lite_llm.with_structured_output(CharacterResponse)
 
-    response = character_llm.invoke([
-        SystemMessage(content=sysmet_prompt),
-        HumanMessage(content=f"""
-                     Scene Description: {str(state.scene)}\n , available characters to interact with: {list(state.scene.characters)}
-                     What do you do in this moment?
-        """)
-    ])
+    response = character_llm.invoke(character_prompt(scene, cast, character).build())
 
+    listener_indexes = repair_indexes(response.who_listens, len(cast), "listener index")
 
-
-    new_memory_unit = CharacterMemoryUnit(
-        who_said=state.current_character.name,
-        who_listens=[state.scene.characters[i].name for i in response.who_listens],
+    # response is validated by the structured output, names come from the scene
+    new_memory_unit = CharacterMemoryUnit.trusted(
+        who_said=character.name,
+        who_listens=[cast[i].name for i in listener_indexes],
         dialogue=response.dialogue,
         action=response.action
     )
     
-    state.current_character.shorttime_goals = response.shortterm_goals
-    state.current_character.longterm_memory.extend(response.longterm_memory)
+    character.shorttime_goals = response.shortterm_goals
+    # Longterm memory is consolidated from shortterm memory in the background, see agents/memory_agent.py
 
     #this character also in below list
-    # state.current_character.update_shortterm_memory(new_memory_unit)
+    # character.update_shortterm_memory(new_memory_unit)
 
     # Change this to update only relevant characters
-    for character in state.scene.characters:
-        character.update_shortterm_memory(new_memory_unit)
+    for member in cast:
+        member.update_shortterm_memory(new_memory_unit)
+
+    return new_memory_unit
 
+
+def character_agent(state: CharacterAgentState) -> CharacterAgentState:
     return {
-        "new_memory_unit": new_memory_unit
+        "new_memory_unit": character_turn(state.scene, state.cast, state.current_character)
     }
 
 
@@ -64,4 +96,14 @@ character_workflow.add_node("character_agent", character_agent)
 character_workflow.set_entry_point("character_agent")
 character_workflow.add_edge("character_agent", END)
 
-character_app = character_workflow.compile()
\ No newline at end of file
+@lru_cache(maxsize=None)
+def get_character_app():
+    # Standalone graph of a single turn, moment_runner calls character_turn directly
+    return character_workflow.compile()
+
+
+def __getattr__(name):
+    # character_app is compiled on first use
+    if name == "character_app":
+        return get_character_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
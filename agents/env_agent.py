@@ -1,12 +1,16 @@
-import json
-from typing import List, TypedDict
+from typing import List, Set, TypedDict
 from pydantic import BaseModel, Field
-from langchain_core.messages import SystemMessage, HumanMessage
+from langgraph.config import get_config
 from langgraph.graph import StateGraph, END
 
-from pydantic_bp.core import Character, Entity, Scene, Moment
+from pydantic_bp.core import Character, Entity, Scene, Moment, scene_cast
+from pydantic_bp.world import WorldRegistry, repair_indexes
+from utils import casting
+from utils.cancellation import check_cancelled
 from utils.model import lite_llm
-from agents.character_agent import character_app
+from utils.prompt_builder import APPEND_ONLY, KEEP_FIRST, KEEP_LATEST, STABLE, VOLATILE, PromptBuilder, characters_fragment, entities_fragment, moments_fragment, scenes_fragment
+from agents.character_agent import character_turn
+from agents import actor_runtime, memory_agent, stall_detector, turn_scheduler
 
 
 class EnvAgentState(TypedDict):
@@ -26,6 +30,40 @@ class EnvAgentState(TypedDict):
     next_moment_no: int = 1
     current_moment: Moment = None
 
+    # Running scene validation: the assessment so far, how many moments it covers, and when to validate next
+    scene_assessment: str = ""
+    scene_progress: float = 0.0
+    validated_moments: int = 0
+    next_validation_moment: int = 1
+
+
+
+# Scenes a history over the context budget is compacted to, before older lines are cut
+COMPACT_HISTORY_SCENES = 3
+
+
+def history_compactor(agent: str, heading: str, scenes: List[Scene]):
+    return lambda: f"{heading}\n{scenes_fragment(agent, scenes[-COMPACT_HISTORY_SCENES:])}"
+
+
+# Moments until the next scene validation by the progress of the last one, a scene far from its purpose is checked less often
+VALIDATION_CADENCE = ((0.3, 3), (0.7, 2))
+
+
+def validation_interval(progress: float) -> int:
+    for below, interval in VALIDATION_CADENCE:
+        if progress < below:
+            return interval
+    return 1
+
+
+def reset_validation() -> dict:
+    return {
+        "scene_assessment": "",
+        "scene_progress": 0.0,
+        "validated_moments": 0,
+        "next_validation_moment": 1,
+    }
 
 
 class SceneModel(BaseModel):
@@ -33,19 +71,47 @@ class SceneModel(BaseModel):
     description: str = Field(description="Description of the scene like where it is happening, time of the day, mood, etc.")
 
 
-def get_next_character(state: EnvAgentState) -> Character:
-    if state["next_character_index"] >= len(state["characters"]):
+def get_next_character(state: EnvAgentState, cast: List[Character], acted: Set[int]) -> Character:
+    '''
+    Picks the character of the cast that acts next in this moment, see agents/turn_scheduler.py.
+    next_character_index is the round-robin position the scheduler falls back to.
+    '''
+    if (state.get("next_character_index") or 0) >= len(cast):
         state["next_character_index"] = 0
 
-    character = state["characters"][state["next_character_index"]]
-    return character
+    index = turn_scheduler.next_speaker(state["current_scene"], cast, state.get("next_character_index") or 0, acted)
+    acted.add(index)
+    state["next_character_index"] = (index + 1) % len(cast)
+    return cast[index]
+
+def current_story_id() -> str:
+    try:
+        return str(get_config().get("configurable", {}).get("thread_id", ""))
+    except RuntimeError:
+        return ""
+
+
+def consolidate_memories(state: EnvAgentState):
+    '''
+    Between moments: merges the memory consolidations that finished in the background and starts
+    new ones for characters whose shortterm memory piled up. Never waits on the LLM.
+    '''
+    if not memory_agent.ENABLED:
+        return
+    story_id = current_story_id()
+    consolidator = memory_agent.get_consolidator()
+    consolidator.apply(story_id, state["characters"])
+    consolidator.submit(story_id, state["characters"])
+
 
 def scene_creator(state: EnvAgentState) -> EnvAgentState:
     '''
     Creates a new scene based on the current state.
     '''
+    check_cancelled()
 
     print(f"Creating scene number {state['next_scene_no']}...")
+    consolidate_memories(state)
 
     
     system_mssage = f"""
@@ -56,66 +122,44 @@ def scene_creator(state: EnvAgentState) -> EnvAgentState:
 
     scene_creator_llm = lite_llm.with_structured_output(SceneModel)
 
-    characters_data = []
-    for character in state["characters"]:
-        characters_data.append({
-            "name": character.name,
-            "role": character.role,
-            "longtime_goals": character.longtime_goals,
-            "personality": character.personality,
-            "strengths": character.strengths,
-            "weaknesses": character.weaknesses,
-        })
-
-    entities_data = [entity.model_dump() for entity in state["entities"]]
-
-    scenes_data = []
-    for scene in state["scenes"]:
-        scene_data = {
-            "no": scene.no,
-            "description": scene.description,
-            "moments": []
-        }
-        for moment in scene.moments:
-            moment_data = {
-                "no": moment.no,
-                "situations": []
-            }
-            for situation in moment.situations:
-                situation_data = {
-                    "who_said": situation.who_said,
-                    "who_listens": [char for char in situation.who_listens],
-                    "dialogue": situation.dialogue,
-                    "action": situation.action
-                }
-                moment_data["situations"].append(situation_data)
-            scene_data["moments"].append(moment_data)
-        scenes_data.append(scene_data)
-
-    response = scene_creator_llm.invoke([
-        SystemMessage(content=system_mssage),
-        HumanMessage(content=f'''
-        Here are the available characters:
-        {json.dumps(characters_data, indent=2)}
-        Here are the available entities:
-        {json.dumps(entities_data, indent=2)}
-        The scenes that have happened so far:
-        {json.dumps(scenes_data, indent=2)}
-        Reference to the new scene is {state['next_scene']}
-        ''')
-    ])
+    # Only the characters and entities the reference calls for are offered, large rosters stay out of the prompt
+    reference, named = casting.scene_reference(state["next_scene"], state["characters"])
+    cast_shortlist = casting.shortlist_characters(state["characters"], reference, named)
+    candidates = casting.pick(state["characters"], cast_shortlist)
+    entities = casting.pick(state["entities"], casting.shortlist_entities(state["entities"], reference))
+
+    prompt = PromptBuilder("scene_creator")
+    prompt.system(system_mssage)
+    prompt.add(f"Here are the available characters:\n{characters_fragment('scene_creator', candidates)}", STABLE, "characters", 2, KEEP_FIRST)
+    prompt.add(f"Here are the available entities:\n{entities_fragment('scene_creator', entities)}", STABLE, "entities", 0, KEEP_FIRST)
+    heading = "The scenes that have happened so far:"
+    prompt.add(
+        f"{heading}\n{scenes_fragment('scene_creator', state['scenes'])}", APPEND_ONLY, "scenes", 1, KEEP_LATEST,
+        compact=history_compactor("scene_creator", heading, state["scenes"]),
+    )
+    prompt.add(f"Reference to the new scene is {reference}", VOLATILE)
+
+    response = scene_creator_llm.invoke(prompt.build())
+
+    # Repair the cast locally instead of failing on an out of range index
+    characters_indexes = repair_indexes(response.characters_indexes, len(candidates), "character index")
+    characters = [candidates[i] for i in characters_indexes]
+    if not characters:
+        world = WorldRegistry.lookup(candidates, entities)
+        characters = world.mentioned_characters(response.description) or candidates
 
     print(f"Scene created successfully..")
 
     return {
-        "current_scene": Scene(
+        "current_scene": Scene.trusted(
                 no=state["next_scene_no"],
                 description=response.description,
-                characters=[state["characters"][i] for i in response.characters_indexes],
+                character_ids=[character.ref for character in characters],
                 moments=[]
         ),
         "is_scene_complete": False,
         "next_moment_no": 1,
+        **reset_validation(),
     }
 
 
@@ -123,15 +167,26 @@ def moment_runner(state: EnvAgentState) -> EnvAgentState:
     '''
     Creates a new moments within the current scene.
     '''
+    check_cancelled()
     print(f"Creating moment number {state['next_moment_no']} in scene {state['next_scene_no']}...")
 
-    for character in state["current_scene"].characters:
-        character_state = {
-            "scene": state["current_scene"],
-            "current_character": character,
-        }
-        character_response = character_app.invoke(character_state)
-        new_memory_unit = character_response["new_memory_unit"]
+    # Scenes reference their cast, the characters themselves live only in state["characters"]
+    cast = scene_cast(state["current_scene"], state["characters"])
+    # Only the characters the scheduler picks act in this moment, bystanders wait for a later one
+    turns = turn_scheduler.speakers_per_moment(cast)
+    acted = set()
+    # With CHARACTER_ACTORS set, turns run on the actor of each character in a worker
+    actors = actor_runtime.get_actor_system()
+    story_id = current_story_id()
+    for _ in range(turns):
+        # Safe point between character turns, the moment is only checkpointed when the node returns
+        check_cancelled()
+        character = get_next_character(state, cast, acted)
+        if actors is not None:
+            new_memory_unit = actors.turn(story_id, state["current_scene"], cast, character)
+        else:
+            # Direct call, a compiled sub-graph per turn only added orchestration and state coercion
+            new_memory_unit = character_turn(state["current_scene"], cast, character)
         
         # Append the new memory unit to the current moment
         if state["current_moment"] is None :
@@ -144,88 +199,111 @@ def moment_runner(state: EnvAgentState) -> EnvAgentState:
 
         state["current_moment"].situations.append(new_memory_unit)
 
-    print(f"Moment created successfully..")
+    if actors is not None:
+        actors.checkpoint()
+    consolidate_memories(state)
+    stats = turn_scheduler.record_moment(cast, turns)
+    print(f"Moment created successfully.. {turns} of {len(cast)} characters acted, {stats['skipped']} turns skipped so far")
 
     return {
-        "next_moment_no": state["next_moment_no"] + 1
+        "next_moment_no": state["next_moment_no"] + 1,
+        "next_character_index": state["next_character_index"]
+    }
+
+
+def complete_scene(state: EnvAgentState) -> EnvAgentState:
+    return {
+        "scenes": state["scenes"] + [state["current_scene"]],
+        "next_scene_no": state["next_scene_no"] + 1,
+        "current_scene": None,
+        "current_moment": None,
+        "next_moment_no": 1,
+        "is_scene_complete": True,
+        **reset_validation(),
     }
 
 
 def scene_validator(state: EnvAgentState) -> EnvAgentState:
     '''
     Validates the created scene if it finishes its purpose.
+
+    Incremental: the validator keeps a compact running assessment of the scene in the state and is
+    only sent that assessment and the moments since the last validation, so a call costs the same
+    for any scene length. Scenes with little progress are validated every few moments.
     '''
+    check_cancelled()
     print("Validating scene completion...")
 
+    moments = len(state["current_scene"].moments)
+    due = moments >= state.get("next_validation_moment", 1)
+
+    # Looping lines are caught locally, without a validator call
+    verdict = stall_detector.check(state["current_scene"], due=due)
+    if verdict == stall_detector.CLOSE:
+        print(f"Scene is stalled, closing it. {stall_detector.STALL_STATS['validator_calls_saved']} validator calls saved so far")
+        return complete_scene(state)
+    if verdict == stall_detector.SKIP:
+        print(f"Nothing new in this moment, scene is not yet complete. {stall_detector.STALL_STATS['validator_calls_saved']} validator calls saved so far")
+        return {
+            "is_scene_complete": False
+        }
+
+    if not due:
+        print(f"Scene progress {state.get('scene_progress', 0.0):.1f}, next validation after moment {state['next_validation_moment']}.")
+        return {
+            "is_scene_complete": False
+        }
+
     class SceneValidationModel(BaseModel):
+        # Defaults keep responses recorded before the running assessment valid
+        assessment: str = Field(default="", description="Your updated assessment of the scene: what of its purpose is achieved and what is still missing, in at most 3 short sentences.")
+        progress: float = Field(default=0.0, description="Progress of the scene toward its purpose, from 0 (nothing yet) to 1 (achieved).")
         is_scene_complete: bool = Field(description="Whether the scene is complete or not.")
     
 
     system_prompt = f"""
         You are a scene validator agent. Your task is to evaluate whether the current scene has achieved its purpose in progressing towards the main goal.
         The main goal is: {state['main_goal']}
+        If scene purpose must be fully achieved, mark it as complete.
+        Even scene purpose is achieved if characters not yet complete their actions or conversations, mark it as incomplete.
+        and if scene being large unnecessarily and characters are just make silly actions, terminate scene by marking it as complete.
+        You are given your assessment of the scene so far and only the moments that happened since, update the assessment with them.
         Provide your response in the specified structured format.
     """
 
     scene_validator_llm = lite_llm.with_structured_output(SceneValidationModel)
 
-    current_scene = state["current_scene"]
-    current_scene_data = {
-        "description": current_scene.description,
-        "moments": []
-    }
-
-    # Manually serialize moments and situations
+    # The purpose is fixed for the whole scene, the assessment replaces the moments it already covers
+    validated = min(state.get("validated_moments", 0), moments)
+    assessment = state.get("scene_assessment") or "None yet, the scene just started."
+    prompt = PromptBuilder("scene_validator")
+    prompt.system(system_prompt)
+    prompt.add(f"The purpose of the scene is {casting.scene_reference(state['next_scene'], state['characters'])[0]}", STABLE)
+    prompt.add(f"Your assessment after {validated} moments: {assessment}", VOLATILE)
+    prompt.add(f"The moments since then:\n{moments_fragment('scene_validator', state['current_scene'], validated)}", VOLATILE, "moments", 0, KEEP_LATEST)
+    prompt.add("Based on your assessment and the new moments, determine if the scene is complete in achieving its purpose.", VOLATILE)
 
-    for moment in current_scene.moments:
-        moment_data = {
-            "no": moment.no,
-            "situations": []
-        }
-        for situation in moment.situations:
-            situation_data = {
-                "who_said": situation.who_said,
-                "who_listens": [char for char in situation.who_listens],
-                "dialogue": situation.dialogue,
-                "action": situation.action
-            }
-            moment_data["situations"].append(situation_data)
-        current_scene_data["moments"].append(moment_data)
-
-
-    response = scene_validator_llm.invoke([
-        SystemMessage(content=system_prompt),
-        HumanMessage(content=f'''
-        Here is the current scene:
-        {json.dumps(current_scene_data, indent=2)}
-        Based on the above scene, determine if the scene is complete in achieving its purpose.
-        The purpose of the scene is {state['next_scene']}
-        If scene purpose must be fully achieved, mark it as complete.
-        Even scene purpose is achieved if characters not yet complete their actions or conversations, mark it as incomplete.
-        and if scene being large unnecessarily and characters are just make silly actions, terminate scene by marking it as complete.
-        ''')
-    ])
+    response = scene_validator_llm.invoke(prompt.build())
 
     state["is_scene_complete"] = response.is_scene_complete
 
     if response.is_scene_complete:
         print("Scene is complete.")
-        return {
-            "scenes": state["scenes"] + [state["current_scene"]],
-            "next_scene_no": state["next_scene_no"] + 1,
-            "current_scene": None,
-            "current_moment": None,
-            "next_moment_no": 1,
-            "is_scene_complete": True
-        }
+        return complete_scene(state)
 
-    print("Scene is not yet complete.")
+    progress = min(max(response.progress, 0.0), 1.0)
+    print(f"Scene is not yet complete, progress {progress:.1f}.")
     return {
-        "is_scene_complete": response.is_scene_complete
+        "is_scene_complete": response.is_scene_complete,
+        "scene_assessment": response.assessment.strip() or state.get("scene_assessment", ""),
+        "scene_progress": progress,
+        "validated_moments": moments,
+        "next_validation_moment": moments + validation_interval(progress),
     }
 
 
 def final_goal_validator(state: EnvAgentState) -> EnvAgentState:
+    check_cancelled()
     print("Validating final goal achievement...")
     
     class GoalModel(BaseModel):
@@ -242,67 +320,63 @@ def final_goal_validator(state: EnvAgentState) -> EnvAgentState:
 
     goal_validator_llm = lite_llm.with_structured_output(GoalModel)
 
-    scenes_data = []
-
-    for scene in state["scenes"]:
-        scene_data = {
-            "no": scene.no,
-            "description": scene.description,
-            "moments": []
-        }
-        for moment in scene.moments:
-            moment_data = {
-                "no": moment.no,
-                "situations": []
-            }
-            for situation in moment.situations:
-                situation_data = {
-                    "who_said": situation.who_said,
-                    "who_listens": [char for char in situation.who_listens],
-                    "dialogue": situation.dialogue,
-                    "action": situation.action
-                }
-                moment_data["situations"].append(situation_data)
-            scene_data["moments"].append(moment_data)
-        scenes_data.append(scene_data)
-
-    characters_data = []
-    for character in state["characters"]:
-        characters_data.append({
-            "name": character.name,
-            "role": character.role,
-            "longtime_goals": character.longtime_goals,
-            "personality": character.personality,
-            "strengths": character.strengths,
-            "weaknesses": character.weaknesses,
-        })
-
-    entities_data = [entity.model_dump() for entity in state["entities"]]
-
-    response = goal_validator_llm.invoke([
-        SystemMessage(content=system_prompt),
-        HumanMessage(content=f'''
-        Here are the scenes that have happened so far:
-        {json.dumps(scenes_data, indent=2)}
-        Based on the above scenes, determine if the main goal has been achieved. If not, suggest the next scene to be created.
-        Characters available:
-        {json.dumps(characters_data, indent=2)}
-        Entities available:
-        {json.dumps(entities_data, indent=2)}
-        ''')
-    ])
+    reference = casting.story_reference(state["main_goal"], state["scenes"], state["characters"])
+    cast_shortlist = casting.shortlist_characters(state["characters"], reference)
+    entities = casting.pick(state["entities"], casting.shortlist_entities(state["entities"], reference))
+
+    # Roster and entities first, they are stable while the scene history only grows
+    prompt = PromptBuilder("final_goal_validator")
+    prompt.system(system_prompt)
+    prompt.add(f"Characters available:\n{characters_fragment('final_goal_validator', casting.pick(state['characters'], cast_shortlist))}", STABLE, "characters", 2, KEEP_FIRST)
+    prompt.add(f"Entities available:\n{entities_fragment('final_goal_validator', entities)}", STABLE, "entities", 0, KEEP_FIRST)
+    # The history decides the goal, it is trimmed before the cast only, whose indexes the next scene refers to
+    heading = "Here are the scenes that have happened so far:"
+    prompt.add(
+        f"{heading}\n{scenes_fragment('final_goal_validator', state['scenes'])}", APPEND_ONLY, "scenes", 1, KEEP_LATEST,
+        compact=history_compactor("final_goal_validator", heading, state["scenes"]),
+    )
+    prompt.add("Based on the above scenes, determine if the main goal has been achieved. If not, suggest the next scene to be created.", VOLATILE)
+
+    response = goal_validator_llm.invoke(prompt.build())
 
     if response.is_main_goal_achieved:
         print("Main goal has been achieved!")
     else:
         print("Main goal not yet achieved. Next scene to create:")
 
-    
+    next_scene = response.next_scene
+    if next_scene is not None:
+        # The suggested cast indexes the shortlist, the state keeps roster positions
+        next_scene = next_scene.model_copy(update={"characters_indexes": casting.to_roster(next_scene.characters_indexes, cast_shortlist)})
+
     return{
         "is_main_goal_achieved": response.is_main_goal_achieved,
-        "next_scene": response.next_scene
+        "next_scene": next_scene
+    }
+
+def initial_state(start_output: dict) -> EnvAgentState:
+    '''
+    State a new story starts env_agent_workflow with, from the output of the start agent.
+    '''
+    # Ids are assigned here once, scenes reference the characters by them from then on
+    world = WorldRegistry(start_output["characters"], start_output["entities"])
+    return {
+        "main_goal": start_output["main_goal"],
+        "is_main_goal_achieved": False,
+        "characters": world.character_list(),
+        "entities": world.entity_list(),
+        "scenes": [],
+        "next_character_index": 0,
+        "next_scene_no": 1,
+        "next_scene": start_output["start_scene_description"],
+        "is_scene_complete": False,
+        "current_scene": None,
+        "next_moment_no": 1,
+        "current_moment": None,
+        **reset_validation(),
     }
 
+
 env_agent_workflow = StateGraph(EnvAgentState)
 env_agent_workflow.add_node("scene_creation", scene_creator)
 env_agent_workflow.add_node("moment_runner", moment_runner)
@@ -0,0 +1,145 @@
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Tuple
+
+from pydantic import BaseModel, Field
+
+from pydantic_bp.core import Character, CharacterMemoryUnit
+from utils.model import lite_llm
+from utils.prompt_builder import STABLE, VOLATILE, PromptBuilder
+
+
+# Most recent shortterm units a character always keeps verbatim
+KEEP_RECENT = 8
+# Older units are consolidated once at least this many have piled up
+CONSOLIDATE_BATCH = 12
+# MEMORY_CONSOLIDATION=0 turns the background worker off
+ENABLED = os.getenv("MEMORY_CONSOLIDATION", "1") != "0"
+
+
+def max_longterm_memory(character: Character) -> int:
+    # Better memory keeps more facts, like max_shortterm_memory
+    return 10 + int(character.memory_factor * 40)
+
+
+def needs_consolidation(character: Character) -> bool:
+    return len(character.shortterm_memory) - KEEP_RECENT >= CONSOLIDATE_BATCH
+
+
+class MemoryConsolidation(BaseModel):
+    longterm_memory: List[str] = Field(description="Your whole updated longterm memory: concise facts, the existing ones merged with what is worth remembering from the events.")
+
+
+def consolidate(character: Character, units: List[CharacterMemoryUnit], longterm_memory: List[str]) -> List[str]:
+    '''
+    Compresses shortterm memory units into concise longterm facts, merged with the existing ones.
+    Returns the new longterm memory of the character.
+    '''
+    limit = max_longterm_memory(character)
+    system_message = (
+        f"{character.profile_message()} "
+        "You are consolidating your memory. Turn the events below into short factual statements worth remembering, "
+        "merge them with your existing longterm memory, drop duplicates and details that no longer matter. "
+        f"Keep at most {limit} facts. With a low memory factor you forget more, even important details."
+    )
+    events = "\n".join(f"- {unit.who_said} -> {', '.join(unit.who_listens) or 'nobody'}: \"{unit.dialogue}\" [{unit.action}]" for unit in units)
+    existing = "\n".join(f"- {memory}" for memory in longterm_memory) or "(empty)"
+
+    prompt = PromptBuilder("memory_agent", prefix_key=f"memory_agent:{character.ref}")
+    prompt.system(system_message)
+    prompt.add(f"Your longterm memory:\n{existing}", STABLE)
+    prompt.add(f"Events to consolidate:\n{events}", VOLATILE)
+
+    memory_llm = lite_llm.with_structured_output(MemoryConsolidation)
+    response = memory_llm.invoke(prompt.build())
+    return [memory.strip() for memory in response.longterm_memory if memory.strip()][:limit]
+
+
+@dataclass
+class _Job:
+    units: List[CharacterMemoryUnit]
+    longterm_memory: List[str]
+    future: Future
+
+
+def _drop_consolidated(memory: List[CharacterMemoryUnit], units: List[CharacterMemoryUnit]):
+    # Units that overflowed meanwhile are already gone from the front, drop what is left of the batch
+    for start in range(len(units) + 1):
+        rest = units[start:]
+        if memory[:len(rest)] == rest:
+            del memory[:len(rest)]
+            return
+
+
+class MemoryConsolidator:
+    '''
+    Consolidates the older shortterm memory of characters into longterm facts on a background thread,
+    off the critical path of the character turns.
+
+    submit() snapshots the memory of the characters that need it and starts the LLM calls, apply()
+    merges finished results back into the characters. Both are called from the graph nodes between
+    moments, so the characters in the story state are only ever changed by the node that owns them.
+    A failed consolidation is dropped, the units stay in shortterm memory and are retried later.
+    '''
+
+    def __init__(self, max_workers: int = 2):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="memory")
+        self._jobs: Dict[Tuple[str, str], _Job] = {}
+        self._lock = threading.Lock()
+
+    def submit(self, story_id: str, characters: Iterable[Character]) -> int:
+        submitted = 0
+        for character in characters:
+            key = (story_id, character.ref)
+            with self._lock:
+                if key in self._jobs or not needs_consolidation(character):
+                    continue
+                units = character.shortterm_memory[:len(character.shortterm_memory) - KEEP_RECENT]
+                longterm_memory = list(character.longterm_memory)
+                future = self._executor.submit(consolidate, character.model_copy(), units, longterm_memory)
+                self._jobs[key] = _Job(units, longterm_memory, future)
+            submitted += 1
+        return submitted
+
+    def apply(self, story_id: str, characters: Iterable[Character], wait: bool = False) -> int:
+        '''
+        Merges finished consolidations into the characters of the story character table.
+        '''
+        applied = 0
+        for character in characters:
+            with self._lock:
+                job = self._jobs.get((story_id, character.ref))
+                if job is None or not (wait or job.future.done()):
+                    continue
+                del self._jobs[(story_id, character.ref)]
+            try:
+                longterm_memory = job.future.result()
+            except Exception as error:
+                print(f"Memory consolidation for {character.ref} failed, keeping shortterm memory: {error}")
+                continue
+
+            _drop_consolidated(character.shortterm_memory, job.units)
+            # Keep facts added since the snapshot
+            added = [memory for memory in character.longterm_memory if memory not in job.longterm_memory]
+            character.longterm_memory[:] = longterm_memory + added
+            applied += 1
+        return applied
+
+    def pending(self, story_id: str) -> int:
+        with self._lock:
+            return sum(1 for key in self._jobs if key[0] == story_id)
+
+
+_consolidator = None
+_consolidator_lock = threading.Lock()
+
+
+def get_consolidator() -> MemoryConsolidator:
+    global _consolidator
+    if _consolidator is None:
+        with _consolidator_lock:
+            if _consolidator is None:
+                _consolidator = MemoryConsolidator()
+    return _consolidator
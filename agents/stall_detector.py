@@ -0,0 +1,75 @@
+import os
+import re
+from typing import FrozenSet, List
+
+from pydantic_bp.core import CharacterMemoryUnit, Scene
+
+
+# STALL_DETECTION=0 sends every moment to the scene validator again
+ENABLED = os.getenv("STALL_DETECTION", "1") != "0"
+# A line repeats an earlier one of the scene when their word 3-gram Jaccard similarity is at least this
+REPEAT_SIMILARITY = float(os.getenv("STALL_REPEAT_SIMILARITY", "0.6"))
+# Lines of the scene looked at, and the share of them that must be repeats to close the scene
+WINDOW = int(os.getenv("STALL_WINDOW", "6"))
+CLOSE_RATIO = float(os.getenv("STALL_CLOSE_RATIO", "0.75"))
+# Share of repeats in the last moment from which the validator call is skipped, the scene goes on
+SKIP_RATIO = float(os.getenv("STALL_SKIP_RATIO", "1.0"))
+NGRAM = 3
+
+STALL_STATS = {"checks": 0, "validator_calls_saved": 0, "scenes_closed": 0}
+
+_WORD = re.compile(r"[a-z0-9']+")
+
+CONTINUE, SKIP, CLOSE = "continue", "skip", "close"
+
+
+def shingles(unit: CharacterMemoryUnit) -> FrozenSet[tuple]:
+    words = _WORD.findall(f"{unit.dialogue} {unit.action}".lower())
+    if len(words) < NGRAM:
+        return frozenset([tuple(words)]) if words else frozenset()
+    return frozenset(tuple(words[i:i + NGRAM]) for i in range(len(words) - NGRAM + 1))
+
+
+def similarity(a: FrozenSet[tuple], b: FrozenSet[tuple]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def repeats(units: List[CharacterMemoryUnit], history: int = 2 * WINDOW) -> List[bool]:
+    '''
+    For every line, whether it repeats one of the history lines before it, by any speaker.
+    '''
+    sets = [shingles(unit) for unit in units]
+    return [
+        any(similarity(sets[i], sets[j]) >= REPEAT_SIMILARITY for j in range(max(0, i - history), i))
+        for i in range(len(sets))
+    ]
+
+
+def check(scene: Scene, due: bool = True) -> str:
+    '''
+    Local verdict on the scene after a moment, before the validator is asked:
+    CLOSE when the characters loop on the same lines, SKIP when the last moment added nothing new
+    so the validator would answer as before, CONTINUE to ask the validator.
+    due tells whether the validation cadence would call the validator for this moment, a call
+    counts as saved only then.
+    '''
+    if not ENABLED or not scene.moments:
+        return CONTINUE
+    STALL_STATS["checks"] += 1
+    units = [unit for moment in scene.moments for unit in moment.situations]
+    repeated = repeats(units[-3 * WINDOW:])
+
+    window = repeated[-WINDOW:]
+    if len(window) >= WINDOW and sum(window) / len(window) >= CLOSE_RATIO:
+        STALL_STATS["scenes_closed"] += 1
+        STALL_STATS["validator_calls_saved"] += due
+        return CLOSE
+
+    last = repeated[-len(scene.moments[-1].situations):] if scene.moments[-1].situations else []
+    # The first validation of a scene is always asked
+    if last and len(scene.moments) > 1 and sum(last) / len(last) >= SKIP_RATIO:
+        STALL_STATS["validator_calls_saved"] += due
+        return SKIP
+    return CONTINUE
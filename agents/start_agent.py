@@ -1,10 +1,20 @@
+import operator
+import re
+from functools import lru_cache
 from pydantic import BaseModel, Field
-from typing import List, TypedDict
+from typing import Annotated, Dict, List, TypedDict
 from langchain_core.messages import SystemMessage, HumanMessage
 from langgraph.graph import StateGraph, END
+from langgraph.types import Send
 
 from pydantic_bp.core import Character, Entity
-from utils.model import lite_llm
+from pydantic_bp.world import WorldRegistry, normalize_name
+from utils.model import cassette, lite_llm
+
+
+# Inputs longer than this are split into chunks and processed map-reduce style
+CHUNK_CHARS = 12000
+CHUNK_OVERLAP_CHARS = 500
 
 
 class startAgentState(BaseModel):
@@ -14,6 +24,9 @@ class startAgentState(BaseModel):
     start_scene_description: str = ""
     main_goal: str = ""
 
+    chunks: List[str] = []
+    extractions: Annotated[List[dict], operator.add] = []
+
 class CharacterDict(TypedDict):
     name: str = Field(depescription="Name of the character")
     role: str = Field(depescription="Role of the character in the story")
@@ -33,6 +46,22 @@ class StartAgentOutput(TypedDict):
     start_scene_description: str = Field(depescription="Description of the starting scene")
     main_goal: str = Field(depescription="Main goal of the story, successfully occurrence of crime")
 
+class ChunkCharacterDict(CharacterDict):
+    aliases: List[str] = Field(description="Other names, nicknames or titles used for this character in the text")
+
+class ChunkExtractionOutput(TypedDict):
+    characters: List[ChunkCharacterDict]
+    entities: List[EntityDict]
+    summary: str = Field(description="Short summary of the events and situation in this part of the text")
+
+class StoryReduceOutput(TypedDict):
+    start_scene_description: str = Field(description="Description of the starting scene")
+    main_goal: str = Field(description="Main goal of the story")
+
+class ChunkState(TypedDict):
+    index: int
+    chunk: str
+
 
 def start_agent(state: startAgentState) -> StartAgentOutput:
 
@@ -82,19 +111,246 @@ def start_agent(state: startAgentState) -> StartAgentOutput:
         )       
     
 
+    # Assigns stable ids and merges duplicate characters and entities
+    world = WorldRegistry(characters, entities)
+
     print("Start Agent completed.")
 
     return {
-        "characters": characters,
-        "entities": entities,
+        "characters": world.character_list(),
+        "entities": world.entity_list(),
         "start_scene_description": res["start_scene_description"],
         "main_goal": res["main_goal"]
     }
 
+
+def split_text(text: str, chunk_chars: int = CHUNK_CHARS, overlap_chars: int = CHUNK_OVERLAP_CHARS) -> List[str]:
+    '''
+    Splits text into chunks of at most chunk_chars on paragraph boundaries (sentences for very long paragraphs).
+    Every chunk starts with the last overlap_chars of the previous one, so names spanning a boundary are not lost.
+    '''
+    if len(text) <= chunk_chars:
+        return [text]
+
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        if len(paragraph) <= chunk_chars - overlap_chars:
+            pieces.append(paragraph)
+            continue
+        for sentence in re.split(r"(?<=[.!?])\s+", paragraph):
+            # Hard split anything that is still too long
+            step = chunk_chars - overlap_chars
+            pieces.extend(sentence[i:i + step] for i in range(0, len(sentence), step))
+
+    chunks = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + len(piece) + 2 > chunk_chars:
+            chunks.append(current)
+            current = current[-overlap_chars:] if overlap_chars else ""
+        current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+
+    return chunks
+
+
+def split_input(state: startAgentState) -> startAgentState:
+    if cassette is not None:
+        # Lets a recorded story be replayed without the original input at hand
+        cassette.note(input_text=state.input_text)
+    chunks = split_text(state.input_text)
+    if len(chunks) > 1:
+        print(f"Input split into {len(chunks)} chunks.")
+    return {"chunks": chunks}
+
+
+def route_chunks(state: startAgentState):
+    '''
+    Short inputs go through the single call start agent, long ones are fanned out one Send per chunk.
+    '''
+    if len(state.chunks) <= 1:
+        return "start_agent"
+    return [Send("extract_chunk", {"index": i, "chunk": chunk}) for i, chunk in enumerate(state.chunks)]
+
+
+def extract_chunk(state: ChunkState) -> startAgentState:
+    '''
+    Map step, extracts characters and entities from a single chunk. Runs in parallel for all chunks.
+    '''
+    print(f"Extracting characters and entities from chunk {state['index'] + 1}...")
+
+    system_prompt = """You are an agent that analyzes one part of a longer text to identify its key characters and entities.
+    List every character and entity that appears in this part, with all the other names used for them.
+    Also summarize what happens in this part of the text.
+    """
+
+    extract_llm = lite_llm.with_structured_output(ChunkExtractionOutput)
+
+    res = extract_llm.invoke([
+        SystemMessage(content=system_prompt),
+        HumanMessage(content=f"Text part {state['index'] + 1}:\n{state['chunk']}")
+    ])
+
+    return {"extractions": [{"index": state["index"], **res}]}
+
+
+def _merge_lists(*lists: List[str]) -> List[str]:
+    merged = []
+    seen = set()
+    for items in lists:
+        for item in items or []:
+            key = item.strip().lower()
+            if key and key not in seen:
+                seen.add(key)
+                merged.append(item.strip())
+    return merged
+
+
+def merge_characters(extracted: List[dict]) -> List[dict]:
+    '''
+    Merges characters extracted from different chunks, resolving names and aliases.
+    Two entries are the same character when a normalized name or alias matches, or when a single word
+    name matches a word of exactly one known character (e.g. "Thorne" and "Dr. Aris Thorne").
+    '''
+    merged: List[dict] = []
+    index: Dict[str, int] = {}
+
+    def keys(character: dict) -> List[str]:
+        names = [character["name"]] + list(character.get("aliases") or [])
+        return [key for key in (normalize_name(name) for name in names) if key]
+
+    def find(character: dict):
+        for key in keys(character):
+            if key in index:
+                return index[key]
+        for key in keys(character):
+            if " " in key:
+                # "Dr. Aris Thorne" after a plain "Thorne"
+                candidates = {index[word] for word in key.split() if word in index}
+            else:
+                candidates = {position for name_key, position in index.items() if key in name_key.split()}
+            if len(candidates) == 1:
+                return candidates.pop()
+        return None
+
+    for character in extracted:
+        position = find(character)
+        if position is None:
+            position = len(merged)
+            merged.append({**character, "aliases": _merge_lists(character.get("aliases"))})
+        else:
+            existing = merged[position]
+            # The longest name is usually the most complete one
+            names = sorted([existing["name"], character["name"]], key=lambda name: (len(normalize_name(name)), len(name)), reverse=True)
+            aliases = _merge_lists(existing["aliases"], names[1:], character.get("aliases"))
+            existing["name"] = names[0]
+            existing["aliases"] = [alias for alias in aliases if alias.lower() != names[0].lower()]
+            for key in ("longtime_goals", "personality", "strengths", "weaknesses"):
+                existing[key] = _merge_lists(existing.get(key), character.get(key))
+            if not existing.get("role"):
+                existing["role"] = character.get("role", "")
+
+        for key in keys(merged[position]):
+            index.setdefault(key, position)
+
+    return merged
+
+
+def merge_entities(extracted: List[dict]) -> List[dict]:
+    merged: Dict[str, dict] = {}
+    for entity in extracted:
+        key = normalize_name(entity["name"])
+        if key not in merged:
+            merged[key] = dict(entity)
+        elif entity["description"] and entity["description"] not in merged[key]["description"]:
+            merged[key]["description"] = f"{merged[key]['description']} {entity['description']}".strip()
+    return list(merged.values())
+
+
+def reduce_story(state: startAgentState) -> StartAgentOutput:
+    '''
+    Reduce step, merges the chunk extractions and creates the starting scene and main goal from
+    the merged roster and the chunk summaries, without sending the source text again.
+    '''
+    print("Merging chunk extractions...")
+
+    extractions = sorted(state.extractions, key=lambda extraction: extraction["index"])
+    characters_data = merge_characters([character for extraction in extractions for character in extraction["characters"]])
+    entities_data = merge_entities([entity for extraction in extractions for entity in extraction["entities"]])
+
+    system_prompt = """You are an agent that generates a compelling starting scene description and the main goal for a story.
+    You are given the characters and entities of the source text, and summaries of its parts in order.
+    """
+
+    roster = "\n".join(f"- {character['name']} ({character['role']})" for character in characters_data)
+    entity_list = "\n".join(f"- {entity['name']}: {entity['description']}" for entity in entities_data)
+    summaries = "\n".join(f"{extraction['index'] + 1}. {extraction['summary']}" for extraction in extractions)
+
+    reduce_llm = lite_llm.with_structured_output(StoryReduceOutput)
+
+    res = reduce_llm.invoke([
+        SystemMessage(content=system_prompt),
+        HumanMessage(content=f"""
+        Characters:
+        {roster}
+        Entities:
+        {entity_list}
+        Summaries of the source text parts:
+        {summaries}
+        """)
+    ])
+
+    characters = []
+    for character in characters_data:
+        characters.append(
+            Character(
+                name=character["name"],
+                role=character["role"],
+                longtime_goals=character["longtime_goals"],
+                personality=character["personality"],
+                strengths=character["strengths"],
+                weaknesses=character["weaknesses"],
+                shortterm_memory=[],
+                longterm_memory=[],
+                aliases=character.get("aliases", []),
+                memory_factor=character.get("memory_factor", 0.5)
+            )
+        )
+
+    entities = [Entity(name=entity["name"], description=entity["description"]) for entity in entities_data]
+    world = WorldRegistry(characters, entities)
+
+    print("Start Agent completed.")
+
+    return {
+        "characters": world.character_list(),
+        "entities": world.entity_list(),
+        "start_scene_description": res["start_scene_description"],
+        "main_goal": res["main_goal"]
+    }
+
+
 start_agent_workflow = StateGraph(startAgentState)
+start_agent_workflow.add_node("split_input", split_input)
 start_agent_workflow.add_node("start_agent", start_agent)
+start_agent_workflow.add_node("extract_chunk", extract_chunk)
+start_agent_workflow.add_node("reduce_story", reduce_story)
 
-start_agent_workflow.set_entry_point("start_agent")
+start_agent_workflow.set_entry_point("split_input")
+start_agent_workflow.add_conditional_edges("split_input", route_chunks, ["start_agent", "extract_chunk"])
+start_agent_workflow.add_edge("extract_chunk", "reduce_story")
 start_agent_workflow.add_edge("start_agent", END)
+start_agent_workflow.add_edge("reduce_story", END)
+
+
+@lru_cache(maxsize=None)
+def get_start_agent_app():
+    return start_agent_workflow.compile()
+
 
-start_agent_app = start_agent_workflow.compile()
+def __getattr__(name):
+    # start_agent_app is compiled on first use
+    if name == "start_agent_app":
+        return get_start_agent_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,79 @@
+import os
+import re
+from typing import Dict, List, Set
+
+from pydantic_bp.core import Character, CharacterMemoryUnit, Scene
+
+
+# Characters that act per moment, the others wait for a later moment. 0 (default) turns the scheduler off,
+# the whole cast acts every moment in cast order
+SPEAKERS_PER_MOMENT = int(os.getenv("SPEAKERS_PER_MOMENT", "0"))
+
+# Scores of the local signals, the character with the highest score acts next
+ADDRESSED_WEIGHT = 4.0      # someone spoke to the character since its last turn
+LAST_ADDRESSED_WEIGHT = 1.0  # ... in the very last line
+RECENCY_CAP = 6             # one point per line since the character last acted, up to this
+GOAL_WEIGHT = 0.5           # per shorttime goal word that came up in the recent lines
+GOAL_CAP = 3
+RECENT_UNITS = 6
+
+SCHEDULER_STATS = {"moments": 0, "turns": 0, "skipped": 0}
+
+_WORD = re.compile(r"[a-z0-9']{4,}")
+
+
+def _words(text: str) -> Set[str]:
+    return set(_WORD.findall(text.lower()))
+
+
+def scene_units(scene: Scene) -> List[CharacterMemoryUnit]:
+    return [unit for moment in scene.moments for unit in moment.situations]
+
+
+def speaker_score(character: Character, units: List[CharacterMemoryUnit]) -> float:
+    '''
+    Cheap local relevance of a character for the next turn, from the lines of the scene so far.
+    '''
+    last_turn = next((i for i in range(len(units) - 1, -1, -1) if units[i].who_said == character.name), None)
+    since = units[last_turn + 1:] if last_turn is not None else units
+    # Characters that have not acted in the scene yet rank like the ones that waited longest
+    score = float(min(len(since), RECENCY_CAP)) if last_turn is not None else RECENCY_CAP + 1.0
+
+    if any(character.name in unit.who_listens for unit in since):
+        score += ADDRESSED_WEIGHT
+    if units and units[-1].who_said != character.name and character.name in units[-1].who_listens:
+        score += LAST_ADDRESSED_WEIGHT
+
+    if character.shorttime_goals:
+        recent = set()
+        for unit in units[-RECENT_UNITS:]:
+            recent |= _words(f"{unit.dialogue} {unit.action}")
+        goal_words = _words(" ".join(character.shorttime_goals))
+        score += GOAL_WEIGHT * min(len(goal_words & recent), GOAL_CAP)
+    return score
+
+
+def next_speaker(scene: Scene, cast: List[Character], start: int, acted: Set[int]) -> int:
+    '''
+    Index in the cast of the character that acts next, among the ones that have not acted in this moment.
+    Ties, and a scene without lines yet, fall back to round-robin from start. With the scheduler off
+    the cast acts in its order.
+    '''
+    candidates = [i for i in range(len(cast)) if i not in acted]
+    if SPEAKERS_PER_MOMENT <= 0:
+        return candidates[0]
+    units = scene_units(scene)
+    return max(candidates, key=lambda i: (speaker_score(cast[i], units), -((i - start) % len(cast))))
+
+
+def speakers_per_moment(cast: List[Character]) -> int:
+    if SPEAKERS_PER_MOMENT <= 0:
+        return len(cast)
+    return min(SPEAKERS_PER_MOMENT, len(cast))
+
+
+def record_moment(cast: List[Character], turns: int) -> Dict[str, int]:
+    SCHEDULER_STATS["moments"] += 1
+    SCHEDULER_STATS["turns"] += turns
+    SCHEDULER_STATS["skipped"] += len(cast) - turns
+    return SCHEDULER_STATS
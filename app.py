@@ -1,105 +1,98 @@
 import gradio as gr
-from langgraph.checkpoint.sqlite import SqliteSaver
-from agents.start_agent import start_agent_app
-from agents.env_agent import env_agent_workflow
-from utils.get_env import get_env_variable
+from utils.jobs import JobService
 
 
-env_agent_app = None
+job_service = None
 
 
 def initialize_app():
-    global env_agent_app
-    with SqliteSaver.from_conn_string("env_agent_checkpoint.db") as memory:
-        env_agent_app = env_agent_workflow.compile(checkpointer=memory)
+    global job_service
+    # Jobs are persisted, stories interrupted by a restart continue from their checkpoints
+    job_service = JobService().start()
 
 
-def check_story_exists() -> bool:
-    """Checks if a saved state exists for the given thread_id."""
-    config = {"configurable": {"thread_id": get_env_variable("THREAD_ID")}}
-    try:
-        env_agent_app.get_state(config)
+def get_user_id(request: gr.Request) -> str:
+    """Logged in user when auth is enabled, otherwise the browser session"""
+    return request.username or request.session_hash
+
+
+def can_resume(thread_id: str, request: gr.Request) -> bool:
+    """Logged in users resume their own stories. A browser session ends with a page reload,
+    without auth the story ID is what a user keeps to come back to a story"""
+    if not request.username:
         return True
-    except Exception:
-        return False
-
-
-def run_start_agent(input_text: str):
-    initial_state = {
-        "input_text": input_text,
-        "characters": [],
-        "entities": [],
-        "start_scene_description": "",
-        "main_goal": ""
-    }
-    output_state = start_agent_app.invoke(initial_state)
-
-    initial_state["characters"] = output_state["characters"]
-    initial_state["entities"] = output_state["entities"]
-    initial_state["start_scene_description"] = output_state["start_scene_description"]
-    initial_state["main_goal"] = output_state["main_goal"]
-
-    return initial_state
-
-
-def run_env_agent(state, resume: bool):
-    config = {
-        "recursion_limit": 50,
-        "configurable": {
-            "thread_id": get_env_variable("THREAD_ID")
-        }
-    }
-
-    if resume and check_story_exists():
-        output_state = env_agent_app.invoke(None, config=config)
-        return output_state
-    
-    output_state = env_agent_app.invoke(state, config=config)
-    return output_state
+    owner = job_service.thread_owner(thread_id)
+    return owner is None or owner == request.username
 
 
-def generate_new_story(prompt: str, progress=gr.Progress()):
-    """Generate a new story from scratch"""
-    try:
-        progress(0, desc="Running start agent...")
-        output = run_start_agent(prompt)
-        
-        progress(0.3, desc="Starting story generation...")
-        story_state = {
-            "main_goal": output["main_goal"],
-            "is_main_goal_achieved": False,
-            "characters": output["characters"],
-            "entities": output["entities"],
-            "scenes": [],
-            "next_character_index": 0,
-            "next_scene_no": 1,
-            "next_scene": output["start_scene_description"],
-            "is_scene_complete": False,
-            "current_scene": None,
-            "next_moment_no": 1,
-            "current_moment": None
-        }
-        
-        progress(0.5, desc="Generating story...")
-        result = run_env_agent(story_state, resume=False)
-        
-        return format_story_output(result)
-    except Exception as e:
-        return f"Error generating story: {str(e)}"
+def job_status(job) -> str:
+    status = f"**Job** `{job['job_id']}` | **Story** `{job['thread_id']}` | **Status:** {job['status']} | **Scenes completed:** {job['scene_count']}"
+    if job["error"]:
+        status += f"\n\n{job['error']}"
+    return status
+
 
+def follow_job(job):
+    """Stream the status of a job, then the story once it is finished"""
+    for job in job_service.watch(job["job_id"]):
+        yield job["job_id"], job_status(job)
+    state = job_service.app.get_state({"configurable": {"thread_id": job["thread_id"]}}).values
+    yield job["job_id"], job_status(job) + "\n\n" + (format_story_output(state) if state else "")
 
-def resume_story(progress=gr.Progress()):
-    """Resume an existing story from checkpoint"""
+
+def generate_new_story(prompt: str, request: gr.Request):
+    """Queue a new story and follow it until it is finished"""
     try:
-        if not check_story_exists():
-            return "No existing story found. Please generate a new story first."
-        
-        progress(0, desc="Resuming story...")
-        result = run_env_agent(None, resume=True)
-        
-        return format_story_output(result)
+        job = job_service.submit(get_user_id(request), input_text=prompt)
     except Exception as e:
-        return f"Error resuming story: {str(e)}"
+        yield None, f"Error generating story: {str(e)}"
+        return
+    yield from follow_job(job)
+
+
+def resume_story(thread_id: str, last_job_id, request: gr.Request):
+    """Continue a stored story from its checkpoint, by default the last one of this session.
+    A story that is still being generated, e.g. before a page reload, is followed again"""
+    user_id = get_user_id(request)
+    thread_id = (thread_id or "").strip()
+    if not thread_id and last_job_id:
+        thread_id = job_service.get(last_job_id)["thread_id"]
+
+    if not thread_id or not job_service.saver.story_exists(thread_id):
+        yield last_job_id, "No existing story found. Please generate a new story first."
+        return
+    if not can_resume(thread_id, request):
+        yield last_job_id, "This story belongs to another user."
+        return
+
+    active = job_service.active_job(thread_id)
+    if active is not None:
+        yield from follow_job(active)
+        return
+    try:
+        job = job_service.submit(user_id, thread_id=thread_id)
+    except Exception as e:
+        yield last_job_id, f"Error resuming story: {str(e)}"
+        return
+    yield from follow_job(job)
+
+
+def cancel_job(job_id):
+    """Cancel the job of this session"""
+    if job_id and job_service.cancel(job_id):
+        return "Cancelling, the story stops after the current step and can be resumed later."
+    return "No story is being generated."
+
+
+def list_user_jobs(request: gr.Request):
+    """Jobs of this user, most recent first"""
+    jobs = job_service.list_jobs(get_user_id(request))
+    if not jobs:
+        return "No jobs yet."
+    rows = ["| Job | Story | Status | Created | Error |", "|---|---|---|---|---|"]
+    for job in jobs:
+        rows.append(f"| `{job['job_id']}` | `{job['thread_id']}` | {job['status']} | {job['created_at'][:19]} | {job['error'] or ''} |")
+    return "\n".join(rows)
 
 
 def format_story_output(state):
@@ -144,6 +137,8 @@ def main():
     with gr.Blocks(title="Story Engine", theme=gr.themes.Soft()) as demo:
         gr.Markdown("# 🎭 Story Engine")
         gr.Markdown("Generate AI-powered interactive stories with dynamic characters and environments.")
+        # Job of this browser session, for cancel and resume
+        job_id = gr.State(None)
         
         with gr.Tabs():
             with gr.Tab("Generate New Story"):
@@ -155,25 +150,54 @@ def main():
                         value="In a distant future, humanity has colonized Mars. Amidst political turmoil and environmental challenges, a group of explorers embarks on a mission to uncover ancient Martian artifacts that could hold the key to humanity's survival."
                     )
                     generate_btn = gr.Button("Generate Story", size="lg", variant="primary")
+                    cancel_btn = gr.Button("Cancel Story", size="sm", variant="stop")
+                    cancel_status = gr.Markdown()
                     
                     output = gr.Markdown(label="Story Output")
                     
+                    # Handlers only follow their job, the worker pool bounds the actual generation
                     generate_btn.click(
                         fn=generate_new_story,
                         inputs=[prompt_input],
-                        outputs=[output]
+                        outputs=[job_id, output],
+                        concurrency_limit=None
+                    )
+                    cancel_btn.click(
+                        fn=cancel_job,
+                        inputs=[job_id],
+                        outputs=[cancel_status]
                     )
             
             with gr.Tab("Resume Story"):
                 with gr.Column():
                     gr.Markdown("Resume your previously started story from where you left off.")
+                    thread_input = gr.Textbox(label="Story ID", placeholder="Leave empty for the last story of this session, or the story ID to come back to it after a reload")
                     resume_btn = gr.Button("Resume Story", size="lg", variant="primary")
+                    cancel_resume_btn = gr.Button("Cancel Story", size="sm", variant="stop")
+                    cancel_resume_status = gr.Markdown()
                     
                     output_resume = gr.Markdown(label="Story Output")
                     
                     resume_btn.click(
                         fn=resume_story,
-                        outputs=[output_resume]
+                        inputs=[thread_input, job_id],
+                        outputs=[job_id, output_resume],
+                        concurrency_limit=None
+                    )
+                    cancel_resume_btn.click(
+                        fn=cancel_job,
+                        inputs=[job_id],
+                        outputs=[cancel_resume_status]
+                    )
+            
+            with gr.Tab("My Jobs"):
+                with gr.Column():
+                    refresh_btn = gr.Button("Refresh", size="sm")
+                    jobs_output = gr.Markdown()
+                    
+                    refresh_btn.click(
+                        fn=list_user_jobs,
+                        outputs=[jobs_output]
                     )
     
     return demo
@@ -0,0 +1,74 @@
+'''
+Prompt size and latency of retrieval-based casting as the roster grows.
+
+For synthetic rosters of increasing size, prints the estimated tokens of the characters section of the
+scene_creator prompt with the whole roster and with the CAST_SHORTLIST candidates, the time to build the
+casting index and to shortlist a scene reference against it, and whether the character the reference
+names made the shortlist.
+
+    python -m benchmarks.bench_casting --sizes 10 100 1000 --shortlist 12
+'''
+import argparse
+import random
+import time
+from typing import List
+
+from pydantic_bp.core import Character
+from utils import casting
+from utils.prompt_builder import characters_fragment
+from utils.tokens import estimate_tokens
+
+ROLES = ["blacksmith", "sailor", "priest", "thief", "captain", "scholar", "healer", "guard", "merchant", "spy"]
+GOALS = [
+    "find the lost crown", "avenge the burned village", "map the northern sea", "cure the plague",
+    "win the tournament", "steal the ledger", "protect the harbor", "decode the star chart",
+]
+
+
+def make_roster(size: int, rng: random.Random) -> List[Character]:
+    return [
+        Character(
+            id=f"character-{i}",
+            name=f"Character {i}",
+            role=rng.choice(ROLES),
+            longtime_goals=rng.sample(GOALS, 2),
+            personality=["Curious", "Stubborn"],
+            strengths=["Patience"],
+            weaknesses=["Pride"],
+            shortterm_memory=[],
+            longterm_memory=[],
+        )
+        for i in range(size)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 200, 1000])
+    parser.add_argument("--shortlist", type=int, default=casting.CAST_SHORTLIST)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    backend = "numpy" if casting._get_numpy() is not None else "python"
+    print(f"casting index backend: {backend}, shortlist {args.shortlist}")
+    print(f"{'roster':>7} {'full tokens':>12} {'shortlist tokens':>17} {'build ms':>9} {'query ms':>9} {'named found':>12}")
+    for size in args.sizes:
+        roster = make_roster(size, rng)
+        named = rng.randrange(size)
+        reference = f"A healer tries to cure the plague at the harbor, with {roster[named].name}"
+
+        start = time.perf_counter()
+        casting.character_index(roster)
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        shortlist = casting.shortlist_characters(roster, reference, k=args.shortlist)
+        query = time.perf_counter() - start
+
+        full_tokens = estimate_tokens(characters_fragment("scene_creator", roster))
+        shortlist_tokens = estimate_tokens(characters_fragment("scene_creator", casting.pick(roster, shortlist)))
+        print(f"{size:7} {full_tokens:12} {shortlist_tokens:17} {build * 1e3:9.1f} {query * 1e3:9.2f} {str(named in shortlist):>12}")
+
+
+if __name__ == "__main__":
+    main()
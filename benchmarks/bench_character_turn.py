@@ -0,0 +1,102 @@
+'''
+Per-turn orchestration overhead of a character turn, with the fake LLM backend (LLM_MODE=fake).
+
+Compares the compiled character sub-graph (get_character_app().invoke, as moment_runner called it
+before) with the direct character_turn call, standalone and nested in a parent graph with a
+checkpointer, where the sub-graph also wrote its own checkpoints for every turn. The bare fake LLM
+call and prompt build are timed as the floor both paths share.
+
+    python -m benchmarks.bench_character_turn --cast 5 --memory 100 --moments 20
+'''
+import argparse
+import os
+import timeit
+
+# The LLM clients are chosen when utils.model is imported
+os.environ.setdefault("LLM_MODE", "fake")
+
+from typing import List, TypedDict
+
+from langgraph.checkpoint.sqlite import SqliteSaver
+from langgraph.graph import StateGraph, END
+
+from agents.character_agent import CharacterResponse, character_prompt, character_turn, get_character_app
+from benchmarks.bench_pydantic_overhead import make_scene
+from pydantic_bp.core import Character, Scene
+from utils.model import lite_llm
+
+
+class TurnState(TypedDict):
+    scene: Scene
+    cast: List[Character]
+    turns: int
+
+
+def nested_app(use_subgraph: bool, checkpointer):
+    '''
+    Parent graph running one turn per step, like moment_runner inside env_agent_workflow.
+    '''
+    def turn(state: TurnState):
+        scene, cast = state["scene"], state["cast"]
+        character = cast[state["turns"] % len(cast)]
+        if use_subgraph:
+            get_character_app().invoke({"scene": scene, "cast": cast, "current_character": character})
+        else:
+            character_turn(scene, cast, character)
+        return {"turns": state["turns"] + 1}
+
+    workflow = StateGraph(TurnState)
+    workflow.add_node("turn", turn)
+    workflow.set_entry_point("turn")
+    workflow.add_edge("turn", END)
+    return workflow.compile(checkpointer=checkpointer)
+
+
+def per_call_us(fn, number: int) -> float:
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cast", type=int, default=5)
+    parser.add_argument("--memory", type=int, default=100, help="Shortterm memory units per character.")
+    parser.add_argument("--moments", type=int, default=20)
+    parser.add_argument("--number", type=int, default=200)
+    args = parser.parse_args()
+
+    if os.environ["LLM_MODE"] != "fake":
+        raise SystemExit("Run with LLM_MODE=fake, the benchmark measures orchestration and not the model")
+
+    scene, cast = make_scene(args.cast, args.memory, args.moments)
+    character = cast[0]
+    # Every turn appends to the shortterm memory of the cast, fill it up to its bound so all paths see the same prompt size
+    for _ in range(character.max_shortterm_memory):
+        character_turn(scene, cast, character)
+    character_llm = lite_llm.with_structured_output(CharacterResponse)
+
+    print(f"cast: {args.cast}, shortterm memory: {args.memory}, moments: {args.moments}")
+    floor = per_call_us(lambda: character_llm.invoke(character_prompt(scene, cast, character).build()), args.number)
+    print(f"{'prompt + fake LLM (floor)':32} {floor:9.1f} us")
+
+    standalone = {
+        "sub-graph": per_call_us(lambda: get_character_app().invoke({"scene": scene, "cast": cast, "current_character": character}), args.number),
+        "direct": per_call_us(lambda: character_turn(scene, cast, character), args.number),
+    }
+
+    nested = {}
+    with SqliteSaver.from_conn_string(":memory:") as checkpointer:
+        for name, use_subgraph in (("sub-graph", True), ("direct", False)):
+            app = nested_app(use_subgraph, checkpointer)
+            config = {"configurable": {"thread_id": f"bench-{name}"}}
+            nested[name] = per_call_us(lambda: app.invoke({"scene": scene, "cast": cast, "turns": 0}, config), max(1, args.number // 4))
+
+    for label, results in (("standalone", standalone), ("in a checkpointed graph", nested)):
+        overhead = results["sub-graph"] - results["direct"]
+        print(f"{label}:")
+        for name, us in results.items():
+            print(f"    {name:28} {us:9.1f} us   orchestration over floor {us - floor:9.1f} us")
+        print(f"    {'removed per turn':28} {overhead:9.1f} us")
+
+
+if __name__ == "__main__":
+    main()
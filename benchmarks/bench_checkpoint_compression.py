@@ -0,0 +1,93 @@
+'''
+Stored size of checkpoints against encode/decode latency, for each CHECKPOINT_COMPRESSION codec and level.
+
+Checkpoints and writes are read from a checkpoint DB (opened read-only) and re-serialized with every
+codec. Dictionaries are trained on the older half of the rows and measured on the newer half, like a
+dictionary trained on earlier stories compresses the next ones. Latency is per row and includes the msgpack
+step all codecs share, "none" is that floor.
+
+    python -m benchmarks.bench_checkpoint_compression --db env_agent_checkpoint.db
+    python -m benchmarks.bench_checkpoint_compression --db replay_checkpoint.db --limit 500
+'''
+import argparse
+import sqlite3
+import statistics
+import time
+from typing import List
+
+from utils.checkpointer import DB_PATH
+from utils.compressed_serde import DICTIONARY_SIZE, MIN_SIZE, CompressedSerializer, load_dictionaries
+
+CONFIGS = [("none", None), ("zlib", 1), ("zlib", 3), ("zlib", 6), ("zlib", 9), ("zstd", 1), ("zstd", 3), ("zstd", 9), ("zstd", 19)]
+
+
+def load_objects(conn: sqlite3.Connection, table: str, column: str, limit: int) -> List[object]:
+    serde = CompressedSerializer("none")
+    serde.use_dictionaries(load_dictionaries(conn))
+    rows = conn.execute(f"SELECT type, {column} FROM {table} ORDER BY checkpoint_id LIMIT ?", (limit,)).fetchall()
+    return [serde.loads_typed((type, data)) for type, data in rows if type is not None]
+
+
+def measure(serde: CompressedSerializer, objects: List[object], repeat: int) -> dict:
+    encode, decode = [], []
+    size = raw = 0
+    for obj in objects:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            stored = serde.dumps_typed(obj)
+        encode.append((time.perf_counter() - start) / repeat)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            serde.loads_typed(stored)
+        decode.append((time.perf_counter() - start) / repeat)
+        size += len(stored[1])
+        raw += len(serde.inner.dumps_typed(obj)[1])
+    return {
+        "bytes": size,
+        "ratio": raw / size if size else 0,
+        "encode_us": statistics.mean(encode) * 1e6,
+        "decode_us": statistics.mean(decode) * 1e6,
+        "encode_mb_s": raw / sum(encode) / 2**20,
+        "decode_mb_s": raw / sum(decode) / 2**20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--limit", type=int, default=1000, help="Checkpoints and writes to read")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--dict-size", type=int, default=DICTIONARY_SIZE)
+    args = parser.parse_args()
+
+    conn = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+    train, test = [], []
+    for table, column in (("checkpoints", "checkpoint"), ("writes", "value")):
+        objects = load_objects(conn, table, column, args.limit)
+        train += objects[:len(objects) // 2]
+        test += objects[len(objects) // 2:]
+    if len(test) < 2:
+        raise SystemExit(f"{args.db} has too few checkpoints, run a story first")
+
+    import zstandard
+
+    samples = [payload for payload in (CompressedSerializer("none").inner.dumps_typed(obj)[1] for obj in train) if len(payload) >= MIN_SIZE]
+    dictionary = zstandard.train_dictionary(args.dict_size, samples).as_bytes()
+
+    print(f"{args.db}: {len(train) + len(test)} rows, measured on the newer {len(test)}, dictionary trained on {len(samples)}")
+    print(f"{'codec':16} {'stored KB':>10} {'ratio':>6} {'encode us':>10} {'decode us':>10} {'encode MB/s':>12} {'decode MB/s':>12}")
+    configs = [(codec, level, False) for codec, level in CONFIGS] + [("zstd", 3, True), ("zstd", 9, True)]
+    for codec, level, use_dictionary in configs:
+        serde = CompressedSerializer(codec, level)
+        if use_dictionary:
+            serde.use_dictionaries({1: dictionary})
+        result = measure(serde, test, args.repeat)
+        name = f"{codec} {level or ''}{' +dict' if use_dictionary else ''}".strip()
+        print(
+            f"{name:16} {result['bytes'] / 1024:10.1f} {result['ratio']:6.2f} {result['encode_us']:10.1f} "
+            f"{result['decode_us']:10.1f} {result['encode_mb_s']:12.1f} {result['decode_mb_s']:12.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
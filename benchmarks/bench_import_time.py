@@ -0,0 +1,84 @@
+'''
+Cold start import time of the entry points, measured with python -X importtime.
+
+Every target is imported in a fresh interpreter without GOOGLE_API_KEY, so importing must neither
+need credentials nor build LLM clients. Prints the best of --runs for each target, the modules with
+the largest own import time, and fails (exit code 1) when a target is over its budget.
+
+    python -m benchmarks.bench_import_time
+    python -m benchmarks.bench_import_time --runs 10 --target cli=0.6
+'''
+import argparse
+import os
+import re
+import subprocess
+import sys
+from typing import Dict, List, Tuple
+
+
+# name -> (module, budget in seconds)
+TARGETS: Dict[str, Tuple[str, float]] = {
+    "cli": ("main", 0.8),                       # python main.py
+    "worker": ("agents.env_agent", 0.75),       # batch and job workers running the story graph
+    "checkpoint_reader": ("utils.export", 0.35),  # tools that only read checkpoints
+}
+
+_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)")
+
+
+def measure(module: str) -> Tuple[float, List[Tuple[str, int]]]:
+    '''
+    Cumulative import time of the module in seconds, and (module, own microseconds) of every import.
+    '''
+    env = {key: value for key, value in os.environ.items() if key not in ("GOOGLE_API_KEY", "LLM_MODE")}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=env,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    total = 0
+    modules = []
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if not match:
+            continue
+        own, cumulative, _, name = match.groups()
+        modules.append((name, int(own)))
+        if name == module:
+            total = int(cumulative)
+    return total / 1e6, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=8, help="Heaviest modules to list per target")
+    parser.add_argument("--target", action="append", default=[], help="Override a budget, name=seconds")
+    args = parser.parse_args()
+
+    targets = dict(TARGETS)
+    for override in args.target:
+        name, seconds = override.split("=")
+        targets[name] = (targets[name][0], float(seconds))
+
+    failed = []
+    for name, (module, budget) in targets.items():
+        runs = [measure(module) for _ in range(args.runs)]
+        best, modules = min(runs, key=lambda run: run[0])
+        status = "ok" if best <= budget else "OVER BUDGET"
+        if best > budget:
+            failed.append(name)
+
+        print(f"{name:18} import {module:20} best {best * 1000:7.1f} ms  budget {budget * 1000:6.0f} ms  {status}")
+        for module_name, own in sorted(modules, key=lambda item: item[1], reverse=True)[:args.top]:
+            print(f"    {own / 1000:7.1f} ms  {module_name}")
+
+    if failed:
+        print(f"Over budget: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+'''
+Memory per memory unit of a story restored from its checkpoint, with and without interned names.
+
+Builds a story of N moments, dumps it like a checkpoint (every string is a new object when loaded back)
+and validates it again, once with the engine models, where CharacterMemoryUnit interns who_said and
+who_listens, and once with the same models without interning. Memory is measured with tracemalloc.
+
+    python -m benchmarks.bench_memory_units --moments 10000 --cast 4
+'''
+import argparse
+import json
+import random
+import tracemalloc
+from typing import List
+
+from pydantic import BaseModel
+
+from pydantic_bp.core import CharacterMemoryUnit, Moment, Scene
+
+MOMENTS_PER_SCENE = 20
+
+
+class PlainMemoryUnit(BaseModel):
+    who_said: str
+    who_listens: List[str]
+    dialogue: str
+    action: str
+
+
+class PlainMoment(BaseModel):
+    no: int
+    situations: List[PlainMemoryUnit]
+
+
+class PlainScene(BaseModel):
+    no: int
+    description: str
+    character_ids: List[str]
+    moments: List[PlainMoment]
+
+
+def make_story(moments: int, cast: int, units_per_moment: int, rng: random.Random) -> str:
+    names = [f"Character {i} of the Northern Realm" for i in range(cast)]
+    scenes = []
+    for scene_no in range(-(-moments // MOMENTS_PER_SCENE)):
+        scene_moments = []
+        for moment_no in range(min(MOMENTS_PER_SCENE, moments - scene_no * MOMENTS_PER_SCENE)):
+            units = []
+            for _ in range(units_per_moment):
+                speaker = rng.choice(names)
+                units.append(CharacterMemoryUnit(
+                    who_said=speaker,
+                    who_listens=[name for name in names if name != speaker],
+                    dialogue=" ".join(rng.choice(["we", "must", "go", "north", "before", "the", "storm", "breaks"]) for _ in range(rng.randint(6, 24))),
+                    action=rng.choice(["Waits.", "Draws a map in the sand.", "Looks at the horizon."]),
+                ))
+            scene_moments.append(Moment(no=moment_no, situations=units))
+        scenes.append(Scene(no=scene_no, description=f"Scene {scene_no}", character_ids=[], moments=scene_moments))
+    return json.dumps([scene.model_dump() for scene in scenes])
+
+
+def restored_bytes(model, dump: str) -> int:
+    # Loaded data is dropped once validated, what stays is what the models hold
+    tracemalloc.start()
+    data = json.loads(dump)
+    scenes = [model.model_validate(scene) for scene in data]
+    del data
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del scenes
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--moments", type=int, default=10_000)
+    parser.add_argument("--cast", type=int, default=4)
+    parser.add_argument("--units", type=int, default=3, help="Memory units per moment")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    dump = make_story(args.moments, args.cast, args.units, random.Random(args.seed))
+    events = args.moments * args.units
+    plain = restored_bytes(PlainScene, dump)
+    interned = restored_bytes(Scene, dump)
+    print(f"{args.moments} moments, {events} memory units, cast of {args.cast}")
+    print(f"{'models':28} {'MB':>8} {'bytes/unit':>11}")
+    print(f"{'pydantic, names per unit':28} {plain / 2**20:8.1f} {plain / events:11.0f}")
+    print(f"{'pydantic, interned names':28} {interned / 2**20:8.1f} {interned / events:11.0f}")
+    print(f"saved {1 - interned / plain:.0%} per unit")
+
+
+if __name__ == "__main__":
+    main()
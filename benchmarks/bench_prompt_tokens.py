@@ -0,0 +1,59 @@
+'''
+Compares prompt encodings by input tokens on real checkpoints.
+
+For the latest checkpoint of every thread in the checkpoint DB, encodes the roster, entities and
+scene history the way scene_creator, scene_validator and final_goal_validator embed them, in every
+format of utils.prompt_encoding, and prints the estimated tokens per format.
+
+    python -m benchmarks.bench_prompt_tokens --db env_agent_checkpoint.db
+'''
+import argparse
+import sqlite3
+
+from utils.checkpointer import StorySaver
+from utils.export import DB_PATH, iter_latest_checkpoints, load_story
+from utils.prompt_encoding import FORMATS, characters_data, encode, entities_data, scene_data, scenes_data
+from utils.tokens import estimate_tokens
+
+
+def prompt_sections(state: dict) -> dict:
+    sections = {
+        "characters": characters_data(state.get("characters") or []),
+        "entities": entities_data(state.get("entities") or []),
+        "scenes": scenes_data(state.get("scenes") or []),
+    }
+    if state.get("current_scene") is not None:
+        sections["current_scene"] = scene_data(state["current_scene"])
+    return sections
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default=DB_PATH)
+    args = parser.parse_args()
+
+    totals = {fmt: 0 for fmt in FORMATS}
+    conn = sqlite3.connect(args.db, check_same_thread=False)
+    try:
+        saver = StorySaver(conn)
+        for thread_id, checkpoint_id in list(iter_latest_checkpoints(conn)):
+            state = load_story(saver, thread_id, checkpoint_id)
+            if state is None:
+                continue
+
+            print(f"thread {thread_id}")
+            for section, data in prompt_sections(state).items():
+                kind = "scenes" if section == "current_scene" else section
+                counts = {fmt: estimate_tokens(encode(kind, data, fmt)) for fmt in FORMATS}
+                for fmt, count in counts.items():
+                    totals[fmt] += count
+                print(f"  {section:14} " + "  ".join(f"{fmt}: {count:6d}" for fmt, count in counts.items()))
+    finally:
+        conn.close()
+
+    baseline = totals["json"] or 1
+    print("total          " + "  ".join(f"{fmt}: {count:6d} ({100 * count / baseline:5.1f}%)" for fmt, count in totals.items()))
+
+
+if __name__ == "__main__":
+    main()
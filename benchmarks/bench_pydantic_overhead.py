@@ -0,0 +1,120 @@
+'''
+Micro-benchmark of the per-turn pydantic overhead of the engine.
+
+Times each model construction one character turn goes through, with full validation (before) and
+with the trusted path (after): the memory unit built by character_agent, the CharacterAgentState
+that character_app coerces on input and again for the node, and the scene built by scene_creator
+(amortized over the turns of a scene). Validating a checkpointed scene from its dump is printed
+for reference.
+
+    python -m benchmarks.bench_pydantic_overhead --cast 5 --memory 100 --moments 20
+'''
+import argparse
+import timeit
+from typing import List, Tuple
+
+from agents.character_agent import CharacterAgentState
+from pydantic_bp.core import Character, CharacterMemoryUnit, Moment, Scene
+
+
+def make_scene(cast: int, memory: int, moments: int) -> Tuple[Scene, List[Character]]:
+    '''
+    Scene and its cast, the scene references the characters by id like in the story state.
+    '''
+    names = [f"Character {i}" for i in range(cast)]
+    units = [
+        CharacterMemoryUnit(
+            who_said=names[i % cast],
+            who_listens=[name for name in names if name != names[i % cast]],
+            dialogue="A line of dialogue that is about as long as a typical one. " * 2,
+            action="Looks around the room carefully.",
+        )
+        for i in range(memory)
+    ]
+    characters = [
+        Character(
+            name=name,
+            role="Explorer",
+            longtime_goals=["Find the artifact", "Keep the team alive"],
+            personality=["Curious", "Brave"],
+            strengths=["Agility"],
+            weaknesses=["Impulsiveness"],
+            shortterm_memory=list(units),
+            longterm_memory=["An important fact."] * 10,
+        )
+        for name in names
+    ]
+    scene = Scene(
+        no=1,
+        character_ids=[character.ref for character in characters],
+        description="A long scene",
+        moments=[Moment(no=no, situations=units[:cast]) for no in range(1, moments + 1)],
+    )
+    return scene, characters
+
+
+def hops(scene: Scene, cast: List[Character]) -> dict:
+    '''
+    (validated, trusted) callables for every construction hop of a turn, as the engine does them.
+    '''
+    character = cast[0]
+    listeners = [c.name for c in cast[1:]]
+    dialogue = scene.moments[0].situations[0].dialogue
+    action = scene.moments[0].situations[0].action
+
+    def agent_state():
+        # graph input, then coercion for the node, both with model instances
+        CharacterAgentState(scene=scene, cast=cast, current_character=character)
+        CharacterAgentState(scene=scene, cast=cast, current_character=character, new_memory_unit=None)
+
+    def trusted_agent_state():
+        CharacterAgentState.trusted(scene=scene, cast=cast, current_character=character)
+        CharacterAgentState.trusted(scene=scene, cast=cast, current_character=character, new_memory_unit=None)
+
+    return {
+        "memory unit": (
+            lambda: CharacterMemoryUnit(who_said=character.name, who_listens=list(listeners), dialogue=dialogue, action=action),
+            lambda: CharacterMemoryUnit.trusted(who_said=character.name, who_listens=list(listeners), dialogue=dialogue, action=action),
+        ),
+        "agent state": (agent_state, trusted_agent_state),
+        "scene": (
+            lambda: Scene(no=scene.no, description=scene.description, character_ids=list(scene.character_ids), moments=[]),
+            lambda: Scene.trusted(no=scene.no, description=scene.description, character_ids=list(scene.character_ids), moments=[]),
+        ),
+    }
+
+
+def per_call_us(fn, number: int) -> float:
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cast", type=int, default=5)
+    parser.add_argument("--memory", type=int, default=100, help="Shortterm memory units per character.")
+    parser.add_argument("--moments", type=int, default=20)
+    parser.add_argument("--number", type=int, default=5000)
+    args = parser.parse_args()
+
+    scene, cast = make_scene(args.cast, args.memory, args.moments)
+    # scene_creator runs once per scene, spread it over the turns of that scene
+    weights = {"memory unit": 1, "agent state": 1, "scene": 1 / (args.cast * args.moments)}
+
+    print(f"cast: {args.cast}, shortterm memory: {args.memory}, moments: {args.moments}")
+    before = after = 0.0
+    for name, (validated, trusted) in hops(scene, cast).items():
+        validated_us = per_call_us(validated, args.number)
+        trusted_us = per_call_us(trusted, args.number)
+        before += validated_us * weights[name]
+        after += trusted_us * weights[name]
+        print(f"{name:12} validated: {validated_us:8.2f} us   trusted: {trusted_us:8.2f} us")
+
+    print(f"{'per turn':12} before:    {before:8.2f} us   after:   {after:8.2f} us")
+
+    data = scene.model_dump()
+    revalidate_us = per_call_us(lambda: Scene(**data), max(1, args.number // 100))
+    print(f"validating the scene from a dump (reference):   {revalidate_us:8.2f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+'''
+Load test of the story front-ends with simulated concurrent users, behind the fake LLM backend.
+
+Every user loops over a weighted mix of actions until the duration is over: generate a new story,
+resume its last story, or browse (list jobs / open a stored story). Reports throughput, p50/p95/p99
+latency and error rate per action as JSON, stamped with the git commit so runs can be compared.
+
+Targets:
+    gradio     app.py over HTTP with gradio_client, one client session per user. --launch starts
+               `LLM_MODE=fake python app.py` in a scratch directory, otherwise --url must be running
+               with LLM_MODE=fake.
+    streamlit  interface.py sessions run headless in-process with streamlit.testing (AppTest),
+               in a scratch directory, the same script runs a browser session would.
+    jobs       The job service app.py runs on, in-process without a UI, as the baseline.
+
+    python -m benchmarks.load_test --target gradio --launch --users 20 --duration 60 --out load_gradio.json
+    python -m benchmarks.load_test --target jobs --users 50 --mix generate=1,resume=1,browse=4
+    python -m benchmarks.load_test --compare load_before.json load_after.json
+'''
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROMPT = "In a distant future, humanity has colonized Mars. A group of explorers searches for ancient Martian artifacts."
+ACTIONS = ("generate", "resume", "browse")
+
+# Fake backend for every target, short stories with a small per call latency like a fast model
+FAKE_ENV = {"LLM_MODE": "fake", "FAKE_LLM_TURNS": "2", "FAKE_LLM_LATENCY": "0.05"}
+
+
+class ActionFailed(RuntimeError):
+    pass
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    # Nearest rank
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, List[str]] = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def timed(self, action: str, fn: Callable):
+        start = time.perf_counter()
+        try:
+            result = fn()
+        except Exception as error:
+            with self._lock:
+                self.errors[action].append(f"{type(error).__name__}: {error}"[:200])
+            return None
+        with self._lock:
+            self.latencies[action].append(time.perf_counter() - start)
+        return result
+
+    def report(self, wall_time: float) -> Dict[str, dict]:
+        actions = {}
+        for action in sorted(set(self.latencies) | set(self.errors)):
+            latencies = self.latencies[action]
+            errors = self.errors[action]
+            total = len(latencies) + len(errors)
+            actions[action] = {
+                "requests": total,
+                "errors": len(errors),
+                "error_rate": round(len(errors) / total, 4) if total else 0.0,
+                "throughput_per_s": round(len(latencies) / wall_time, 3),
+                "p50_s": _round(percentile(latencies, 50)),
+                "p95_s": _round(percentile(latencies, 95)),
+                "p99_s": _round(percentile(latencies, 99)),
+                "max_s": _round(max(latencies) if latencies else None),
+                "sample_errors": sorted(set(errors))[:5],
+            }
+        return actions
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return None if value is None else round(value, 4)
+
+
+# ---- Targets, one session object per simulated user ----
+
+class GradioSession:
+    def __init__(self, url: str):
+        from gradio_client import Client
+
+        self.client = Client(url, verbose=False)
+        self.thread_id = None
+
+    def _check(self, markdown: str) -> str:
+        status = re.search(r"\*\*Status:\*\* (\w+)", markdown or "")
+        if status is None or status.group(1) != "done":
+            raise ActionFailed((markdown or "empty response")[:200])
+        return markdown
+
+    def generate(self):
+        # The handler streams the job status, predict returns once the story is finished
+        _, markdown = self.client.predict(PROMPT, api_name="/generate_new_story")
+        self._check(markdown)
+        self.thread_id = re.search(r"\*\*Story\*\* `([^`]+)`", markdown).group(1)
+
+    def resume(self):
+        _, markdown = self.client.predict(self.thread_id, api_name="/resume_story")
+        self._check(markdown)
+
+    def browse(self):
+        self.client.predict(api_name="/list_user_jobs")
+
+
+class StreamlitSession:
+    def __init__(self, script: str, timeout: float, index: int):
+        from streamlit.testing.v1 import AppTest
+
+        self.app = AppTest.from_file(script, default_timeout=timeout)
+        self.app.run()
+        self._raise_errors()
+        self.index = index
+        self.stories = 0
+        self.thread_id = None
+
+    def _raise_errors(self):
+        if self.app.exception:
+            raise ActionFailed(str(self.app.exception[0].message)[:200])
+        if self.app.error:
+            raise ActionFailed(str(self.app.error[0].value)[:200])
+        for markdown in self.app.markdown:
+            if "error-box" in markdown.value:
+                raise ActionFailed(re.sub(r"<[^>]+>", "", markdown.value)[:200])
+
+    def _click(self, label: str):
+        button = next((button for button in self.app.button if button.label == label), None)
+        if button is None:
+            raise ActionFailed(f"No {label} button")
+        button.click().run()
+        self._raise_errors()
+
+    def _select_story(self):
+        select = next((select for select in self.app.selectbox if select.label == "select_story:"), None)
+        if select is None or self.thread_id not in select.options:
+            # The archive lists the most recent stories of all users
+            raise ActionFailed(f"Story {self.thread_id} not in the archive")
+        select.select(self.thread_id).run()
+
+    def generate(self):
+        # Without a custom thread_id every session would write to the THREAD_ID story
+        self.stories += 1
+        thread_id = f"load_{self.index}_{self.stories}_{uuid.uuid4().hex[:6]}"
+        next(box for box in self.app.checkbox if box.label == "custom_thread_id").check().run()
+        next(text for text in self.app.text_input if text.label == "thread_id:").input(thread_id).run()
+        self._click(">>> EXECUTE_GENERATION")
+        self.thread_id = thread_id
+
+    def resume(self):
+        self._select_story()
+        self._click(">>> RESUME_STORY")
+
+    def browse(self):
+        self._select_story()
+        self._click(">>> LOAD_STORY")
+
+
+class JobsSession:
+    _service = None
+    _service_lock = threading.Lock()
+
+    def __init__(self, user_id: str):
+        with JobsSession._service_lock:
+            if JobsSession._service is None:
+                from utils.jobs import JobService
+
+                JobsSession._service = JobService().start()
+        self.service = JobsSession._service
+        self.user_id = user_id
+        self.thread_id = None
+
+    def _follow(self, job: dict):
+        for job in self.service.watch(job["job_id"], interval=0.05):
+            pass
+        if job["status"] != "done":
+            raise ActionFailed(f"Job {job['job_id']} {job['status']}: {job['error']}")
+
+    def generate(self):
+        job = self.service.submit(self.user_id, input_text=PROMPT)
+        self.thread_id = job["thread_id"]
+        self._follow(job)
+
+    def resume(self):
+        self._follow(self.service.submit(self.user_id, thread_id=self.thread_id))
+
+    def browse(self):
+        self.service.list_jobs(self.user_id)
+        story = self.service.saver.open_story(self.thread_id)
+        story.header
+        story.page(0)
+
+
+# ---- Runner ----
+
+def run_user(index: int, make_session: Callable, mix: Dict[str, float], deadline: float, think: float,
+             recorder: Recorder, seed: int):
+    rng = random.Random(seed + index)
+    session = recorder.timed("connect", make_session)
+    if session is None:
+        return
+    actions = list(mix)
+    weights = [mix[action] for action in actions]
+    while time.monotonic() < deadline:
+        action = rng.choices(actions, weights)[0]
+        if action != "generate" and session.thread_id is None:
+            # Resuming and browsing need a story of this user
+            action = "generate"
+        recorder.timed(action, getattr(session, action))
+        time.sleep(rng.uniform(0, think))
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def scratch_dir():
+    '''
+    Runs the target in a temporary directory, so its checkpoint and job databases are throwaway.
+    '''
+    previous = os.getcwd()
+    path = tempfile.mkdtemp(prefix="story_load_")
+    os.chdir(path)
+    try:
+        yield path
+    finally:
+        os.chdir(previous)
+        shutil.rmtree(path, ignore_errors=True)
+
+
+@contextmanager
+def launched_gradio(workdir: str, timeout: float = 120):
+    port = _free_port()
+    # app.py binds to 7861, the port is swapped in so a running instance is not in the way
+    launcher = (
+        "import runpy, gradio as gr; launch = gr.Blocks.launch;"
+        f"gr.Blocks.launch = lambda self, *a, **k: launch(self, *a, **{{**k, 'server_port': {port}}});"
+        f"runpy.run_path({os.path.join(REPO_ROOT, 'app.py')!r}, run_name='__main__')"
+    )
+    env = {**os.environ, **FAKE_ENV, "PYTHONPATH": REPO_ROOT}
+    process = subprocess.Popen([sys.executable, "-c", launcher], cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    url = f"http://127.0.0.1:{port}/"
+    try:
+        start = time.monotonic()
+        while True:
+            if process.poll() is not None:
+                raise RuntimeError(f"app.py exited:\n{process.stderr.read().decode()[-2000:]}")
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() - start > timeout:
+                    raise RuntimeError(f"app.py did not listen on port {port} within {timeout}s")
+                time.sleep(0.5)
+        yield url
+    finally:
+        process.terminate()
+        process.wait(10)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> dict:
+    mix = {}
+    for part in args.mix.split(","):
+        action, weight = part.split("=")
+        if action not in ACTIONS:
+            raise SystemExit(f"Unknown action {action}, expected one of {ACTIONS}")
+        mix[action] = float(weight)
+
+    recorder = Recorder()
+    with scratch_dir() as workdir:
+        if args.target == "gradio":
+            if args.launch:
+                server = launched_gradio(workdir)
+            else:
+                server = contextmanager(lambda: iter([args.url]))()
+        else:
+            # In-process targets pick the fake backend when utils.model is first imported
+            os.environ.update(FAKE_ENV)
+            sys.path.insert(0, REPO_ROOT)
+            server = contextmanager(lambda: iter([None]))()
+
+        with server as url:
+            factories = {
+                "gradio": lambda index: (lambda: GradioSession(url)),
+                "streamlit": lambda index: (lambda: StreamlitSession(os.path.join(REPO_ROOT, "interface.py"), args.timeout, index)),
+                "jobs": lambda index: (lambda: JobsSession(f"load-user-{index}")),
+            }
+            start = time.monotonic()
+            deadline = start + args.duration
+            users = []
+            for index in range(args.users):
+                user = threading.Thread(target=run_user, args=(index, factories[args.target](index), mix, deadline,
+                                                               args.think, recorder, args.seed), daemon=True)
+                user.start()
+                users.append(user)
+                time.sleep(args.ramp_up / max(args.users, 1))
+            for user in users:
+                # Actions started before the deadline are let finish
+                user.join(args.duration + args.timeout)
+            wall_time = time.monotonic() - start
+            if JobsSession._service is not None:
+                JobsSession._service.stop(timeout=10)
+
+    return {
+        "commit": git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "target": args.target,
+        "config": {"users": args.users, "duration_s": args.duration, "ramp_up_s": args.ramp_up, "think_s": args.think,
+                   "mix": mix, "seed": args.seed, "fake_llm": FAKE_ENV},
+        "wall_time_s": round(wall_time, 3),
+        "actions": recorder.report(wall_time),
+    }
+
+
+def compare(before: dict, after: dict):
+    print(f"{before.get('commit')} -> {after.get('commit')} ({after['target']}, {after['config']['users']} users)")
+    for action in sorted(set(before["actions"]) | set(after["actions"])):
+        old = before["actions"].get(action, {})
+        new = after["actions"].get(action, {})
+        cells = []
+        for key in ("throughput_per_s", "p50_s", "p95_s", "p99_s", "error_rate"):
+            a, b = old.get(key), new.get(key)
+            change = f" ({(b - a) / a * 100:+.0f}%)" if a and b is not None else ""
+            cells.append(f"{key} {a} -> {b}{change}")
+        print(f"  {action:9} " + "  ".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=("gradio", "streamlit", "jobs"), default="gradio")
+    parser.add_argument("--url", default="http://127.0.0.1:7861/", help="Running Gradio app (with LLM_MODE=fake)")
+    parser.add_argument("--launch", action="store_true", help="Start app.py with the fake backend in a scratch directory")
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=60, help="Seconds new actions are started for")
+    parser.add_argument("--ramp-up", type=float, default=5, help="Seconds over which the users are started")
+    parser.add_argument("--think", type=float, default=1.0, help="Max random pause between the actions of a user")
+    parser.add_argument("--mix", default="generate=1,resume=1,browse=3", help="Action weights")
+    parser.add_argument("--timeout", type=float, default=300, help="Max seconds a single action may take")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="Write the JSON report here")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare two reports and exit")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            compare(json.load(before), json.load(after))
+        return
+
+    report = run(args)
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.out:
+        with open(args.out, "w") as file:
+            file.write(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
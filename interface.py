@@ -2,10 +2,12 @@ import streamlit as st
 import sqlite3
 import json
 from datetime import datetime
-from langgraph.checkpoint.sqlite import SqliteSaver
-from agents.start_agent import start_agent_app
-from agents.env_agent import env_agent_workflow
+from utils.cancellation import STORY_TIMEOUT, StoryCancelled, cancel_story, running_stories, story_run
+from utils.checkpointer import StorySaver
+from agents.start_agent import get_start_agent_app
+from agents.env_agent import env_agent_workflow, initial_state
 from utils.get_env import get_env_variable
+from utils.export import export_stories
 from pydantic_bp.core import Character, Entity, Scene, Moment
 import pandas as pd
 import time
@@ -185,11 +187,13 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+ARCHIVE_PAGE_SIZE = 20
+
 # Initialize session state
 @st.cache_resource
 def get_compiled_app():
     """Compile the workflow with checkpointer"""
-    memory_ctx = SqliteSaver.from_conn_string("env_agent_checkpoint.db")
+    memory_ctx = StorySaver.from_conn_string("env_agent_checkpoint.db")
     memory = memory_ctx.__enter__()
     app = env_agent_workflow.compile(checkpointer=memory)
     return app, memory, memory_ctx
@@ -198,6 +202,8 @@ app, memory, memory_ctx = get_compiled_app()
 
 if 'current_story_state' not in st.session_state:
     st.session_state.current_story_state = None
+if 'current_story' not in st.session_state:
+    st.session_state.current_story = None
 if 'generated_output' not in st.session_state:
     st.session_state.generated_output = None
 if 'thread_id' not in st.session_state:
@@ -223,13 +229,7 @@ def log_system(message: str, level: str = "INFO"):
 def get_thread_ids_from_db():
     """Get all thread IDs from database"""
     try:
-        conn = sqlite3.connect("env_agent_checkpoint.db", check_same_thread=False)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT DISTINCT thread_id FROM checkpoints ORDER BY thread_id DESC")
-        threads = cursor.fetchall()
-        conn.close()
-        return [dict(t)['thread_id'] for t in threads] if threads else []
+        return memory.thread_ids()
     except Exception as e:
         log_system(f"ERROR: {str(e)}", "ERROR")
         return []
@@ -238,18 +238,7 @@ def get_thread_ids_from_db():
 def get_checkpoint_details(thread_id):
     """Get checkpoint details"""
     try:
-        conn = sqlite3.connect("env_agent_checkpoint.db", check_same_thread=False)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT id, ts_created FROM checkpoints 
-            WHERE thread_id = ? 
-            ORDER BY ts_created DESC
-        """, (thread_id,))
-        checkpoints = cursor.fetchall()
-        result = [{"id": cp[0], "ts_created": cp[1]} for cp in checkpoints]
-        conn.close()
-        return result
+        return memory.checkpoint_history(thread_id)
     except Exception as e:
         log_system(f"ERROR: {str(e)}", "ERROR")
         return []
@@ -257,43 +246,39 @@ def get_checkpoint_details(thread_id):
 
 def check_story_exists(thread_id) -> bool:
     """Check if story exists"""
-    config = {"configurable": {"thread_id": thread_id}}
-    try:
-        app.get_state(config)
-        return True
-    except Exception:
-        return False
+    return memory.story_exists(thread_id)
 
 
 def run_start_agent(input_text: str):
-    initial_state = {
+    state = {
         "input_text": input_text,
         "characters": [],
         "entities": [],
         "start_scene_description": "",
         "main_goal": ""
     }
-    output_state = start_agent_app.invoke(initial_state)
-    initial_state["characters"] = output_state["characters"]
-    initial_state["entities"] = output_state["entities"]
-    initial_state["start_scene_description"] = output_state["start_scene_description"]
-    initial_state["main_goal"] = output_state["main_goal"]
-    return initial_state
+    output_state = get_start_agent_app().invoke(state)
+    state["characters"] = output_state["characters"]
+    state["entities"] = output_state["entities"]
+    state["start_scene_description"] = output_state["start_scene_description"]
+    state["main_goal"] = output_state["main_goal"]
+    return state
 
 
-def run_env_agent(state, thread_id, resume: bool):
+def run_env_agent(state, thread_id, resume: bool, timeout=STORY_TIMEOUT):
     config = {
         "recursion_limit": 50,
         "configurable": {"thread_id": thread_id}
     }
     if resume and check_story_exists(thread_id):
-        output_state = app.invoke(None, config=config)
-        return output_state
-    output_state = app.invoke(state, config=config)
+        state = None
+    # Registered by thread_id, CANCEL_STORY in the archive can stop it from any session
+    with story_run(thread_id, timeout=timeout):
+        output_state = app.invoke(state, config=config, durability="sync")
     return output_state
 
 
-def format_story_detailed(state):
+def format_story_detailed(state, scenes_total=None):
     """Format story output"""
     md = ""
     
@@ -318,7 +303,7 @@ def format_story_detailed(state):
         md += "\n"
     
     if "scenes" in state and state["scenes"]:
-        md += f"```\n[STORY_SCENES] Total: {len(state['scenes'])}\n```\n"
+        md += f"```\n[STORY_SCENES] Total: {len(state['scenes']) if scenes_total is None else scenes_total}\n```\n"
         for scene in state["scenes"]:
             md += f"**SCENE_{scene.no}** | `{scene.description}`\n"
             
@@ -353,9 +338,8 @@ conn = sqlite3.connect("env_agent_checkpoint.db", check_same_thread=False)
 cursor = conn.cursor()
 cursor.execute("SELECT COUNT(*) FROM checkpoints")
 checkpoint_count = cursor.fetchone()[0]
-cursor.execute("SELECT COUNT(DISTINCT thread_id) FROM checkpoints")
-distinct_threads = cursor.fetchone()[0]
 conn.close()
+distinct_threads = memory.story_count()
 
 with col1:
     st.markdown("""
@@ -432,6 +416,7 @@ with tab1:
             thread_id = st.text_input("thread_id:", value="story_" + datetime.now().strftime("%Y%m%d_%H%M%S"))
         else:
             thread_id = get_env_variable("THREAD_ID")
+        deadline_minutes = st.number_input("deadline_minutes (0 = none):", min_value=0, value=int((STORY_TIMEOUT or 0) // 60))
         
         st.markdown(f"""
         ```
@@ -457,29 +442,17 @@ with tab1:
                 st.markdown('<div class="log-entry"><span class="log-time">[01:15]</span> Characters & entities initialized</div>', unsafe_allow_html=True)
             
             log_system("PHASE_2: ENV_AGENT_SETUP", "INFO")
-            story_state = {
-                "main_goal": output["main_goal"],
-                "is_main_goal_achieved": False,
-                "characters": output["characters"],
-                "entities": output["entities"],
-                "scenes": [],
-                "next_character_index": 0,
-                "next_scene_no": 1,
-                "next_scene": output["start_scene_description"],
-                "is_scene_complete": False,
-                "current_scene": None,
-                "next_moment_no": 1,
-                "current_moment": None
-            }
+            story_state = initial_state(output)
             
             with progress_container:
                 st.markdown('<div class="log-entry"><span class="log-time">[01:45]</span> Generating narrative sequences...</div>', unsafe_allow_html=True)
             
             log_system("PHASE_3: STORY_GENERATION", "INFO")
-            result = run_env_agent(story_state, thread_id, resume=False)
+            result = run_env_agent(story_state, thread_id, resume=False, timeout=deadline_minutes * 60 or None)
             
             st.session_state.generated_output = result
             st.session_state.current_story_state = result
+            st.session_state.current_story = None
             st.session_state.active_thread = thread_id
             
             log_system("GENERATION_COMPLETE", "SUCCESS")
@@ -487,6 +460,9 @@ with tab1:
             with progress_container:
                 st.markdown('<div class="success-box">>>> GENERATION_SUCCESS | Story stored in checkpoint</div>', unsafe_allow_html=True)
             
+        except StoryCancelled as e:
+            log_system(f"GENERATION_STOPPED: {str(e)}", "WARNING")
+            st.markdown(f'<div class="warning-box">>>> STOPPED: {str(e)} | Resumable from its last checkpoint</div>', unsafe_allow_html=True)
         except Exception as e:
             log_system(f"GENERATION_FAILED: {str(e)}", "ERROR")
             st.markdown(f'<div class="error-box">>>> ERROR: {str(e)}</div>', unsafe_allow_html=True)
@@ -504,7 +480,19 @@ with tab2:
     if not thread_ids:
         st.markdown('<div class="warning-box">>>> NO_STORIES_FOUND | Create one using GENERATOR</div>', unsafe_allow_html=True)
     else:
-        selected_thread = st.selectbox("select_story:", thread_ids, label_visibility="collapsed")
+        # Listing comes from the story index, no story is loaded
+        archive_pages = max(1, -(-memory.story_count() // ARCHIVE_PAGE_SIZE))
+        archive_page = st.number_input("archive_page:", min_value=1, max_value=archive_pages, value=1)
+        stories = memory.list_stories(limit=ARCHIVE_PAGE_SIZE, offset=(archive_page - 1) * ARCHIVE_PAGE_SIZE)
+        st.dataframe(pd.DataFrame([{
+            "Thread_ID": story["thread_id"],
+            "Scenes": story["scene_count"],
+            "Goal": "ACHIEVED ✓" if story["is_main_goal_achieved"] else "IN_PROGRESS →",
+            "Updated": story["updated_at"][:19],
+            "Forked_From": story["forked_from"] or ""
+        } for story in stories]), use_container_width=True, hide_index=True)
+
+        selected_thread = st.selectbox("select_story:", [story["thread_id"] for story in stories], label_visibility="collapsed")
         
         col_actions, col_info = st.columns([1, 1])
         
@@ -513,13 +501,9 @@ with tab2:
             if st.button(">>> LOAD_STORY", use_container_width=True):
                 try:
                     log_system(f"LOADING: {selected_thread}", "INFO")
-                    config = {"configurable": {"thread_id": selected_thread}}
-                    state_obj = app.get_state(config)
-                    
-                    if hasattr(state_obj, 'values'):
-                        st.session_state.current_story_state = state_obj.values
-                    else:
-                        st.session_state.current_story_state = state_obj
+                    # Lazy view, scenes are loaded page by page when displayed
+                    st.session_state.current_story = memory.open_story(selected_thread)
+                    st.session_state.current_story_state = None
                     
                     st.session_state.active_thread = selected_thread
                     log_system(f"LOADED: {selected_thread}", "SUCCESS")
@@ -528,15 +512,24 @@ with tab2:
                     log_system(f"LOAD_FAILED: {str(e)}", "ERROR")
                     st.error(f"Error: {str(e)}")
             
+            if selected_thread in running_stories() and st.button(">>> CANCEL_STORY", use_container_width=True):
+                cancel_story(selected_thread)
+                log_system(f"CANCEL_REQUESTED: {selected_thread}", "WARNING")
+                st.warning("Stopping after the current step")
+            
             if st.button(">>> RESUME_STORY", use_container_width=True):
                 try:
                     log_system(f"RESUMING: {selected_thread}", "INFO")
                     result = run_env_agent(None, selected_thread, resume=True)
                     st.session_state.current_story_state = result
+                    st.session_state.current_story = None
                     st.session_state.generated_output = result
                     st.session_state.active_thread = selected_thread
                     log_system(f"RESUMED: {selected_thread}", "SUCCESS")
                     st.success("✓ Story resumed")
+                except StoryCancelled as e:
+                    log_system(f"RESUME_STOPPED: {str(e)}", "WARNING")
+                    st.warning(f"Stopped: {str(e)}")
                 except Exception as e:
                     log_system(f"RESUME_FAILED: {str(e)}", "ERROR")
                     st.error(f"Error: {str(e)}")
@@ -557,14 +550,41 @@ with tab2:
                 cp_data = []
                 for cp in checkpoints:
                     cp_data.append({
-                        "ID": cp['id'][:12] + "...",
-                        "Timestamp": cp['ts_created']
+                        "ID": cp['checkpoint_id'][:12] + "...",
+                        "Step": cp['step'],
+                        "Source": cp['source'],
+                        "Thread": cp['thread_id']
                     })
                 st.dataframe(pd.DataFrame(cp_data), use_container_width=True, hide_index=True)
+
+        with st.expander("🌿 Fork_Story"):
+            st.markdown("Branch a new story from any checkpoint. The common history is shared, not copied.")
+            if checkpoints:
+                fork_checkpoint = st.selectbox(
+                    "fork_from_checkpoint:",
+                    checkpoints,
+                    format_func=lambda cp: f"step {cp['step']} | {cp['checkpoint_id'][:12]}... | {cp['thread_id']}"
+                )
+                fork_thread = st.text_input("new_thread_id:", value=f"{selected_thread}_fork_" + datetime.now().strftime("%H%M%S"))
+                if st.button(">>> FORK_STORY", use_container_width=True):
+                    try:
+                        new_thread = memory.fork(selected_thread, fork_checkpoint['checkpoint_id'], thread_id=fork_thread)
+                        log_system(f"FORKED: {selected_thread} -> {new_thread}", "SUCCESS")
+                        st.success(f"✓ Story forked to {new_thread}, resume it from the archive")
+                    except Exception as e:
+                        log_system(f"FORK_FAILED: {str(e)}", "ERROR")
+                        st.error(f"Error: {str(e)}")
+            else:
+                st.info("No checkpoints available")
         
         st.markdown('<div class="section-divider"></div>', unsafe_allow_html=True)
         
-        if st.session_state.current_story_state:
+        if st.session_state.current_story:
+            story = st.session_state.current_story
+            st.markdown("### > STORY_CONTENT")
+            story_page = st.number_input("scene_page:", min_value=1, max_value=story.page_count(), value=1)
+            st.markdown(format_story_detailed({**story.header, "scenes": story.page(story_page - 1)}, scenes_total=len(story)))
+        elif st.session_state.current_story_state:
             st.markdown("### > STORY_CONTENT")
             st.markdown(format_story_detailed(st.session_state.current_story_state))
 
@@ -668,6 +688,42 @@ with tab4:
     else:
         st.info("No analytics data available")
 
+    st.markdown('<div class="section-divider"></div>', unsafe_allow_html=True)
+    st.markdown("**[EXPORT_STORIES]**")
+
+    col_export_cfg, col_export_run = st.columns([2, 1])
+
+    with col_export_cfg:
+        export_formats = st.multiselect("formats:", ["jsonl", "parquet"], default=["jsonl"])
+        export_dir = st.text_input("output_dir:", value="exports")
+        export_incremental = st.checkbox("incremental (only changed threads)", value=True)
+        export_all = st.checkbox("include stories in progress")
+
+    with col_export_run:
+        if st.button(">>> EXPORT_STORIES", use_container_width=True):
+            try:
+                log_system("EXPORT_START", "INFO")
+                summary = export_stories(
+                    db_path="env_agent_checkpoint.db",
+                    out_dir=export_dir,
+                    formats=export_formats,
+                    incremental=export_incremental,
+                    include_incomplete=export_all,
+                )
+                log_system(f"EXPORT_COMPLETE: {summary['exported']} stories", "SUCCESS")
+                st.markdown(f"""
+                ```
+                run_id: {summary['run_id']}
+                exported: {summary['exported']}
+                skipped_unchanged: {summary['skipped_unchanged']}
+                skipped_incomplete: {summary['skipped_incomplete']}
+                rows: {json.dumps(summary['rows'])}
+                ```
+                """)
+            except Exception as e:
+                log_system(f"EXPORT_FAILED: {str(e)}", "ERROR")
+                st.markdown(f'<div class="error-box">>>> ERROR: {str(e)}</div>', unsafe_allow_html=True)
+
 
 # ==================== TAB 5: SYSTEM LOGS ====================
 with tab5:
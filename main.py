@@ -1,57 +1,63 @@
-from langgraph.checkpoint.sqlite import SqliteSaver
+from utils.cancellation import STORY_TIMEOUT, StoryCancelled, cancel_on_sigint, story_run
+from utils.checkpointer import StorySaver
+from utils.state_profiler import STATE_PROFILE, profile_story, save_report
 
-from agents.start_agent import start_agent_app
-from agents.env_agent import env_agent_workflow
+from agents.start_agent import get_start_agent_app
+from agents.env_agent import env_agent_workflow, initial_state
 from utils.get_env import get_env_variable
 
 
 def run_start_agent(input_text: str):
-    initial_state = {
+    state = {
         "input_text": input_text,
         "characters": [],
         "entities": [],
         "start_scene_description": "",
         "main_goal": ""
     }
-    output_state = start_agent_app.invoke(initial_state)
+    output_state = get_start_agent_app().invoke(state)
 
-    initial_state["characters"] = output_state["characters"]
-    initial_state["entities"] = output_state["entities"]
-    initial_state["start_scene_description"] = output_state["start_scene_description"]
-    initial_state["main_goal"] = output_state["main_goal"]
+    state["characters"] = output_state["characters"]
+    state["entities"] = output_state["entities"]
+    state["start_scene_description"] = output_state["start_scene_description"]
+    state["main_goal"] = output_state["main_goal"]
 
-    return initial_state
+    return state
 
 
 def run_env_agent(state, resume: bool):
+    thread_id = get_env_variable("THREAD_ID")
     config = {
             "recursion_limit": 50,
             "configurable": {
-                "thread_id": get_env_variable("THREAD_ID")
+                "thread_id": thread_id
             }
         }
 
     if resume and check_story_exists(env_agent_app):
         print("Env Agent resuming from existing checkpoint...")
-        output_state = env_agent_app.invoke(None, config=config)
-        return output_state
-    
-    print("Env Agent starting fresh execution...")
-    output_state = env_agent_app.invoke(
-        state,
-        config=config
-    )
+        state = None
+    else:
+        print("Env Agent starting fresh execution...")
+
+    # Ctrl-C stops the story at its next safe point, the checkpoint of the last finished step is kept for resuming
+    try:
+        with story_run(thread_id, timeout=STORY_TIMEOUT), cancel_on_sigint(thread_id):
+            # Sync checkpoint writes, the saved state of every finished step is on disk before the next one starts
+            if STATE_PROFILE:
+                save_report(profile_story(env_agent_app, state, config), STATE_PROFILE)
+                output_state = env_agent_app.get_state(config).values
+            else:
+                output_state = env_agent_app.invoke(state, config=config, durability="sync")
+    except StoryCancelled as error:
+        print(f"{error}. Resume the story from its checkpoint to continue.")
+        return env_agent_app.get_state(config).values
     return output_state
 
 def check_story_exists(app) -> bool:
     """Checks if a saved state exists for the given thread_id."""
-    config = {"configurable": {"thread_id": get_env_variable("THREAD_ID")}}
-    try:
-        # get_state() will raise an exception if no state is found
-        app.get_state(config)
-        return True
-    except Exception:
-        return False
+    # Story index lookup, get_state() would load the whole story and never raises for unknown threads
+    return app.checkpointer.story_exists(get_env_variable("THREAD_ID"))
 
 
 
@@ -59,7 +65,7 @@ if __name__ == "__main__":
     input_text = "In a distant future, humanity has colonized Mars. Amidst political turmoil and environmental challenges, a group of explorers embarks on a mission to uncover ancient Martian artifacts that could hold the key to humanity's survival."
 
 
-    with SqliteSaver.from_conn_string("env_agent_checkpoint.db") as memory:
+    with StorySaver.from_conn_string("env_agent_checkpoint.db") as memory:
         env_agent_app = env_agent_workflow.compile(checkpointer=memory)
 
         need_generate_story = input("Do you want to generate story? (y/n): ")
@@ -71,20 +77,7 @@ if __name__ == "__main__":
                 output = run_start_agent(input_text)
                 print(output)
 
-                output = run_env_agent({
-                    "main_goal": output["main_goal"],
-                    "is_main_goal_achieved": False,
-                    "characters": output["characters"],
-                    "entities": output["entities"],
-                    "scenes": [],
-                    "next_character_index": 0,
-                    "next_scene_no": 1,
-                    "next_scene": output["start_scene_description"],
-                    "is_scene_complete": False,
-                    "current_scene": None,
-                    "next_moment_no": 1,
-                    "current_moment": None
-                }, resume=False)
+                output = run_env_agent(initial_state(output), resume=False)
             else:
                 print("Resuming story from checkpoint...")
                 output = run_env_agent(None, resume=True)
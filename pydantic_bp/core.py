@@ -1,18 +1,62 @@
+import sys
+from functools import lru_cache
 from pydantic import BaseModel, Field, model_validator
-from typing import List, Optional
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 
-class CharacterMemoryUnit(BaseModel):
+
+class EngineModel(BaseModel):
+    @classmethod
+    def trusted(cls, **data):
+        '''
+        Builds the model from engine-internal data that is already validated, skipping validation.
+        Keep full validation (the normal constructor) for LLM outputs and user input.
+        '''
+        # Leaner than model_construct, which is slower than validating model instances on pydantic v2
+        fields = cls.__pydantic_fields__
+        fields_set = set(data)
+        if len(data) < len(fields):
+            for name, field in fields.items():
+                if name not in data:
+                    data[name] = field.get_default(call_default_factory=True)
+
+        model = cls.__new__(cls)
+        _set = object.__setattr__
+        _set(model, "__dict__", data)
+        _set(model, "__pydantic_fields_set__", fields_set)
+        _set(model, "__pydantic_extra__", None)
+        _set(model, "__pydantic_private__", None)
+        return model
+
+
+class CharacterMemoryUnit(EngineModel):
     who_said: str
     who_listens: List[str]
     dialogue: str
     action: str
 
-class Moment(BaseModel):
+    @model_validator(mode='after')
+    def intern_names(self):
+        # The same few names repeat in every unit of a story, units restored from a checkpoint share one string per name
+        # Written to the instance dict, assignment through the model would cost more than the interning
+        fields = self.__dict__
+        fields["who_said"] = sys.intern(fields["who_said"])
+        fields["who_listens"] = [sys.intern(name) for name in fields["who_listens"]]
+        return self
+
+    @classmethod
+    def trusted(cls, **data):
+        data["who_said"] = sys.intern(data["who_said"])
+        data["who_listens"] = [sys.intern(name) for name in data["who_listens"]]
+        return super().trusted(**data)
+
+class Moment(EngineModel):
     no: int
     situations: List[CharacterMemoryUnit]
 
-class Character(BaseModel):
+class Character(EngineModel):
+    id: Optional[str] = None
     name: str
+    aliases: List[str] = Field(default_factory=list)
     role: str
     longtime_goals: List[str]
     shorttime_goals: List[str] = Field(default_factory=list)
@@ -32,14 +76,29 @@ class Character(BaseModel):
         
         return self
 
+    @classmethod
+    def trusted(cls, **data):
+        # model_construct skips validators, so apply the post init defaults here
+        return super().trusted(**data).set_post_init()
+
+    @property
+    def ref(self) -> str:
+        # Key of the character in the story character table, what scenes reference
+        return self.id or self.name
+
+    def profile_message(self) -> str:
+        '''
+        Static part of the system message, memoized on the profile fields.
+        '''
+        return _profile_message(self.name, self.role, tuple(self.longtime_goals), self.memory_factor,
+                                tuple(self.personality), tuple(self.strengths), tuple(self.weaknesses))
+
+    def goals_message(self) -> str:
+        return f"Your shorttime goals are: {', '.join(self.shorttime_goals)}."
+
     def system_message(self) -> str:
-        return (f"You are {self.name}, a {self.role} in the story. "
-                f"Your longtime goals are: {', '.join(self.longtime_goals)}. "
-                f"Your shorttime goals are: {', '.join(self.shorttime_goals)}. "
-                f"Your memory factor is: {self.memory_factor}. (Means how well you remember past events, from 0 to 1). "
-                f"your personality traits are: {', '.join(self.personality)}. "
-                f"Your strengths are: {', '.join(self.strengths)}. "
-                f"Your weaknesses are: {', '.join(self.weaknesses)}.")
+        # Shorttime goals change every turn, so they go last
+        return f"{self.profile_message()} {self.goals_message()}"
     
     def update_shortterm_memory(self, event: str):
         if len(self.shortterm_memory) >= self.max_shortterm_memory:
@@ -48,14 +107,52 @@ class Character(BaseModel):
         self.shortterm_memory.append(event)
 
 
-class Scene(BaseModel):
+@lru_cache(maxsize=1024)
+def _profile_message(name: str, role: str, longtime_goals: Tuple[str, ...], memory_factor: float,
+                     personality: Tuple[str, ...], strengths: Tuple[str, ...], weaknesses: Tuple[str, ...]) -> str:
+    return (f"You are {name}, a {role} in the story. "
+            f"Your longtime goals are: {', '.join(longtime_goals)}. "
+            f"Your memory factor is: {memory_factor}. (Means how well you remember past events, from 0 to 1). "
+            f"your personality traits are: {', '.join(personality)}. "
+            f"Your strengths are: {', '.join(strengths)}. "
+            f"Your weaknesses are: {', '.join(weaknesses)}.")
+
+
+class Scene(EngineModel):
     no: int
-    characters: List[Character]
+    # Cast as references (Character.ref) into the story character table, resolved with scene_cast()
+    character_ids: List[str] = Field(default_factory=list)
     description: str
     moments: List[Moment]
 
+    @model_validator(mode='before')
+    @classmethod
+    def normalize_characters(cls, data):
+        # Checkpoints from before the state was normalized embed the whole cast
+        if isinstance(data, dict) and "characters" in data:
+            data = dict(data)
+            characters = data.pop("characters") or []
+            data.setdefault("character_ids", [
+                character.ref if isinstance(character, Character) else (character.get("id") or character["name"])
+                for character in characters
+            ])
+        return data
+
+
+def character_table(characters: Iterable[Character]) -> Dict[str, Character]:
+    return {character.ref: character for character in characters}
+
+
+def scene_cast(scene: Scene, characters: Union[Dict[str, Character], Iterable[Character]]) -> List[Character]:
+    '''
+    Resolves the cast of a scene from the story characters (a list or a character_table), in scene order.
+    '''
+    table = characters if isinstance(characters, dict) else character_table(characters)
+    return [table[ref] for ref in scene.character_ids if ref in table]
+
 
-class Entity(BaseModel):
+class Entity(EngineModel):
+    id: Optional[str] = None
     name: str
     description: str
 
@@ -0,0 +1,170 @@
+import logging
+import re
+from typing import Container, Dict, Iterable, List, Optional
+
+from pydantic_bp.core import Character, Entity
+
+
+# Titles and articles are ignored when matching names
+_IGNORED_WORDS = {
+    "the", "a", "an",
+    "dr", "mr", "mrs", "ms", "miss", "sir", "lady", "lord", "prof", "professor", "captain", "capt", "commander",
+    "detective", "officer", "agent", "general", "colonel", "major", "lieutenant", "sergeant", "inspector",
+}
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_name(name: str) -> str:
+    '''
+    Lowercase name without punctuation, titles and articles, "Dr. Aris Thorne" -> "aris thorne".
+    '''
+    tokens = re.findall(r"\w+", name.lower())
+    return " ".join(token for token in tokens if token not in _IGNORED_WORDS) or " ".join(tokens)
+
+
+def make_id(name: str, taken: Container[str]) -> str:
+    '''
+    Stable, readable id from a name, "Dr. Aris Thorne" -> "aris-thorne" (suffixed when taken).
+    taken is a set, or a dict keyed by id, of the ids in use.
+    '''
+    base = normalize_name(name).replace(" ", "-") or "unnamed"
+    candidate = base
+    suffix = 2
+    while candidate in taken:
+        candidate = f"{base}-{suffix}"
+        suffix += 1
+    return candidate
+
+
+def repair_indexes(indexes: Iterable[int], size: int, what: str = "index") -> List[int]:
+    '''
+    Validates 0 based indexes returned by the LLM against a list of the given size.
+    Out of range and duplicate indexes are dropped, order is kept.
+    '''
+    repaired = []
+    seen = set()
+    invalid = []
+    for index in indexes:
+        if not isinstance(index, int) or not 0 <= index < size:
+            invalid.append(index)
+            continue
+        if index in seen:
+            continue
+        seen.add(index)
+        repaired.append(index)
+    if invalid:
+        logger.warning("Dropping invalid %s %s (expected 0..%d).", what, ", ".join(map(str, invalid)), size - 1)
+    return repaired
+
+
+class WorldRegistry:
+    '''
+    Characters and entities of a story with stable ids and a name/alias lookup index.
+
+    Registering assigns an id to models that have none and deduplicates: a character whose name or
+    alias resolves to an already registered one is merged into it. All lookups are dict lookups.
+    '''
+
+    def __init__(self, characters: Iterable[Character] = (), entities: Iterable[Entity] = ()):
+        self.characters: Dict[str, Character] = {}
+        self.entities: Dict[str, Entity] = {}
+        self._character_names: Dict[str, str] = {}
+        self._entity_names: Dict[str, str] = {}
+
+        for character in characters:
+            self.add_character(character)
+        for entity in entities:
+            self.add_entity(entity)
+
+    @classmethod
+    def lookup(cls, characters: Iterable[Character] = (), entities: Iterable[Entity] = ()) -> "WorldRegistry":
+        '''
+        Read-only name index over characters and entities that are already registered, like the ones
+        of the story state. Ids are not assigned and duplicates are not merged, the models are left as they are.
+        '''
+        world = cls()
+        for character in characters:
+            world.characters.setdefault(character.ref, character)
+            for name in [character.name] + character.aliases:
+                world._character_names.setdefault(normalize_name(name), character.ref)
+        for entity in entities:
+            entity_id = entity.id or entity.name
+            world.entities.setdefault(entity_id, entity)
+            world._entity_names.setdefault(normalize_name(entity.name), entity_id)
+        return world
+
+    def add_character(self, character: Character) -> Character:
+        existing = self.find_character(character.name)
+        if existing is None:
+            for alias in character.aliases:
+                existing = self.find_character(alias)
+                if existing is not None:
+                    break
+
+        if existing is character:
+            return character
+        if existing is not None:
+            self._merge_character(existing, character)
+            character = existing
+        else:
+            if not character.id or character.id in self.characters:
+                character.id = make_id(character.name, self.characters)
+            self.characters[character.id] = character
+
+        for name in [character.name] + character.aliases:
+            self._character_names.setdefault(normalize_name(name), character.id)
+        return character
+
+    def _merge_character(self, existing: Character, duplicate: Character):
+        for field in ("longtime_goals", "personality", "strengths", "weaknesses", "aliases"):
+            values = getattr(existing, field)
+            for value in getattr(duplicate, field):
+                if value not in values:
+                    values.append(value)
+        if duplicate.name != existing.name and duplicate.name not in existing.aliases:
+            existing.aliases.append(duplicate.name)
+
+    def add_entity(self, entity: Entity) -> Entity:
+        existing = self.find_entity(entity.name)
+        if existing is entity:
+            return entity
+        if existing is not None:
+            if entity.description and entity.description not in existing.description:
+                existing.description = f"{existing.description} {entity.description}".strip()
+            return existing
+
+        if not entity.id or entity.id in self.entities:
+            entity.id = make_id(entity.name, self.entities)
+        self.entities[entity.id] = entity
+        self._entity_names.setdefault(normalize_name(entity.name), entity.id)
+        return entity
+
+    def find_character(self, ref: str) -> Optional[Character]:
+        '''
+        Resolves an id, name or alias to a character.
+        '''
+        if ref in self.characters:
+            return self.characters[ref]
+        character_id = self._character_names.get(normalize_name(ref))
+        return self.characters.get(character_id) if character_id else None
+
+    def find_entity(self, ref: str) -> Optional[Entity]:
+        if ref in self.entities:
+            return self.entities[ref]
+        entity_id = self._entity_names.get(normalize_name(ref))
+        return self.entities.get(entity_id) if entity_id else None
+
+    def mentioned_characters(self, text: str) -> List[Character]:
+        '''
+        Characters whose name or alias appears in the text, in roster order.
+        '''
+        normalized = f" {normalize_name(text)} "
+        mentioned = {character_id for name, character_id in self._character_names.items() if f" {name} " in normalized}
+        return [character for character_id, character in self.characters.items() if character_id in mentioned]
+
+    def character_list(self) -> List[Character]:
+        return list(self.characters.values())
+
+    def entity_list(self) -> List[Entity]:
+        return list(self.entities.values())
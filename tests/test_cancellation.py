@@ -0,0 +1,43 @@
+import time
+
+import pytest
+
+from utils.cancellation import (
+    DeadlineExceeded, StoryCancelled, bind_token, call_with_deadline, cancel_story, check_cancelled, running_stories, story_run,
+)
+
+
+def test_cancelled_story_stops_at_its_next_safe_point():
+    with story_run("story") as token, bind_token(token):
+        check_cancelled()
+        assert cancel_story("story")
+        with pytest.raises(StoryCancelled):
+            check_cancelled()
+    assert "story" not in running_stories()
+    assert not cancel_story("story")
+
+
+def test_story_deadline_is_checked():
+    with story_run("story", timeout=0.01) as token, bind_token(token):
+        time.sleep(0.02)
+        with pytest.raises(DeadlineExceeded):
+            check_cancelled()
+
+
+def test_hung_call_is_abandoned_at_its_deadline():
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        call_with_deadline(time.sleep, 2, timeout=0.1)
+    assert time.monotonic() - started < 1
+
+
+def test_cancel_releases_a_waiting_call():
+    with story_run("story") as token, bind_token(token):
+        started = time.monotonic()
+        with pytest.raises(StoryCancelled):
+            call_with_deadline(lambda: (token.cancel(), time.sleep(2)), timeout=5)
+        assert time.monotonic() - started < 1
+
+
+def test_call_returns_its_result():
+    assert call_with_deadline(lambda a, b: a + b, 1, b=2) == 3
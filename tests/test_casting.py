@@ -0,0 +1,51 @@
+import threading
+
+from pydantic_bp.core import Character
+from utils import casting
+
+
+def make_roster(size: int, with_ids: bool = True):
+    return [
+        Character(
+            id=f"character-{i}" if with_ids else None, name=f"Character {i}", role="guard" if i % 2 else "sailor",
+            longtime_goals=[f"guard gate {i}"], personality=["calm"], strengths=["patience"], weaknesses=["pride"],
+            shortterm_memory=[], longterm_memory=[],
+        )
+        for i in range(size)
+    ]
+
+
+def test_named_characters_are_shortlisted_without_changing_the_roster():
+    roster = make_roster(15, with_ids=False)
+    before = [character.model_dump() for character in roster]
+    shortlist = casting.shortlist_characters(roster, "Character 14 meets Character 3 at the gate", k=4)
+    assert {3, 14} <= set(shortlist) and len(shortlist) == 4
+    assert [character.model_dump() for character in roster] == before
+
+
+def test_index_is_reused_when_shorttime_goals_change():
+    roster = make_roster(20)
+    index = casting.character_index(roster)
+    roster[0].shorttime_goals = ["find the sailor"]
+    assert casting.character_index(roster) is index
+
+
+def test_concurrent_shortlists_count_every_lookup():
+    rosters = [make_roster(13 + i) for i in range(casting.MAX_INDEXES * 2)]
+    before = casting.CASTING_STATS["lookups"]
+    errors = []
+
+    def shortlist(roster):
+        try:
+            for _ in range(20):
+                casting.shortlist_characters(roster, "a sailor guards the gate", k=5)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=shortlist, args=(roster,)) for roster in rosters]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+    assert casting.CASTING_STATS["lookups"] - before == 20 * len(rosters)
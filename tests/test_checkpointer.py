@@ -0,0 +1,82 @@
+import sqlite3
+
+import pytest
+from langgraph.checkpoint.base import empty_checkpoint
+
+from pydantic_bp.core import Scene
+from utils.checkpointer import StorySaver
+
+
+@pytest.fixture
+def saver(tmp_path):
+    saver = StorySaver(sqlite3.connect(tmp_path / "story.db", check_same_thread=False))
+    saver.setup()
+    yield saver
+    saver.conn.close()
+
+
+def scene(description: str) -> Scene:
+    return Scene(no=0, description=description, character_ids=[], moments=[])
+
+
+def put(saver: StorySaver, thread_id: str, descriptions, parent: str = None) -> str:
+    checkpoint = empty_checkpoint()
+    checkpoint["channel_values"] = {"main_goal": "Find the artifact", "scenes": [scene(description) for description in descriptions]}
+    config = {"configurable": {"thread_id": thread_id, "checkpoint_ns": "", "checkpoint_id": parent}}
+    return saver.put(config, checkpoint, {}, {})["configurable"]["checkpoint_id"]
+
+
+def descriptions(saver: StorySaver, thread_id: str):
+    return [scene.description for scene in saver.load_scenes(thread_id)]
+
+
+def test_fork_reads_the_shared_scenes_after_the_parent_advances(saver):
+    first = put(saver, "parent", ["cave"])
+    second = put(saver, "parent", ["cave", "river"], first)
+    fork = saver.fork("parent", thread_id="fork")
+    put(saver, "parent", ["cave", "river", "tower"], second)
+
+    assert descriptions(saver, fork) == ["cave", "river"]
+    assert saver.visible_scene_count(fork) == 2
+    assert descriptions(saver, "parent") == ["cave", "river", "tower"]
+
+
+def test_fork_keeps_the_shared_scenes_when_the_parent_restarts(saver):
+    first = put(saver, "parent", ["cave"])
+    second = put(saver, "parent", ["cave", "river"], first)
+    saver.fork("parent", thread_id="fork")
+    own = saver.fork("parent", checkpoint_id=second, thread_id="continued")
+    put(saver, "continued", ["cave", "river", "bridge"], second)
+
+    restarted = put(saver, "parent", [])
+    put(saver, "parent", ["desert"], restarted)
+
+    assert descriptions(saver, "parent") == ["desert"]
+    assert descriptions(saver, "fork") == ["cave", "river"]
+    assert descriptions(saver, own) == ["cave", "river", "bridge"]
+    assert saver.visible_scene_count("fork") == 2
+
+
+def test_fork_of_a_fork_keeps_the_scenes_of_both_sources(saver):
+    first = put(saver, "parent", ["cave"])
+    saver.fork("parent", thread_id="fork")
+    put(saver, "fork", ["cave", "river"], first)
+    saver.fork("fork", thread_id="grandchild")
+
+    put(saver, "parent", [])
+    assert descriptions(saver, "grandchild") == ["cave", "river"]
+
+
+def test_story_index_lists_stories_and_unstarted_forks(saver):
+    first = put(saver, "parent", ["cave"])
+    put(saver, "parent", ["cave", "river"], first)
+    saver.fork("parent", checkpoint_id=first, thread_id="fork")
+
+    stories = {story["thread_id"]: story for story in saver.list_stories()}
+    assert saver.story_count() == 2
+    assert stories["parent"]["scene_count"] == 2
+    assert stories["parent"]["main_goal"] == "Find the artifact"
+    assert stories["fork"]["scene_count"] == 1
+    assert stories["fork"]["forked_from"] == "parent"
+    assert saver.story_exists("fork") and not saver.story_exists("missing")
+    assert saver.story_header("parent")["main_goal"] == "Find the artifact"
@@ -0,0 +1,55 @@
+import sqlite3
+
+import pytest
+from langgraph.checkpoint.base import empty_checkpoint
+
+pytest.importorskip("zstandard")
+
+from benchmarks.bench_checkpoint_compression import load_objects
+from utils.checkpointer import StorySaver
+from utils.compressed_serde import CompressedSerializer, train_dictionary
+
+
+def write_checkpoints(saver: StorySaver, thread_id: str, count: int):
+    config = {"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}}
+    for step in range(count):
+        checkpoint = empty_checkpoint()
+        checkpoint["channel_values"] = {"main_goal": f"Find the artifact {step} " + "in the northern caves " * 20}
+        config = saver.put(config, checkpoint, {"step": step}, {})
+
+
+def open_saver(db_path) -> StorySaver:
+    saver = StorySaver(sqlite3.connect(db_path, check_same_thread=False), serde=CompressedSerializer("zstd"))
+    saver.setup()
+    return saver
+
+
+def dictionary_types(db_path) -> set:
+    with sqlite3.connect(db_path) as conn:
+        return {type for (type,) in conn.execute("SELECT type FROM checkpoints") if ".d" in type}
+
+
+def test_dictionary_can_be_retrained_on_rows_compressed_with_one(tmp_path):
+    db_path = tmp_path / "story.db"
+    write_checkpoints(open_saver(db_path), "first", 12)
+    with sqlite3.connect(db_path) as conn:
+        first = train_dictionary(conn, size=4096)
+
+    write_checkpoints(open_saver(db_path), "second", 12)
+    assert dictionary_types(db_path) == {f"msgpack+zstd.v1.d{first}"}
+    with sqlite3.connect(db_path) as conn:
+        assert train_dictionary(conn, size=4096) == first + 1
+        assert len(load_objects(conn, "checkpoints", "checkpoint", 100)) == 24
+
+
+def test_open_saver_reads_rows_of_a_dictionary_trained_meanwhile(tmp_path):
+    db_path = tmp_path / "story.db"
+    server = open_saver(db_path)
+    write_checkpoints(server, "first", 12)
+    with sqlite3.connect(db_path) as conn:
+        dict_id = train_dictionary(conn, size=4096)
+
+    write_checkpoints(open_saver(db_path), "second", 2)
+    assert dictionary_types(db_path) == {f"msgpack+zstd.v1.d{dict_id}"}
+    state = server.get_tuple({"configurable": {"thread_id": "second", "checkpoint_ns": ""}}).checkpoint["channel_values"]
+    assert state["main_goal"].startswith("Find the artifact 1 ")
@@ -0,0 +1,12 @@
+from agents.env_agent import reset_validation, validation_interval
+
+
+def test_validation_gets_more_frequent_as_the_scene_progresses():
+    intervals = [validation_interval(progress) for progress in (0.0, 0.29, 0.3, 0.69, 0.7, 1.0)]
+    assert intervals == [3, 3, 2, 2, 1, 1]
+
+
+def test_a_new_scene_is_validated_after_its_first_moment():
+    state = reset_validation()
+    assert state["next_validation_moment"] == 1
+    assert state["scene_assessment"] == "" and state["validated_moments"] == 0
@@ -0,0 +1,86 @@
+'''
+Checkpoint readers against a DB written with compressed checkpoints.
+
+    python -m unittest tests.test_export
+'''
+import contextlib
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+from langgraph.checkpoint.base import empty_checkpoint
+
+from benchmarks import bench_prompt_tokens
+from pydantic_bp.core import Character, CharacterMemoryUnit, Moment, Scene
+from utils.checkpointer import StorySaver
+from utils.export import export_stories
+
+
+def story_values() -> dict:
+    units = [
+        CharacterMemoryUnit(who_said=speaker, who_listens=[listener], dialogue="A line long enough to be compressed. " * 4, action="Waits.")
+        for speaker, listener in [("Ada", "Bo"), ("Bo", "Ada")] * 3
+    ]
+    characters = [
+        Character(id=name.lower(), name=name, role="Explorer", longtime_goals=["Find the artifact"], personality=["Calm"],
+                  strengths=["Wit"], weaknesses=["Pride"], shortterm_memory=list(units), longterm_memory=[])
+        for name in ("Ada", "Bo")
+    ]
+    scene = Scene(no=1, description="The cave", character_ids=["ada", "bo"], moments=[Moment(no=1, situations=units)])
+    return {"main_goal": "Find the artifact", "is_main_goal_achieved": True, "characters": characters, "entities": [], "scenes": [scene]}
+
+
+class CompressedExportTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.dir.name, "story.db")
+        with StorySaver.from_conn_string(self.db_path) as saver:
+            checkpoint = empty_checkpoint()
+            checkpoint["channel_values"] = story_values()
+            saver.put({"configurable": {"thread_id": "t", "checkpoint_ns": ""}}, checkpoint, {}, {})
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_checkpoints_are_compressed(self):
+        with sqlite3.connect(self.db_path) as conn:
+            types = [row[0] for row in conn.execute("SELECT type FROM checkpoints")]
+        self.assertTrue(types and all("+" in type for type in types), types)
+
+    def test_export_reads_compressed_checkpoints(self):
+        out_dir = os.path.join(self.dir.name, "exports")
+        summary = export_stories(self.db_path, out_dir, formats=["jsonl"])
+        self.assertEqual(summary["exported"], 1)
+        self.assertEqual(summary["rows"]["situations"], 6)
+
+        part = os.listdir(os.path.join(out_dir, "scenes"))[0]
+        with open(os.path.join(out_dir, "scenes", part), encoding="utf-8") as file:
+            rows = [json.loads(line) for line in file]
+        self.assertEqual([row["description"] for row in rows], ["The cave"])
+
+    def test_full_export_keeps_the_incremental_watermark(self):
+        out_dir = os.path.join(self.dir.name, "exports")
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(export_stories(self.db_path, out_dir, incremental=True)["exported"], 1)
+            with StorySaver.from_conn_string(self.db_path) as saver:
+                checkpoint = empty_checkpoint()
+                checkpoint["channel_values"] = story_values()
+                saver.put({"configurable": {"thread_id": "t", "checkpoint_ns": ""}}, checkpoint, {}, {})
+            self.assertEqual(export_stories(self.db_path, out_dir)["exported"], 1)
+            # The full export does not count as the last incremental run, the new checkpoint is still exported
+            self.assertEqual(export_stories(self.db_path, out_dir, incremental=True)["exported"], 1)
+            self.assertEqual(export_stories(self.db_path, out_dir, incremental=True)["skipped_unchanged"], 1)
+
+    def test_prompt_token_benchmark_reads_compressed_checkpoints(self):
+        output = io.StringIO()
+        with mock.patch("sys.argv", ["bench_prompt_tokens", "--db", self.db_path]), contextlib.redirect_stdout(output):
+            bench_prompt_tokens.main()
+        self.assertIn("thread t", output.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import pytest
+
+from utils.jobs import JobService
+
+
+@pytest.fixture
+def service(tmp_path):
+    service = JobService(db_path=str(tmp_path / "jobs.db"), checkpoint_db=str(tmp_path / "story.db"), workers=0, user_limit=1)
+    yield service
+    service.conn.close()
+    service.saver.conn.close()
+
+
+def claim(service: JobService):
+    with service.lock:
+        return service._claim()
+
+
+def test_workers_take_the_oldest_job_of_users_under_their_limit(service):
+    first = service.submit("ann", "A heist")
+    second = service.submit("ann", "A duel")
+    other = service.submit("bob", "A voyage")
+
+    assert claim(service)["job_id"] == first["job_id"]
+    # ann already has a running story, bob's job goes first
+    assert claim(service)["job_id"] == other["job_id"]
+    assert claim(service) is None
+
+    service._finish(first["job_id"], "done")
+    assert claim(service)["job_id"] == second["job_id"]
+
+
+def test_a_story_has_one_active_job(service):
+    job = service.submit("ann", "A heist")
+    with pytest.raises(ValueError):
+        service.submit("bob", thread_id=job["thread_id"])
+    assert service.thread_owner(job["thread_id"]) == "ann"
+    assert service.active_job(job["thread_id"])["job_id"] == job["job_id"]
+    service._finish(job["job_id"], "done")
+    assert service.active_job(job["thread_id"]) is None
+
+
+def test_cancelled_queued_job_is_not_claimed(service):
+    job = service.submit("ann", "A heist")
+    assert service.cancel(job["job_id"])
+    assert service.get(job["job_id"])["status"] == "cancelled"
+    assert claim(service) is None
+    assert not service.cancel(job["job_id"])
+
+
+def test_running_jobs_are_queued_again_on_start(service):
+    job = service.submit("ann", "A heist")
+    claim(service)
+    service.start()
+    assert service.get(job["job_id"])["status"] == "queued"
+    assert claim(service)["job_id"] == job["job_id"]
+    assert service.get(job["job_id"])["attempts"] == 2
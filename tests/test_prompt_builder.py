@@ -0,0 +1,65 @@
+import pytest
+
+from utils import prompt_builder
+from utils.prompt_builder import APPEND_ONLY, DROP, KEEP_FIRST, KEEP_LATEST, STABLE, VOLATILE, PromptBuilder
+from utils.tokens import estimate_tokens
+
+
+@pytest.fixture
+def budget(monkeypatch):
+    monkeypatch.setenv("CONTEXT_BUDGET_TEST_AGENT", "400")
+    prompt_builder.CONTEXT_STATS.pop("test_agent", None)
+    return 400
+
+
+def lines(heading: str, count: int) -> str:
+    return "\n".join([heading] + [f"{heading} line {i} with a few words of content" for i in range(count)])
+
+
+def human_text(messages) -> str:
+    return messages[-1].content
+
+
+def test_prompt_under_budget_is_left_whole(budget):
+    history = lines("History", 5)
+    messages = PromptBuilder("test_agent").system("Instructions").add(history, APPEND_ONLY, "history", 1, KEEP_LATEST).build()
+    assert human_text(messages) == history
+    assert prompt_builder.CONTEXT_STATS["test_agent"]["trimmed_calls"] == 0
+
+
+def test_lowest_priority_segments_are_trimmed_first_within_budget(budget):
+    roster, history, notes = lines("Roster", 5), lines("History", 200), lines("Notes", 50)
+    question = "Question: what happens next?"
+    messages = (
+        PromptBuilder("test_agent")
+        .system("Instructions")
+        .add(roster, STABLE, "roster", priority=3, strategy=KEEP_FIRST)
+        .add(history, APPEND_ONLY, "history", priority=2, strategy=KEEP_LATEST)
+        .add(notes, APPEND_ONLY, "notes", priority=1, strategy=DROP)
+        .add(question, VOLATILE)
+        .build()
+    )
+    text = human_text(messages)
+    assert estimate_tokens("Instructions") + estimate_tokens(text) <= budget
+    # The higher priority roster and the untrimmable question are kept whole
+    assert roster in text and text.endswith(question)
+    assert "Notes" not in text
+    # The history keeps its heading and latest lines
+    assert "History\n[... " in text and "History line 199" in text and "History line 0 " not in text
+    stats = prompt_builder.CONTEXT_STATS["test_agent"]
+    assert stats["trimmed_calls"] == 1 and stats["over_budget_calls"] == 0
+
+
+def test_compact_rendering_is_tried_before_cutting(budget):
+    full = lines("Cast", 200)
+    messages = (
+        PromptBuilder("test_agent")
+        .add(full, STABLE, "cast", priority=1, strategy=KEEP_FIRST, compact=lambda: "Cast\nshort")
+        .build()
+    )
+    assert human_text(messages) == "Cast\nshort"
+
+
+def test_untrimmable_prompt_is_counted_over_budget(budget):
+    PromptBuilder("test_agent").add(lines("Question", 200), VOLATILE).build()
+    assert prompt_builder.CONTEXT_STATS["test_agent"]["over_budget_calls"] == 1
@@ -0,0 +1,34 @@
+from agents import stall_detector
+from agents.stall_detector import CLOSE, CONTINUE, SKIP
+from pydantic_bp.core import CharacterMemoryUnit, Moment, Scene
+
+
+def unit(name: str, dialogue: str) -> CharacterMemoryUnit:
+    return CharacterMemoryUnit(who_said=name, who_listens=[], dialogue=dialogue, action="Stands still.")
+
+
+def scene(*moments) -> Scene:
+    return Scene(
+        no=1, description="The gate", character_ids=[],
+        moments=[Moment(no=i + 1, situations=[unit(name, dialogue) for name, dialogue in lines]) for i, lines in enumerate(moments)],
+    )
+
+
+LOOP = [("Ann", "We have to open the gate before the guards return"), ("Bob", "We have to open the gate before the guards return now")]
+
+
+def test_new_lines_go_to_the_validator():
+    assert stall_detector.check(scene([("Ann", "Where is the key?")], [("Bob", "Under the old stone by the river.")])) == CONTINUE
+
+
+def test_repeated_moment_skips_the_validator_only_when_due_counts(monkeypatch):
+    monkeypatch.setattr(stall_detector, "STALL_STATS", {"checks": 0, "validator_calls_saved": 0, "scenes_closed": 0})
+    repeated = scene(LOOP, LOOP)
+    assert stall_detector.check(repeated, due=False) == SKIP
+    assert stall_detector.STALL_STATS["validator_calls_saved"] == 0
+    assert stall_detector.check(repeated, due=True) == SKIP
+    assert stall_detector.STALL_STATS["validator_calls_saved"] == 1
+
+
+def test_looping_scene_is_closed():
+    assert stall_detector.check(scene(LOOP, LOOP, LOOP)) == CLOSE
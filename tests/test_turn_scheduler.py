@@ -0,0 +1,36 @@
+from agents import turn_scheduler
+from pydantic_bp.core import Character, CharacterMemoryUnit, Moment, Scene
+
+
+def make_cast(size: int):
+    return [
+        Character(name=f"Character {i}", role="guard", longtime_goals=["g"], personality=["p"], strengths=["s"],
+                  weaknesses=["w"], shortterm_memory=[], longterm_memory=[])
+        for i in range(size)
+    ]
+
+
+def run_moment(scene: Scene, cast, start: int = 0):
+    acted, order = set(), []
+    for _ in range(turn_scheduler.speakers_per_moment(cast)):
+        index = turn_scheduler.next_speaker(scene, cast, start, acted)
+        acted.add(index)
+        order.append(index)
+    return order
+
+
+def test_whole_cast_acts_in_cast_order_by_default(monkeypatch):
+    monkeypatch.setattr(turn_scheduler, "SPEAKERS_PER_MOMENT", 0)
+    cast = make_cast(3)
+    line = CharacterMemoryUnit(who_said=cast[0].name, who_listens=[cast[2].name], dialogue="Over here!", action="Waves.")
+    scene = Scene(no=1, description="The gate", character_ids=[], moments=[Moment(no=1, situations=[line])])
+    assert run_moment(scene, cast, start=1) == [0, 1, 2]
+
+
+def test_addressed_character_acts_first_when_turns_are_capped(monkeypatch):
+    monkeypatch.setattr(turn_scheduler, "SPEAKERS_PER_MOMENT", 2)
+    cast = make_cast(4)
+    line = CharacterMemoryUnit(who_said=cast[0].name, who_listens=[cast[2].name], dialogue="Over here!", action="Waves.")
+    scene = Scene(no=1, description="The gate", character_ids=[], moments=[Moment(no=1, situations=[line])])
+    order = run_moment(scene, cast)
+    assert len(order) == 2 and order[0] == 2
@@ -0,0 +1,21 @@
+import logging
+
+from pydantic_bp.world import make_id, repair_indexes
+
+
+def test_invalid_indexes_are_dropped_with_one_warning(caplog):
+    with caplog.at_level(logging.WARNING, logger="pydantic_bp.world"):
+        assert repair_indexes([2, 7, 0, 2, -1], 3, "character index") == [2, 0]
+    assert len(caplog.records) == 1
+    assert "character index 7, -1" in caplog.records[0].getMessage()
+
+
+def test_valid_indexes_log_nothing(caplog):
+    with caplog.at_level(logging.WARNING, logger="pydantic_bp.world"):
+        assert repair_indexes([1, 0], 2) == [1, 0]
+    assert not caplog.records
+
+
+def test_taken_ids_are_suffixed():
+    assert make_id("Dr. Aris Thorne", set()) == "aris-thorne"
+    assert make_id("Aris Thorne", {"aris-thorne": None, "aris-thorne-2": None}) == "aris-thorne-3"
@@ -0,0 +1,201 @@
+import contextvars
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+
+# Per LLM call deadline in seconds, a hung call is abandoned after it
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+# Optional deadline in seconds for a whole story run
+STORY_TIMEOUT = float(os.getenv("STORY_TIMEOUT", "0")) or None
+POLL_SECONDS = 0.25
+
+
+class StoryCancelled(RuntimeError):
+    pass
+
+
+class DeadlineExceeded(StoryCancelled):
+    pass
+
+
+class CancelToken:
+    def __init__(self, thread_id: str, timeout: Optional[float] = None):
+        self.thread_id = thread_id
+        self.deadline = time.monotonic() + timeout if timeout else None
+        self.reason: Optional[str] = None
+        self._event = threading.Event()
+
+    def cancel(self, reason: str = "cancelled"):
+        self.reason = reason
+        self._event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def remaining(self) -> Optional[float]:
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def check(self):
+        if self._event.is_set():
+            raise StoryCancelled(f"Story {self.thread_id} {self.reason}")
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            raise DeadlineExceeded(f"Story {self.thread_id} exceeded its deadline")
+
+
+_tokens: Dict[str, CancelToken] = {}
+_tokens_lock = threading.Lock()
+# Token of work done for a story outside its graph run, e.g. a character turn on an actor worker
+_bound_token: "contextvars.ContextVar[Optional[CancelToken]]" = contextvars.ContextVar("bound_token", default=None)
+
+# Hung calls keep their thread until they return, the caller is released at the deadline
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="llm-call")
+
+
+@contextmanager
+def story_run(thread_id: str, timeout: Optional[float] = None):
+    '''
+    Registers a cancel token for a story run, with an optional deadline in seconds for the whole run.
+    '''
+    token = CancelToken(thread_id, timeout)
+    with _tokens_lock:
+        _tokens[thread_id] = token
+    try:
+        yield token
+    finally:
+        with _tokens_lock:
+            if _tokens.get(thread_id) is token:
+                del _tokens[thread_id]
+
+
+def cancel_story(thread_id: str, reason: str = "cancelled") -> bool:
+    '''
+    Asks a running story to stop at its next safe point. Returns False when it is not running.
+    '''
+    with _tokens_lock:
+        token = _tokens.get(thread_id)
+    if token is None:
+        return False
+    token.cancel(reason)
+    return True
+
+
+@contextmanager
+def cancel_on_sigint(thread_id: str):
+    '''
+    First Ctrl-C cancels the story, which stops at its next safe point on a consistent checkpoint.
+    A second Ctrl-C aborts immediately.
+    '''
+    def handle(signum, frame):
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        if not cancel_story(thread_id, "interrupted"):
+            raise KeyboardInterrupt
+        print("\nStopping after the current step, press Ctrl-C again to abort.")
+
+    previous = signal.signal(signal.SIGINT, handle)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGINT, previous)
+
+
+def running_stories():
+    with _tokens_lock:
+        return list(_tokens)
+
+
+@contextmanager
+def bind_token(token: CancelToken):
+    '''
+    Makes token the current one in this context, for story work that runs outside the graph.
+    '''
+    reset = _bound_token.set(token)
+    try:
+        yield token
+    finally:
+        _bound_token.reset(reset)
+
+
+def current_token() -> Optional[CancelToken]:
+    '''
+    Token of the story whose graph is running in this context, from the LangGraph run config,
+    or the one bound with bind_token.
+    '''
+    token = _bound_token.get()
+    if token is not None:
+        return token
+    try:
+        from langgraph.config import get_config
+        thread_id = get_config().get("configurable", {}).get("thread_id")
+    except RuntimeError:
+        # Not inside a graph run
+        return None
+    if thread_id is None:
+        return None
+    with _tokens_lock:
+        return _tokens.get(str(thread_id))
+
+
+def check_cancelled():
+    '''
+    Safe point: raises StoryCancelled when the running story was cancelled or is past its deadline.
+    Nodes call this before doing work, so a cancelled run stops on the checkpoint of the last finished step.
+    '''
+    token = current_token()
+    if token is not None:
+        token.check()
+
+
+def call_with_deadline(fn: Callable, *args, timeout: float = LLM_TIMEOUT, **kwargs):
+    '''
+    Runs fn with a deadline (the smaller of timeout and what is left of the story deadline),
+    returning early when the story is cancelled.
+    '''
+    token = current_token()
+    if token is not None:
+        token.check()
+        remaining = token.remaining()
+        if remaining is not None:
+            timeout = min(timeout, max(remaining, 0))
+
+    future = _executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return future.result(timeout=max(0, min(POLL_SECONDS, deadline - time.monotonic())))
+        except FutureTimeoutError:
+            if token is not None:
+                token.check()
+            if time.monotonic() >= deadline:
+                future.cancel()
+                raise DeadlineExceeded(f"LLM call did not return within {timeout:.0f}s")
+
+
+class GuardedLLM:
+    '''
+    Chat model wrapper that applies call_with_deadline to every structured output call.
+    '''
+
+    def __init__(self, llm, timeout: float = LLM_TIMEOUT):
+        self.llm = llm
+        self.timeout = timeout
+
+    def with_structured_output(self, schema, **kwargs) -> "GuardedRunnable":
+        return GuardedRunnable(self.llm.with_structured_output(schema, **kwargs), self.timeout)
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+
+class GuardedRunnable:
+    def __init__(self, runnable, timeout: float):
+        self.runnable = runnable
+        self.timeout = timeout
+
+    def invoke(self, *args, **kwargs):
+        return call_with_deadline(self.runnable.invoke, *args, timeout=self.timeout, **kwargs)
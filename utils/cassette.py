@@ -0,0 +1,318 @@
+import argparse
+import atexit
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, Optional
+
+from pydantic import BaseModel
+
+
+# LLM_MODE=record writes every LLM call to the cassette, LLM_MODE=replay answers them from it
+MODES = ("live", "record", "replay")
+CASSETTE_DIR = "cassettes"
+
+
+def default_cassette_path() -> str:
+    return os.path.join(CASSETTE_DIR, f"{os.getenv('THREAD_ID') or 'default'}.jsonl.gz")
+
+
+def _messages_data(messages) -> List[dict]:
+    return [{"type": getattr(message, "type", "human"), "content": getattr(message, "content", message)} for message in messages]
+
+
+def _schema_name(schema) -> str:
+    return getattr(schema, "__name__", str(schema))
+
+
+def request_key(model: str, schema_name: str, messages: List[dict]) -> str:
+    payload = json.dumps([model, schema_name, messages], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CassetteMiss(RuntimeError):
+    pass
+
+
+class Cassette:
+    '''
+    Gzipped JSONL file of LLM calls, one line per call with the request, the response and its latency.
+
+    Replay looks calls up by a hash of model, schema and messages, with a FIFO per hash for repeated
+    identical requests. A request that is not on the cassette (e.g. a prompt changed since recording)
+    falls back to the next unused call of the same model and schema, unless strict is set.
+
+    Recording without a path keeps the calls in memory until drain(), actor worker processes send
+    them back to the coordinator, which writes them to its cassette with extend().
+    '''
+
+    def __init__(self, path: Optional[str], mode: str, realtime: bool = False, strict: bool = False):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Unknown cassette mode {mode}, expected record or replay")
+        self.path = path
+        self.mode = mode
+        self.realtime = realtime
+        self.strict = strict
+        self.meta: Dict[str, object] = {}
+        self.stats = {"calls": 0, "hits": 0, "fallbacks": 0, "recorded_latency": 0.0}
+        self._lock = threading.Lock()
+        self._file = None
+        self._pending: List[dict] = []
+
+        if mode == "record":
+            if path is not None:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                # A recording starts a new cassette, runs are never appended to an earlier one
+                self._file = gzip.open(path, "wt", encoding="utf-8")
+                atexit.register(self.close)
+        else:
+            self._by_key: Dict[str, Deque[dict]] = defaultdict(deque)
+            self._by_schema: Dict[tuple, Deque[dict]] = defaultdict(deque)
+            for entry in self.read(path):
+                if "meta" in entry:
+                    self.meta.update(entry["meta"])
+                    continue
+                entry["used"] = False
+                self._by_key[entry["key"]].append(entry)
+                self._by_schema[(entry["model"], entry["schema"])].append(entry)
+
+    @staticmethod
+    def read(path: str):
+        '''
+        Entries of the cassette. A cassette of a run that crashed has no gzip end-of-stream marker and may
+        end in a partial line, every complete call before that is read.
+        '''
+        with open(path, "rb") as file:
+            data = file.read()
+        text = b""
+        while data:
+            decompressor = zlib.decompressobj(wbits=16 + zlib.MAX_WBITS)
+            text += decompressor.decompress(data)
+            if not decompressor.eof:
+                print(f"[cassette] {path} ends without a gzip trailer, reading the calls recorded before the crash")
+                break
+            data = decompressor.unused_data
+        for line in text.decode("utf-8", errors="replace").split("\n"):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # The line being written when the run crashed
+                break
+
+    def _write(self, entry: dict):
+        with self._lock:
+            if self.path is None:
+                self._pending.append(entry)
+                return
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            # Flush every call to the file, read() recovers them when the run crashes before close()
+            self._file.flush()
+
+    def drain(self) -> List[dict]:
+        '''
+        Calls recorded in memory since the last drain.
+        '''
+        with self._lock:
+            entries, self._pending = self._pending, []
+        return entries
+
+    def extend(self, entries: List[dict]):
+        '''
+        Writes calls recorded elsewhere, e.g. the turns of an actor worker process.
+        '''
+        if self.mode == "record":
+            for entry in entries:
+                self._write(entry)
+
+    def note(self, **meta):
+        '''
+        Stores run metadata (e.g. the story input) on the cassette, used by the replay command.
+        '''
+        if self.mode == "record":
+            self.meta.update(meta)
+            self._write({"meta": meta})
+
+    def record(self, model: str, schema_name: str, messages: List[dict], response, error: Optional[str], latency: float):
+        if isinstance(response, BaseModel):
+            response = response.model_dump(mode="json")
+        self._write({
+            "key": request_key(model, schema_name, messages),
+            "model": model,
+            "schema": schema_name,
+            "messages": messages,
+            "response": response,
+            "error": error,
+            "latency": round(latency, 4),
+        })
+
+    def take(self, model: str, schema_name: str, messages: List[dict]) -> dict:
+        key = request_key(model, schema_name, messages)
+        with self._lock:
+            self.stats["calls"] += 1
+            entry = self._pop(self._by_key.get(key))
+            if entry is not None:
+                self.stats["hits"] += 1
+            elif not self.strict:
+                entry = self._pop(self._by_schema.get((model, schema_name)))
+                if entry is not None:
+                    self.stats["fallbacks"] += 1
+                    print(f"[cassette] no recorded call for this {schema_name} request, using the next recorded one")
+            if entry is None:
+                raise CassetteMiss(f"No recorded {model} call for {schema_name} on cassette {self.path}")
+            self.stats["recorded_latency"] += entry["latency"]
+        return entry
+
+    @staticmethod
+    def _pop(entries: Optional[Deque[dict]]) -> Optional[dict]:
+        # Entries are shared by both indexes, skip the ones already used through the other
+        while entries:
+            entry = entries.popleft()
+            if not entry["used"]:
+                entry["used"] = True
+                return entry
+        return None
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def __enter__(self) -> "Cassette":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CassetteLLM:
+    '''
+    Stands in for a chat model in the agents, which only use with_structured_output(schema).invoke(messages).
+    Records the calls of the wrapped model, or replays them without one.
+    '''
+
+    def __init__(self, cassette: Cassette, name: str, llm=None):
+        self.cassette = cassette
+        self.name = name
+        self.llm = llm
+
+    def with_structured_output(self, schema, **kwargs) -> "CassetteRunnable":
+        runnable = self.llm.with_structured_output(schema, **kwargs) if self.llm is not None else None
+        return CassetteRunnable(self, schema, runnable)
+
+
+class CassetteRunnable:
+    def __init__(self, owner: CassetteLLM, schema, runnable):
+        self.owner = owner
+        self.schema = schema
+        self.runnable = runnable
+
+    def invoke(self, messages, config=None, **kwargs):
+        cassette = self.owner.cassette
+        messages_data = _messages_data(messages)
+        schema_name = _schema_name(self.schema)
+
+        if cassette.mode == "record":
+            start = time.perf_counter()
+            try:
+                response = self.runnable.invoke(messages, config, **kwargs)
+            except Exception as error:
+                cassette.record(self.owner.name, schema_name, messages_data, None, repr(error), time.perf_counter() - start)
+                raise
+            cassette.record(self.owner.name, schema_name, messages_data, response, None, time.perf_counter() - start)
+            return response
+
+        entry = cassette.take(self.owner.name, schema_name, messages_data)
+        if cassette.realtime:
+            time.sleep(entry["latency"])
+        if entry["error"]:
+            raise RuntimeError(f"Recorded LLM error: {entry['error']}")
+        if isinstance(self.schema, type) and issubclass(self.schema, BaseModel):
+            return self.schema.model_validate(entry["response"])
+        return entry["response"]
+
+
+def summarize(path: str) -> dict:
+    calls = defaultdict(lambda: {"calls": 0, "errors": 0, "latency": 0.0})
+    meta = {}
+    for entry in Cassette.read(path):
+        if "meta" in entry:
+            meta.update(entry["meta"])
+            continue
+        stats = calls[f"{entry['model']}:{entry['schema']}"]
+        stats["calls"] += 1
+        stats["errors"] += bool(entry["error"])
+        stats["latency"] = round(stats["latency"] + entry["latency"], 4)
+    return {"path": path, "meta": {key: value for key, value in meta.items() if key != "input_text"}, "calls": dict(calls)}
+
+
+def replay_story(path: str, thread_id: str, db_path: str, realtime: bool = False, strict: bool = False,
+                 input_text: Optional[str] = None, recursion_limit: int = 50) -> dict:
+    '''
+    Re-runs start_agent_app and env_agent_workflow offline from a cassette into the given checkpoint DB.
+    '''
+    # The LLM clients are chosen when utils.model is imported
+    os.environ["LLM_MODE"] = "replay"
+    os.environ["LLM_CASSETTE"] = path
+    os.environ["LLM_REPLAY_REALTIME"] = "1" if realtime else "0"
+    os.environ["LLM_REPLAY_STRICT"] = "1" if strict else "0"
+
+    from agents.env_agent import env_agent_workflow, initial_state
+    from agents.start_agent import get_start_agent_app
+    from utils.cancellation import STORY_TIMEOUT, story_run
+    from utils.checkpointer import StorySaver
+    from utils.model import cassette
+
+    input_text = input_text or cassette.meta.get("input_text")
+    if not input_text:
+        raise RuntimeError(f"Cassette {path} has no recorded story input, pass it explicitly")
+
+    start = time.perf_counter()
+    output = get_start_agent_app().invoke({"input_text": input_text})
+
+    with StorySaver.from_conn_string(db_path) as memory, story_run(thread_id, timeout=STORY_TIMEOUT):
+        env_agent_app = env_agent_workflow.compile(checkpointer=memory)
+        env_agent_app.invoke(initial_state(output), config={"recursion_limit": recursion_limit, "configurable": {"thread_id": thread_id}}, durability="sync")
+
+    return {**cassette.stats, "wall_time": round(time.perf_counter() - start, 3), "recorded_latency": round(cassette.stats["recorded_latency"], 3)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or replay LLM cassettes recorded with LLM_MODE=record.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    info = subparsers.add_parser("info", help="Calls, errors and recorded latency per model and schema")
+    info.add_argument("cassette")
+
+    replay = subparsers.add_parser("replay", help="Re-run the story pipeline offline from a cassette")
+    replay.add_argument("cassette")
+    replay.add_argument("--thread", default=f"replay_{time.strftime('%Y%m%d_%H%M%S')}", help="Thread id of the replayed story")
+    replay.add_argument("--db", default="replay_checkpoint.db", help="Checkpoint DB to replay into")
+    replay.add_argument("--input-file", help="Story input, defaults to the one recorded on the cassette")
+    replay.add_argument("--realtime", action="store_true", help="Sleep for the recorded latency of every call")
+    replay.add_argument("--strict", action="store_true", help="Fail on requests that are not on the cassette")
+    replay.add_argument("--recursion-limit", type=int, default=50)
+    args = parser.parse_args()
+
+    if args.command == "info":
+        print(json.dumps(summarize(args.cassette), indent=2))
+        return
+
+    input_text = None
+    if args.input_file:
+        with open(args.input_file, encoding="utf-8") as file:
+            input_text = file.read()
+    summary = replay_story(args.cassette, args.thread, args.db, realtime=args.realtime, strict=args.strict,
+                           input_text=input_text, recursion_limit=args.recursion_limit)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import math
+import os
+import re
+import threading
+import zlib
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, Hashable, Iterable, List, Sequence, Tuple
+
+from pydantic_bp.core import Character, Entity, Scene
+from pydantic_bp.world import WorldRegistry, repair_indexes
+
+
+# Candidates put in the scene_creator and final_goal_validator prompts, rosters up to this size go in whole
+CAST_SHORTLIST = int(os.getenv("CAST_SHORTLIST", "12"))
+ENTITY_SHORTLIST = int(os.getenv("ENTITY_SHORTLIST", "12"))
+# Scenes of the history the goal validator query is built from
+RECENT_SCENES = 2
+# Hashed feature space of the index, word unigrams and bigrams
+DIMENSIONS = 2048
+MAX_INDEXES = 8
+
+CASTING_STATS = {"lookups": 0, "roster": 0, "shortlisted": 0}
+
+_WORD = re.compile(r"[a-z0-9']+")
+_STOP_WORDS = {
+    "the", "and", "for", "with", "that", "this", "from", "into", "their", "they", "them", "are", "was",
+    "were", "has", "have", "his", "her", "its", "who", "what", "when", "where", "will", "not", "but", "all",
+}
+
+_indexes: "OrderedDict[Hashable, CastingIndex]" = OrderedDict()
+# Shortlists are built from job workers and actor threads at once
+_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def _get_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def features(text: str) -> Dict[int, int]:
+    '''
+    Hashed term counts of a text: words of 3+ letters that are not stop words, and their bigrams.
+    '''
+    words = [word for word in _WORD.findall(text.lower()) if len(word) > 2 and word not in _STOP_WORDS]
+    terms = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    counts: Dict[int, int] = {}
+    for term in terms:
+        dim = zlib.crc32(term.encode()) % DIMENSIONS
+        counts[dim] = counts.get(dim, 0) + 1
+    return counts
+
+
+class CastingIndex:
+    '''
+    TF-IDF index over hashed terms of a list of documents, search() ranks them against a query by cosine.
+
+    With NumPy installed the document vectors are the columns of a (DIMENSIONS, documents) matrix, a query
+    only reads the rows of its terms. Without it the same vectors are scored through an inverted index.
+    '''
+
+    def __init__(self, documents: Sequence[str]):
+        counts = [features(document) for document in documents]
+        document_frequency: Dict[int, int] = {}
+        for row in counts:
+            for dim in row:
+                document_frequency[dim] = document_frequency.get(dim, 0) + 1
+        self.size = len(documents)
+        self.idf = {dim: math.log((1 + self.size) / (1 + df)) + 1 for dim, df in document_frequency.items()}
+        vectors = [self._vector(row) for row in counts]
+
+        numpy = _get_numpy()
+        self.matrix = None
+        self.postings: Dict[int, List[Tuple[int, float]]] = {}
+        if numpy is not None:
+            self.matrix = numpy.zeros((DIMENSIONS, self.size), dtype=numpy.float32)
+            for position, row in enumerate(vectors):
+                for dim, weight in row.items():
+                    self.matrix[dim, position] = weight
+        else:
+            for position, row in enumerate(vectors):
+                for dim, weight in row.items():
+                    self.postings.setdefault(dim, []).append((position, weight))
+
+    def _vector(self, counts: Dict[int, int]) -> Dict[int, float]:
+        vector = {dim: (1 + math.log(count)) * self.idf.get(dim, 0.0) for dim, count in counts.items()}
+        norm = math.sqrt(sum(weight * weight for weight in vector.values()))
+        return {dim: weight / norm for dim, weight in vector.items() if weight} if norm else {}
+
+    def scores(self, query: str) -> List[float]:
+        query_vector = self._vector(features(query))
+        if not query_vector:
+            return [0.0] * self.size
+        if self.matrix is not None:
+            dims = list(query_vector)
+            weights = _get_numpy().array([query_vector[dim] for dim in dims], dtype=self.matrix.dtype)
+            return (weights @ self.matrix[dims]).tolist()
+        scores = [0.0] * self.size
+        for dim, weight in query_vector.items():
+            for position, value in self.postings.get(dim, ()):
+                scores[position] += weight * value
+        return scores
+
+    def search(self, query: str, k: int) -> List[int]:
+        '''
+        Positions of the k best matching documents, best first. Documents sharing no term with the query are left out.
+        '''
+        scores = self.scores(query)
+        ranked = sorted((position for position in range(self.size) if scores[position] > 0), key=lambda position: -scores[position])
+        return ranked[:k]
+
+
+def character_document(character: Character) -> str:
+    # The name twice, a reference that names a character should rank it first. Only the profile is indexed,
+    # shorttime goals change every moment and would rebuild the index on every lookup
+    return " ".join([
+        character.name, character.name, *character.aliases, character.role,
+        *character.longtime_goals, *character.personality, *character.strengths,
+    ])
+
+
+def entity_document(entity: Entity) -> str:
+    return f"{entity.name} {entity.name} {entity.description}"
+
+
+def _index(key: Hashable, documents: Iterable[str]) -> CastingIndex:
+    with _lock:
+        index = _indexes.get(key)
+        if index is not None:
+            _indexes.move_to_end(key)
+            return index
+    # Built outside the lock, two threads may build the same index and the last one is kept
+    index = CastingIndex(list(documents))
+    with _lock:
+        _indexes[key] = index
+        if len(_indexes) > MAX_INDEXES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def character_index(characters: List[Character]) -> CastingIndex:
+    key = ("characters", tuple(character_document(character) for character in characters))
+    return _index(key, key[1])
+
+
+def entity_index(entities: List[Entity]) -> CastingIndex:
+    key = ("entities", tuple(entity_document(entity) for entity in entities))
+    return _index(key, key[1])
+
+
+def _shortlist(size: int, required: List[int], ranked: List[int], k: int) -> List[int]:
+    picks = list(dict.fromkeys(required + ranked))[:k]
+    # A vague query leaves room, filled in roster order where the main characters come first
+    taken = set(picks)
+    picks += [position for position in range(size) if position not in taken][:k - len(picks)]
+    with _lock:
+        CASTING_STATS["lookups"] += 1
+        CASTING_STATS["roster"] += size
+        CASTING_STATS["shortlisted"] += len(picks)
+    # Roster order, the prompt lists the candidates as the roster does
+    return sorted(picks)
+
+
+def shortlist_characters(characters: List[Character], query: str, required: Iterable[int] = (), k: int = CAST_SHORTLIST) -> List[int]:
+    '''
+    Roster positions of the characters offered for a scene: the required ones, the ones the query names,
+    then the best matches of the query on profiles and goals, at most k. The position of a candidate in
+    the returned list is its index in the prompt, shortlist[i] maps it back to the roster.
+    '''
+    if k <= 0 or len(characters) <= k:
+        return list(range(len(characters)))
+    # Read-only name lookup, the roster of the state is not given ids or merged here
+    positions: Dict[str, int] = {}
+    for position, character in enumerate(characters):
+        positions.setdefault(character.ref, position)
+    mentioned = [positions[character.ref] for character in WorldRegistry.lookup(characters).mentioned_characters(query) if character.ref in positions]
+    required = [position for position in required if 0 <= position < len(characters)]
+    return _shortlist(len(characters), required + mentioned, character_index(characters).search(query, k), k)
+
+
+def shortlist_entities(entities: List[Entity], query: str, k: int = ENTITY_SHORTLIST) -> List[int]:
+    if k <= 0 or len(entities) <= k:
+        return list(range(len(entities)))
+    return _shortlist(len(entities), [], entity_index(entities).search(query, k), k)
+
+
+def scene_reference(next_scene, characters: List[Character]) -> Tuple[str, List[int]]:
+    '''
+    The reference to the next scene as text and the roster positions of the characters it names.
+    It is the start scene description, or the scene suggested by the goal validator whose
+    characters_indexes are roster positions.
+    '''
+    if not next_scene:
+        return "", []
+    if isinstance(next_scene, str):
+        return next_scene, []
+    positions = repair_indexes(next_scene.characters_indexes, len(characters), "character index")
+    if not positions:
+        return next_scene.description, []
+    names = ", ".join(characters[position].name for position in positions)
+    return f"{next_scene.description} Characters: {names}", positions
+
+
+def story_reference(main_goal: str, scenes: List[Scene], characters: List[Character]) -> str:
+    '''
+    Query for the goal validator shortlist: the main goal and the last scenes with their casts.
+    '''
+    names = {character.ref: character.name for character in characters}
+    parts = [main_goal]
+    for scene in scenes[-RECENT_SCENES:]:
+        parts.append(scene.description)
+        parts.extend(names[ref] for ref in scene.character_ids if ref in names)
+    return " ".join(parts)
+
+
+def pick(items: list, shortlist: List[int]) -> list:
+    return [items[position] for position in shortlist]
+
+
+def to_roster(indexes: Iterable[int], shortlist: List[int], what: str = "character index") -> List[int]:
+    '''
+    Roster positions of the 0 based shortlist indexes the LLM answered with, invalid ones dropped.
+    '''
+    return [shortlist[index] for index in repair_indexes(indexes, len(shortlist), what)]
@@ -0,0 +1,551 @@
+import hashlib
+import json
+import uuid
+from datetime import datetime, timezone
+from typing import Iterator, List, Optional
+
+from langchain_core.runnables import RunnableConfig
+from langgraph.checkpoint.base import CheckpointTuple, get_checkpoint_id, get_checkpoint_metadata
+from langgraph.checkpoint.sqlite import SqliteSaver
+
+from utils.compressed_serde import CompressedSerializer, create_dictionary_table, load_dictionaries
+
+
+DB_PATH = "env_agent_checkpoint.db"
+PAGE_SIZE = 5
+
+
+class LazyStory:
+    '''
+    Read-only view of a stored story that loads scenes on demand from the scene index.
+    Everything but the scenes (goal, characters, entities, current scene) comes from the story index
+    header, so opening a story costs the same for any number of scenes.
+    '''
+
+    def __init__(self, saver: "StorySaver", thread_id: str):
+        self.saver = saver
+        self.thread_id = thread_id
+        self._header = None
+        self._scene_count = None
+
+    @property
+    def header(self) -> dict:
+        if self._header is None:
+            self._header = self.saver.story_header(self.thread_id)
+        return self._header
+
+    def __len__(self) -> int:
+        if self._scene_count is None:
+            self._scene_count = self.saver.visible_scene_count(self.thread_id)
+        return self._scene_count
+
+    def page_count(self, page_size: int = PAGE_SIZE) -> int:
+        return max(1, -(-len(self) // page_size))
+
+    def scenes(self, offset: int = 0, limit: Optional[int] = None) -> list:
+        return self.saver.load_scenes(self.thread_id, offset, limit)
+
+    def page(self, page: int, page_size: int = PAGE_SIZE) -> list:
+        '''
+        Scenes of a 0 based page.
+        '''
+        return self.scenes(page * page_size, page_size)
+
+    def scene(self, position: int):
+        scenes = self.scenes(position, 1)
+        if not scenes:
+            raise IndexError(f"Story {self.thread_id} has no scene at position {position}")
+        return scenes[0]
+
+
+class StorySaver(SqliteSaver):
+    '''
+    SqliteSaver with copy-on-write story forks.
+
+    A fork is a single row in story_forks pointing at a checkpoint of the source thread. Until the
+    fork writes its own checkpoints, reads fall through to the source thread, and its history always
+    continues into the source history up to the fork point. Nothing is copied, so forking costs the
+    same for any story length, and the two threads continue independently.
+
+    Checkpoints, writes and the story index are compressed with CHECKPOINT_COMPRESSION (see
+    utils/compressed_serde.py), rows written before are read as they are.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        if kwargs.get("serde") is None:
+            kwargs["serde"] = CompressedSerializer()
+        super().__init__(*args, **kwargs)
+        # thread_id -> number of scenes already in story_scenes
+        self._scene_counts = {}
+        self._inner_serde = getattr(self.serde, "inner", self.serde)
+
+    def setup(self) -> None:
+        if self.is_setup:
+            return
+        super().setup()
+        indexed = self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'story_index'").fetchone()
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS story_forks (
+                thread_id TEXT PRIMARY KEY,
+                source_thread_id TEXT NOT NULL,
+                source_checkpoint_ns TEXT NOT NULL DEFAULT '',
+                source_checkpoint_id TEXT NOT NULL,
+                created_at TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS story_index (
+                thread_id TEXT PRIMARY KEY,
+                checkpoint_id TEXT NOT NULL,
+                scene_count INTEGER NOT NULL,
+                is_main_goal_achieved INTEGER NOT NULL,
+                main_goal TEXT,
+                updated_at TEXT NOT NULL,
+                header_type TEXT,
+                header BLOB
+            );
+            CREATE INDEX IF NOT EXISTS story_index_updated_at ON story_index (updated_at);
+            CREATE TABLE IF NOT EXISTS story_fields (
+                thread_id TEXT NOT NULL,
+                field TEXT NOT NULL,
+                digest TEXT NOT NULL,
+                type TEXT,
+                value BLOB,
+                PRIMARY KEY (thread_id, field)
+            );
+            CREATE TABLE IF NOT EXISTS story_scenes (
+                thread_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                checkpoint_id TEXT NOT NULL,
+                type TEXT,
+                scene BLOB,
+                PRIMARY KEY (thread_id, position)
+            );
+            """
+        )
+        create_dictionary_table(self.conn)
+        self.conn.commit()
+        if isinstance(self.serde, CompressedSerializer):
+            self.serde.use_dictionaries(load_dictionaries(self.conn))
+            # A dictionary trained while this saver is open is loaded on the first row that uses it
+            self.serde.dictionary_loader = lambda: load_dictionaries(self.conn)
+        if not indexed:
+            self._backfill_index()
+
+    def _backfill_index(self):
+        '''
+        One time indexing of stories written before the index existed, from their latest checkpoint.
+        '''
+        threads = self.conn.execute(
+            "SELECT thread_id, MAX(checkpoint_id) FROM checkpoints WHERE checkpoint_ns = '' GROUP BY thread_id"
+        ).fetchall()
+        cur = self.conn.cursor()
+        for thread_id, checkpoint_id in threads:
+            type, checkpoint = cur.execute(
+                "SELECT type, checkpoint FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = '' AND checkpoint_id = ?",
+                (thread_id, checkpoint_id),
+            ).fetchone()
+            self._index_checkpoint(cur, thread_id, self.serde.loads_typed((type, checkpoint)))
+        self.conn.commit()
+        cur.close()
+        if threads:
+            print(f"Indexed {len(threads)} existing stories.")
+
+    def put(self, config: RunnableConfig, checkpoint, metadata, new_versions) -> RunnableConfig:
+        thread_id = str(config["configurable"]["thread_id"])
+        checkpoint_ns = config["configurable"].get("checkpoint_ns", "")
+        parent_id = config["configurable"].get("checkpoint_id")
+        type_, serialized_checkpoint = self.serde.dumps_typed(checkpoint)
+        serialized_metadata = json.dumps(get_checkpoint_metadata(config, metadata), ensure_ascii=False).encode("utf-8", "ignore")
+        # The checkpoint row and the story index are written in one transaction, a crash leaves both or neither
+        with self.cursor() as cur:
+            try:
+                cur.execute(
+                    "INSERT OR REPLACE INTO checkpoints (thread_id, checkpoint_ns, checkpoint_id, parent_checkpoint_id, type, checkpoint, metadata) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (thread_id, checkpoint_ns, checkpoint["id"], parent_id, type_, serialized_checkpoint, serialized_metadata),
+                )
+                # Only the story graph itself is indexed, not the character subgraph checkpoints
+                if checkpoint_ns == "":
+                    self._index_checkpoint(cur, thread_id, checkpoint)
+            except BaseException:
+                self.conn.rollback()
+                self._scene_counts.pop(thread_id, None)
+                raise
+        return {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint["id"]}}
+
+    def _index_checkpoint(self, cur, thread_id: str, checkpoint: dict):
+        '''
+        Updates the story index row and appends the scenes completed since the last indexed checkpoint.
+        Scenes are append only, so each scene is serialized once. The other state fields are stored
+        per field and only rewritten when their content changed.
+        '''
+        values = checkpoint.get("channel_values", {})
+        scenes = values.get("scenes") or []
+
+        known = self._scene_counts.get(thread_id)
+        if known is None:
+            known = self._visible_scene_count(cur, thread_id)
+        if len(scenes) < known:
+            # The story was restarted on the same thread. Forks read the scenes they share with it from its rows,
+            # the ones up to their fork point are copied to them first, with their checkpoint ids
+            cur.execute(
+                """
+                INSERT OR IGNORE INTO story_scenes (thread_id, position, checkpoint_id, type, scene)
+                SELECT story_forks.thread_id, story_scenes.position, story_scenes.checkpoint_id, story_scenes.type, story_scenes.scene
+                FROM story_forks JOIN story_scenes ON story_scenes.thread_id = story_forks.source_thread_id
+                    AND story_scenes.checkpoint_id <= story_forks.source_checkpoint_id
+                WHERE story_forks.source_thread_id = ? AND story_scenes.position >= ?
+                """,
+                (thread_id, len(scenes)),
+            )
+            cur.execute("DELETE FROM story_scenes WHERE thread_id = ? AND position >= ?", (thread_id, len(scenes)))
+            known = len(scenes)
+        for position in range(known, len(scenes)):
+            type, scene = self.serde.dumps_typed(scenes[position])
+            cur.execute(
+                "INSERT OR REPLACE INTO story_scenes (thread_id, position, checkpoint_id, type, scene) VALUES (?, ?, ?, ?, ?)",
+                (thread_id, position, checkpoint["id"], type, scene),
+            )
+        self._scene_counts[thread_id] = len(scenes)
+
+        cur.execute("SELECT field, digest FROM story_fields WHERE thread_id = ?", (thread_id,))
+        stored = dict(cur.fetchall())
+        for field, value in values.items():
+            if field == "scenes":
+                continue
+            # Fields are compared on their plain payload, only changed ones are compressed and written.
+            # Channel versions can not tell, the characters are updated in place between versions
+            field_type, data = self._inner_serde.dumps_typed(value)
+            digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+            if stored.get(field) == digest:
+                continue
+            if isinstance(self.serde, CompressedSerializer):
+                field_type, data = self.serde.compress_typed(field_type, data)
+            cur.execute(
+                "INSERT OR REPLACE INTO story_fields (thread_id, field, digest, type, value) VALUES (?, ?, ?, ?, ?)",
+                (thread_id, field, digest, field_type, data),
+            )
+        fields = [field for field in values if field != "scenes"]
+        cur.execute(
+            f"DELETE FROM story_fields WHERE thread_id = ? AND field NOT IN ({', '.join('?' * len(fields))})",
+            (thread_id, *fields),
+        )
+
+        # Rows indexed before story_fields existed carry the whole header, it is dropped on their next update
+        cur.execute(
+            """
+            INSERT INTO story_index (thread_id, checkpoint_id, scene_count, is_main_goal_achieved, main_goal, updated_at, header_type, header)
+            VALUES (?, ?, ?, ?, ?, ?, NULL, NULL)
+            ON CONFLICT (thread_id) DO UPDATE SET checkpoint_id = excluded.checkpoint_id, scene_count = excluded.scene_count,
+                is_main_goal_achieved = excluded.is_main_goal_achieved, main_goal = excluded.main_goal,
+                updated_at = excluded.updated_at, header_type = NULL, header = NULL
+            """,
+            (thread_id, checkpoint["id"], len(scenes), int(bool(values.get("is_main_goal_achieved"))),
+             values.get("main_goal"), checkpoint.get("ts") or datetime.now(timezone.utc).isoformat()),
+        )
+
+    def _visible_scene_count(self, cur, thread_id: str, upto: Optional[str] = None) -> int:
+        cur.execute(
+            "SELECT MAX(position) FROM story_scenes WHERE thread_id = ? AND (? IS NULL OR checkpoint_id <= ?)",
+            (thread_id, upto, upto),
+        )
+        last = cur.fetchone()[0]
+        count = last + 1 if last is not None else 0
+        # A fork also sees the scenes its source completed up to the fork point
+        cur.execute("SELECT source_thread_id, source_checkpoint_id FROM story_forks WHERE thread_id = ?", (thread_id,))
+        row = cur.fetchone()
+        if row is not None:
+            fork_point = row[1] if upto is None else min(upto, row[1])
+            count = max(count, self._visible_scene_count(cur, row[0], fork_point))
+        return count
+
+    def visible_scene_count(self, thread_id: str) -> int:
+        with self.cursor(transaction=False) as cur:
+            return self._visible_scene_count(cur, thread_id)
+
+    def load_scenes(self, thread_id: str, offset: int = 0, limit: Optional[int] = None) -> list:
+        '''
+        Completed scenes of a story by position, following forks into their source.
+        '''
+        end = offset + limit if limit is not None else None
+        scenes = {}
+        upto = None
+        with self.cursor(transaction=False) as cur:
+            while thread_id is not None:
+                cur.execute(
+                    "SELECT position, type, scene FROM story_scenes WHERE thread_id = ? AND position >= ? AND (? IS NULL OR position < ?) AND (? IS NULL OR checkpoint_id <= ?) ORDER BY position",
+                    (thread_id, offset, end, end, upto, upto),
+                )
+                for position, type, scene in cur.fetchall():
+                    # Own scenes win over inherited ones at the same position
+                    scenes.setdefault(position, (type, scene))
+                cur.execute("SELECT source_thread_id, source_checkpoint_id FROM story_forks WHERE thread_id = ?", (thread_id,))
+                row = cur.fetchone()
+                if row is None:
+                    break
+                thread_id = row[0]
+                upto = row[1] if upto is None else min(upto, row[1])
+        return [self.serde.loads_typed(scenes[position]) for position in sorted(scenes)]
+
+    def story_header(self, thread_id: str) -> dict:
+        '''
+        Latest story state without the scenes.
+        '''
+        with self.cursor(transaction=False) as cur:
+            cur.execute("SELECT field, type, value FROM story_fields WHERE thread_id = ?", (thread_id,))
+            fields = cur.fetchall()
+            cur.execute("SELECT header_type, header FROM story_index WHERE thread_id = ?", (thread_id,))
+            row = cur.fetchone()
+        if fields:
+            return {field: self.serde.loads_typed((type, value)) for field, type, value in fields}
+        if row is not None and row[0] is not None:
+            return self.serde.loads_typed(row)
+        # Forks that have not been continued yet, and stories from before the index
+        checkpoint_tuple = self.get_tuple({"configurable": {"thread_id": thread_id, "checkpoint_ns": ""}})
+        if checkpoint_tuple is None:
+            return {}
+        return {key: value for key, value in checkpoint_tuple.checkpoint["channel_values"].items() if key != "scenes"}
+
+    def open_story(self, thread_id: str) -> LazyStory:
+        return LazyStory(self, thread_id)
+
+    def story_exists(self, thread_id: str) -> bool:
+        '''
+        Index lookup, nothing is deserialized.
+        '''
+        with self.cursor(transaction=False) as cur:
+            cur.execute(
+                """
+                SELECT 1 FROM story_index WHERE thread_id = ?
+                UNION ALL SELECT 1 FROM story_forks WHERE thread_id = ?
+                UNION ALL SELECT 1 FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ''
+                LIMIT 1
+                """,
+                (thread_id, thread_id, thread_id),
+            )
+            return cur.fetchone() is not None
+
+    def list_stories(self, limit: int = 50, offset: int = 0) -> List[dict]:
+        '''
+        Story index rows, most recently updated first. Forks that have not been continued yet are listed
+        with the state of their fork point.
+        '''
+        with self.cursor(transaction=False) as cur:
+            cur.execute(
+                """
+                SELECT thread_id, checkpoint_id, scene_count, is_main_goal_achieved, main_goal, updated_at, NULL FROM story_index
+                UNION ALL
+                SELECT thread_id, source_checkpoint_id, NULL, 0, NULL, created_at, source_thread_id FROM story_forks
+                WHERE thread_id NOT IN (SELECT thread_id FROM story_index)
+                ORDER BY 6 DESC LIMIT ? OFFSET ?
+                """,
+                (limit, offset),
+            )
+            rows = cur.fetchall()
+            stories = []
+            for thread_id, checkpoint_id, scene_count, achieved, main_goal, updated_at, source_thread_id in rows:
+                if scene_count is None:
+                    scene_count = self._visible_scene_count(cur, thread_id)
+                stories.append({
+                    "thread_id": thread_id,
+                    "checkpoint_id": checkpoint_id,
+                    "scene_count": scene_count,
+                    "is_main_goal_achieved": bool(achieved),
+                    "main_goal": main_goal,
+                    "updated_at": updated_at,
+                    "forked_from": source_thread_id,
+                })
+        return stories
+
+    def story_count(self) -> int:
+        with self.cursor(transaction=False) as cur:
+            cur.execute("SELECT (SELECT COUNT(*) FROM story_index) + (SELECT COUNT(*) FROM story_forks WHERE thread_id NOT IN (SELECT thread_id FROM story_index))")
+            return cur.fetchone()[0]
+
+    def get_fork(self, thread_id: str) -> Optional[dict]:
+        with self.cursor(transaction=False) as cur:
+            cur.execute(
+                "SELECT source_thread_id, source_checkpoint_ns, source_checkpoint_id, created_at FROM story_forks WHERE thread_id = ?",
+                (thread_id,),
+            )
+            row = cur.fetchone()
+        if row is None:
+            return None
+        return {
+            "thread_id": thread_id,
+            "source_thread_id": row[0],
+            "source_checkpoint_ns": row[1],
+            "source_checkpoint_id": row[2],
+            "created_at": row[3],
+        }
+
+    def fork(self, source_thread_id: str, checkpoint_id: Optional[str] = None, thread_id: Optional[str] = None,
+             checkpoint_ns: str = "") -> str:
+        '''
+        Creates a new thread continuing from a checkpoint of the source thread (its latest by default)
+        and returns its thread id.
+        '''
+        source_checkpoint_id = self._resolve_checkpoint_id(source_thread_id, checkpoint_ns, checkpoint_id)
+        if source_checkpoint_id is None:
+            raise ValueError(f"No checkpoint {checkpoint_id or '(latest)'} found for thread {source_thread_id}")
+
+        thread_id = thread_id or f"{source_thread_id}_fork_{uuid.uuid4().hex[:8]}"
+        with self.cursor() as cur:
+            cur.execute("SELECT 1 FROM checkpoints WHERE thread_id = ? LIMIT 1", (thread_id,))
+            if cur.fetchone():
+                raise ValueError(f"Thread {thread_id} already exists")
+            cur.execute(
+                "INSERT INTO story_forks (thread_id, source_thread_id, source_checkpoint_ns, source_checkpoint_id, created_at) VALUES (?, ?, ?, ?, ?)",
+                (thread_id, source_thread_id, checkpoint_ns, source_checkpoint_id, datetime.now(timezone.utc).isoformat()),
+            )
+        return thread_id
+
+    def _resolve_checkpoint_id(self, thread_id: str, checkpoint_ns: str, checkpoint_id: Optional[str]) -> Optional[str]:
+        '''
+        Id of the given (or latest) checkpoint visible in the thread, without loading it.
+        '''
+        with self.cursor(transaction=False) as cur:
+            while True:
+                cur.execute(
+                    "SELECT checkpoint_id FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND (? IS NULL OR checkpoint_id = ?) ORDER BY checkpoint_id DESC LIMIT 1",
+                    (thread_id, checkpoint_ns, checkpoint_id, checkpoint_id),
+                )
+                row = cur.fetchone()
+                if row is not None:
+                    return row[0]
+                cur.execute("SELECT source_thread_id, source_checkpoint_ns, source_checkpoint_id FROM story_forks WHERE thread_id = ?", (thread_id,))
+                fork = cur.fetchone()
+                if fork is None or fork[1] != checkpoint_ns or (checkpoint_id and checkpoint_id > fork[2]):
+                    return None
+                thread_id, checkpoint_id = fork[0], checkpoint_id or fork[2]
+
+    def _as_fork(self, source: CheckpointTuple, thread_id: str, own_writes: bool) -> CheckpointTuple:
+        '''
+        Presents a source checkpoint as a checkpoint of the fork thread.
+        '''
+        checkpoint_ns = source.config["configurable"]["checkpoint_ns"]
+        checkpoint_id = source.config["configurable"]["checkpoint_id"]
+        config = {"configurable": {"thread_id": thread_id, "checkpoint_ns": checkpoint_ns, "checkpoint_id": checkpoint_id}}
+        parent_config = None
+        if source.parent_config:
+            parent_config = {"configurable": {**source.parent_config["configurable"], "thread_id": thread_id}}
+
+        # The fork continues fresh from the checkpoint, only writes made by the fork itself are pending
+        pending_writes = []
+        if own_writes:
+            with self.cursor(transaction=False) as cur:
+                cur.execute(
+                    "SELECT task_id, channel, type, value FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ? ORDER BY task_id, idx",
+                    (thread_id, checkpoint_ns, checkpoint_id),
+                )
+                pending_writes = [(task_id, channel, self.serde.loads_typed((type, value))) for task_id, channel, type, value in cur.fetchall()]
+
+        return CheckpointTuple(config, source.checkpoint, source.metadata, parent_config, pending_writes)
+
+    def get_tuple(self, config: RunnableConfig) -> Optional[CheckpointTuple]:
+        checkpoint_tuple = super().get_tuple(config)
+        if checkpoint_tuple is not None:
+            return checkpoint_tuple
+
+        thread_id = str(config["configurable"]["thread_id"])
+        fork = self.get_fork(thread_id)
+        # Subgraph checkpoints (other namespaces) are never shared
+        if fork is None or config["configurable"].get("checkpoint_ns", "") != fork["source_checkpoint_ns"]:
+            return None
+
+        checkpoint_id = get_checkpoint_id(config)
+        # Checkpoint ids are time ordered, everything after the fork point belongs to the fork only
+        if checkpoint_id and checkpoint_id > fork["source_checkpoint_id"]:
+            return None
+        source = self.get_tuple({"configurable": {
+            "thread_id": fork["source_thread_id"],
+            "checkpoint_ns": fork["source_checkpoint_ns"],
+            "checkpoint_id": checkpoint_id or fork["source_checkpoint_id"],
+        }})
+        if source is None:
+            return None
+        return self._as_fork(source, thread_id, own_writes=checkpoint_id in (None, fork["source_checkpoint_id"]))
+
+    def list(self, config: Optional[RunnableConfig], *, filter=None, before: Optional[RunnableConfig] = None,
+             limit: Optional[int] = None) -> Iterator[CheckpointTuple]:
+        count = 0
+        for checkpoint_tuple in super().list(config, filter=filter, before=before, limit=limit):
+            count += 1
+            yield checkpoint_tuple
+
+        if config is None or (limit is not None and count >= limit):
+            return
+        thread_id = str(config["configurable"]["thread_id"])
+        fork = self.get_fork(thread_id)
+        if fork is None or config["configurable"].get("checkpoint_ns", fork["source_checkpoint_ns"]) != fork["source_checkpoint_ns"]:
+            return
+
+        # Continue with the source history from the fork point down
+        fork_point = fork["source_checkpoint_id"]
+        source_before = {"configurable": {"checkpoint_id": fork_point}}
+        if before is not None and get_checkpoint_id(before) and get_checkpoint_id(before) <= fork_point:
+            source_before = before
+        else:
+            source = self.get_tuple({"configurable": {"thread_id": thread_id, "checkpoint_ns": fork["source_checkpoint_ns"], "checkpoint_id": fork_point}})
+            if source is not None and (not filter or all(source.metadata.get(key) == value for key, value in filter.items())):
+                count += 1
+                yield source
+        if limit is not None and count >= limit:
+            return
+
+        source_config = {"configurable": {"thread_id": fork["source_thread_id"], "checkpoint_ns": fork["source_checkpoint_ns"]}}
+        remaining = None if limit is None else limit - count
+        for source in self.list(source_config, filter=filter, before=source_before, limit=remaining):
+            yield self._as_fork(source, thread_id, own_writes=False)
+
+    def thread_ids(self) -> List[str]:
+        '''
+        All stories, including forks that have not written a checkpoint yet.
+        '''
+        with self.cursor(transaction=False) as cur:
+            cur.execute("SELECT thread_id FROM checkpoints UNION SELECT thread_id FROM story_forks ORDER BY thread_id DESC")
+            return [row[0] for row in cur.fetchall()]
+
+    def checkpoint_history(self, thread_id: str, checkpoint_ns: str = "") -> List[dict]:
+        '''
+        Checkpoint ids with their step and source, newest first, following forks into their source.
+        Reads the metadata only, the checkpoints are not deserialized.
+        '''
+        history = []
+        before = None
+        while thread_id is not None:
+            with self.cursor(transaction=False) as cur:
+                cur.execute(
+                    "SELECT checkpoint_id, metadata FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND (? IS NULL OR checkpoint_id <= ?) ORDER BY checkpoint_id DESC",
+                    (thread_id, checkpoint_ns, before, before),
+                )
+                rows = cur.fetchall()
+            for checkpoint_id, metadata in rows:
+                metadata = json.loads(metadata) if metadata is not None else {}
+                history.append({"checkpoint_id": checkpoint_id, "step": metadata.get("step"), "source": metadata.get("source"), "thread_id": thread_id})
+
+            fork = self.get_fork(thread_id)
+            if fork is None or fork["source_checkpoint_ns"] != checkpoint_ns:
+                break
+            thread_id, before = fork["source_thread_id"], fork["source_checkpoint_id"]
+        return history
+
+    def delete_thread(self, thread_id: str) -> None:
+        with self.cursor(transaction=False) as cur:
+            cur.execute("SELECT thread_id FROM story_forks WHERE source_thread_id = ?", (str(thread_id),))
+            forks = [row[0] for row in cur.fetchall()]
+        if forks:
+            raise ValueError(f"Thread {thread_id} is the source of forks {forks}, delete them first")
+        super().delete_thread(thread_id)
+        with self.cursor() as cur:
+            for table in ("story_forks", "story_index", "story_scenes", "story_fields"):
+                cur.execute(f"DELETE FROM {table} WHERE thread_id = ?", (str(thread_id),))
+        self._scene_counts.pop(str(thread_id), None)
+
+
+def fork_story(source_thread_id: str, checkpoint_id: Optional[str] = None, thread_id: Optional[str] = None,
+               db_path: str = DB_PATH) -> str:
+    '''
+    Forks a stored story, see StorySaver.fork.
+    '''
+    with StorySaver.from_conn_string(db_path) as saver:
+        return saver.fork(source_thread_id, checkpoint_id=checkpoint_id, thread_id=thread_id)
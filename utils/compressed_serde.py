@@ -0,0 +1,199 @@
+import importlib.util
+import os
+import sqlite3
+import threading
+import zlib
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from langgraph.checkpoint.serde.jsonplus import JsonPlusSerializer
+
+
+# CHECKPOINT_COMPRESSION=none|zlib|zstd picks the codec new checkpoint rows are written with,
+# zstd when zstandard is installed (langsmith depends on it), zlib otherwise
+COMPRESSION = os.getenv("CHECKPOINT_COMPRESSION") or ("zstd" if importlib.util.find_spec("zstandard") else "zlib")
+COMPRESSION_LEVEL = int(os.getenv("CHECKPOINT_COMPRESSION_LEVEL", "0")) or None
+CODECS = ("none", "zlib", "zstd")
+DEFAULT_LEVELS = {"zlib": 3, "zstd": 3}
+# Payloads below this are stored as they are, the codec header would cost more than it saves
+MIN_SIZE = 256
+FORMAT_VERSION = 1
+DICTIONARY_SIZE = 112_640
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError as error:
+        raise ImportError("CHECKPOINT_COMPRESSION=zstd needs the zstandard package (pip install zstandard)") from error
+    return zstandard
+
+
+class CompressedSerializer:
+    '''
+    Serializer wrapper for the checkpointer that compresses the payloads of the inner serializer.
+
+    The codec is recorded in the type column: "msgpack" becomes "msgpack+zlib.v1", or "msgpack+zstd.v1.d3"
+    when compressed with the zstd dictionary 3 of the database. Types without a suffix are read as the
+    plain payloads of the inner serializer, so rows written before compression stay readable, and rows
+    of any codec can be mixed in one database.
+    '''
+
+    def __init__(self, codec: str = COMPRESSION, level: Optional[int] = COMPRESSION_LEVEL, inner=None):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown checkpoint compression {codec}, expected one of {CODECS}")
+        if codec == "zstd":
+            _zstd()
+        self.codec = codec
+        self.level = level or DEFAULT_LEVELS.get(codec)
+        self.inner = inner or JsonPlusSerializer()
+        # dictionary id -> trained zstd dictionary, the newest one compresses
+        self.dictionaries: Dict[int, bytes] = {}
+        self.dictionary_id: Optional[int] = None
+        # Reads the dictionaries of the database again when a row names one that is not loaded,
+        # e.g. trained while this process was running
+        self.dictionary_loader: Optional[Callable[[], Dict[int, bytes]]] = None
+        # zstd compressor objects must not be shared between threads
+        self._local = threading.local()
+
+    def use_dictionaries(self, dictionaries: Dict[int, bytes]):
+        if not dictionaries:
+            return
+        self.dictionaries = dict(dictionaries)
+        self.dictionary_id = max(self.dictionaries)
+        self._local = threading.local()
+
+    def _dictionary(self, dict_id: Optional[int]):
+        if dict_id is None:
+            return None
+        if dict_id not in self.dictionaries and self.dictionary_loader is not None:
+            self.use_dictionaries(self.dictionary_loader())
+        if dict_id not in self.dictionaries:
+            raise ValueError(f"Checkpoint compressed with zstd dictionary {dict_id}, which is not in this database")
+        return _zstd().ZstdCompressionDict(self.dictionaries[dict_id])
+
+    def _compressor(self):
+        compressor = getattr(self._local, "compressor", None)
+        if compressor is None:
+            compressor = _zstd().ZstdCompressor(level=self.level, dict_data=self._dictionary(self.dictionary_id))
+            self._local.compressor = compressor
+        return compressor
+
+    def _decompressor(self, dict_id: Optional[int]):
+        decompressors = getattr(self._local, "decompressors", None)
+        if decompressors is None:
+            decompressors = self._local.decompressors = {}
+        if dict_id not in decompressors:
+            decompressors[dict_id] = _zstd().ZstdDecompressor(dict_data=self._dictionary(dict_id))
+        return decompressors[dict_id]
+
+    def dumps_typed(self, obj) -> Tuple[str, bytes]:
+        return self.compress_typed(*self.inner.dumps_typed(obj))
+
+    def compress_typed(self, type: str, data: bytes) -> Tuple[str, bytes]:
+        '''
+        Compresses a payload already serialized by the inner serializer.
+        '''
+        if self.codec == "none" or len(data) < MIN_SIZE:
+            return type, data
+        if self.codec == "zlib":
+            return f"{type}+zlib.v{FORMAT_VERSION}", zlib.compress(data, self.level)
+        suffix = f".d{self.dictionary_id}" if self.dictionary_id is not None else ""
+        return f"{type}+zstd.v{FORMAT_VERSION}{suffix}", self._compressor().compress(data)
+
+    def loads_typed(self, data: Tuple[str, bytes]):
+        type, payload = data
+        if "+" not in type:
+            return self.inner.loads_typed((type, payload))
+        type, _, codec = type.rpartition("+")
+        name, version, *options = codec.split(".")
+        if version != f"v{FORMAT_VERSION}":
+            raise ValueError(f"Unsupported checkpoint compression format {codec}")
+        if name == "zlib":
+            payload = zlib.decompress(payload)
+        elif name == "zstd":
+            dict_id = int(options[0][1:]) if options else None
+            payload = self._decompressor(dict_id).decompress(payload)
+        else:
+            raise ValueError(f"Unknown checkpoint compression {codec}")
+        return self.inner.loads_typed((type, payload))
+
+
+# ---- Dictionaries, stored in the checkpoint database they were trained on ----
+
+def create_dictionary_table(conn: sqlite3.Connection):
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS serde_dictionaries (
+            dict_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL,
+            samples INTEGER NOT NULL,
+            created_at TEXT NOT NULL
+        )
+        """
+    )
+
+
+def load_dictionaries(conn: sqlite3.Connection) -> Dict[int, bytes]:
+    # Databases written before dictionaries existed have no table, e.g. when opened read-only
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'serde_dictionaries'").fetchone():
+        return {}
+    return dict(conn.execute("SELECT dict_id, data FROM serde_dictionaries").fetchall())
+
+
+def raw_payloads(conn: sqlite3.Connection, serde: CompressedSerializer, limit: Optional[int] = None) -> List[bytes]:
+    '''
+    Uncompressed inner payloads of the stored checkpoints, newest first.
+    '''
+    rows = conn.execute("SELECT type, checkpoint FROM checkpoints ORDER BY checkpoint_id DESC LIMIT ?", (limit or -1,)).fetchall()
+    rows += conn.execute("SELECT type, value FROM writes ORDER BY checkpoint_id DESC LIMIT ?", (limit or -1,)).fetchall()
+    payloads = []
+    for type, data in rows:
+        if type is None:
+            continue
+        if "+" in type:
+            data = serde.inner.dumps_typed(serde.loads_typed((type, data)))[1]
+        payloads.append(data)
+    return payloads
+
+
+def train_dictionary(conn: sqlite3.Connection, size: int = DICTIONARY_SIZE, limit: Optional[int] = 2000) -> int:
+    '''
+    Trains a zstd dictionary on the stored checkpoints and adds it to the database, new rows written
+    with zstd use it from then on. Earlier dictionaries are kept for the rows compressed with them.
+    '''
+    zstandard = _zstd()
+    create_dictionary_table(conn)
+    # Rows written with an earlier dictionary are decoded with it, a dictionary can be retrained on them
+    serde = CompressedSerializer("none")
+    serde.use_dictionaries(load_dictionaries(conn))
+    samples = [payload for payload in raw_payloads(conn, serde, limit) if len(payload) >= MIN_SIZE]
+    if len(samples) < 8:
+        raise ValueError(f"Only {len(samples)} checkpoints to train on, run a story first")
+    dictionary = zstandard.train_dictionary(size, samples)
+    cur = conn.execute(
+        "INSERT INTO serde_dictionaries (data, samples, created_at) VALUES (?, ?, ?)",
+        (dictionary.as_bytes(), len(samples), datetime.now(timezone.utc).isoformat()),
+    )
+    conn.commit()
+    return cur.lastrowid
+
+
+def main():
+    import argparse
+
+    from utils.checkpointer import DB_PATH
+
+    parser = argparse.ArgumentParser(description="Train a zstd dictionary for CHECKPOINT_COMPRESSION=zstd on the stored checkpoints.")
+    parser.add_argument("--db", default=DB_PATH)
+    parser.add_argument("--size", type=int, default=DICTIONARY_SIZE, help="Dictionary size in bytes")
+    parser.add_argument("--limit", type=int, default=2000, help="Most recent checkpoints and writes to sample")
+    args = parser.parse_args()
+
+    with sqlite3.connect(args.db) as conn:
+        dict_id = train_dictionary(conn, args.size, args.limit)
+    print(f"Trained dictionary {dict_id} on {args.db}, used by CHECKPOINT_COMPRESSION=zstd from now on.")
+
+
+if __name__ == "__main__":
+    main()
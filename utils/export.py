@@ -0,0 +1,305 @@
+import argparse
+import json
+import os
+import sqlite3
+from datetime import datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from pydantic_bp.core import character_table
+from utils.checkpointer import StorySaver
+
+
+DB_PATH = "env_agent_checkpoint.db"
+EXPORT_STATE_FILE = ".export_state.json"
+TABLES = ["scenes", "moments", "situations", "character_stats"]
+FORMATS = ["jsonl", "parquet"]
+
+
+def iter_latest_checkpoints(conn: sqlite3.Connection) -> Iterator[Tuple[str, str]]:
+    """Yields (thread_id, latest checkpoint_id) for every story thread."""
+    cursor = conn.execute("""
+        SELECT thread_id, MAX(checkpoint_id) FROM checkpoints
+        WHERE checkpoint_ns = ''
+        GROUP BY thread_id
+        ORDER BY thread_id
+    """)
+    for thread_id, checkpoint_id in cursor:
+        yield thread_id, checkpoint_id
+
+
+def load_story(saver: StorySaver, thread_id: str, checkpoint_id: str) -> Optional[dict]:
+    """Deserializes a single checkpoint of a story, returns its channel values."""
+    checkpoint_tuple = saver.get_tuple({
+        "configurable": {
+            "thread_id": thread_id,
+            "checkpoint_ns": "",
+            "checkpoint_id": checkpoint_id,
+        }
+    })
+    if checkpoint_tuple is None:
+        return None
+    return checkpoint_tuple.checkpoint["channel_values"]
+
+
+def flatten_story(thread_id: str, checkpoint_id: str, state: dict) -> Dict[str, List[dict]]:
+    '''
+    Flattens one story state into rows of the scenes, moments, situations and character_stats tables.
+    '''
+    rows = {table: [] for table in TABLES}
+
+    stats = {}
+    for character in state.get("characters") or []:
+        stats[character.name] = {
+            "thread_id": thread_id,
+            "checkpoint_id": checkpoint_id,
+            "name": character.name,
+            "role": character.role,
+            "memory_factor": character.memory_factor,
+            "scenes_appeared": 0,
+            "lines_spoken": 0,
+            "actions_taken": 0,
+            "times_addressed": 0,
+            "shortterm_memory_size": len(character.shortterm_memory),
+            "longterm_memory_size": len(character.longterm_memory),
+        }
+
+    def character_stats(name: str) -> dict:
+        # Speakers can be missing from the roster when the LLM invents a name
+        if name not in stats:
+            stats[name] = {
+                "thread_id": thread_id,
+                "checkpoint_id": checkpoint_id,
+                "name": name,
+                "role": None,
+                "memory_factor": None,
+                "scenes_appeared": 0,
+                "lines_spoken": 0,
+                "actions_taken": 0,
+                "times_addressed": 0,
+                "shortterm_memory_size": 0,
+                "longterm_memory_size": 0,
+            }
+        return stats[name]
+
+    roster = character_table(state.get("characters") or [])
+    for scene in state.get("scenes") or []:
+        situation_count = 0
+        for moment in scene.moments:
+            for seq, situation in enumerate(moment.situations):
+                rows["situations"].append({
+                    "thread_id": thread_id,
+                    "checkpoint_id": checkpoint_id,
+                    "scene_no": scene.no,
+                    "moment_no": moment.no,
+                    "seq": seq,
+                    "who_said": situation.who_said,
+                    "who_listens": list(situation.who_listens),
+                    "dialogue": situation.dialogue,
+                    "action": situation.action,
+                })
+
+                speaker = character_stats(situation.who_said)
+                if situation.dialogue:
+                    speaker["lines_spoken"] += 1
+                if situation.action:
+                    speaker["actions_taken"] += 1
+                for listener in situation.who_listens:
+                    character_stats(listener)["times_addressed"] += 1
+
+            rows["moments"].append({
+                "thread_id": thread_id,
+                "checkpoint_id": checkpoint_id,
+                "scene_no": scene.no,
+                "moment_no": moment.no,
+                "situation_count": len(moment.situations),
+            })
+            situation_count += len(moment.situations)
+
+        character_names = [roster[ref].name if ref in roster else ref for ref in scene.character_ids]
+        for name in character_names:
+            character_stats(name)["scenes_appeared"] += 1
+
+        rows["scenes"].append({
+            "thread_id": thread_id,
+            "checkpoint_id": checkpoint_id,
+            "scene_no": scene.no,
+            "description": scene.description,
+            "characters": character_names,
+            "moment_count": len(scene.moments),
+            "situation_count": situation_count,
+        })
+
+    rows["character_stats"] = list(stats.values())
+    return rows
+
+
+class JsonlTableWriter:
+    """Appends rows of one table to a JSONL part file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+
+    def write(self, rows: List[dict]):
+        if not rows:
+            return
+        if self.file is None:
+            self.file = open(self.path, "w", encoding="utf-8")
+        for row in rows:
+            self.file.write(json.dumps(row, ensure_ascii=False))
+            self.file.write("\n")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class ParquetTableWriter:
+    """Writes rows of one table to a Parquet part file, one row group per story."""
+
+    def __init__(self, path: str):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("pyarrow is required for parquet export (pip install pyarrow)")
+
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = path
+        self.writer = None
+
+    def write(self, rows: List[dict]):
+        if not rows:
+            return
+        if self.writer is None:
+            table = self.pa.Table.from_pylist(rows)
+            self.writer = self.pq.ParquetWriter(self.path, table.schema)
+        else:
+            table = self.pa.Table.from_pylist(rows, schema=self.writer.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+WRITERS = {
+    "jsonl": JsonlTableWriter,
+    "parquet": ParquetTableWriter,
+}
+
+
+def load_export_state(out_dir: str) -> Dict[str, str]:
+    path = os.path.join(out_dir, EXPORT_STATE_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def save_export_state(out_dir: str, export_state: Dict[str, str]):
+    path = os.path.join(out_dir, EXPORT_STATE_FILE)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as file:
+        json.dump(export_state, file, indent=2)
+    os.replace(tmp_path, path)
+
+
+def export_stories(
+    db_path: str = DB_PATH,
+    out_dir: str = "exports",
+    formats: Optional[List[str]] = None,
+    incremental: bool = False,
+    include_incomplete: bool = False,
+) -> dict:
+    '''
+    Streams stories out of the checkpoint DB into flat analytics tables.
+
+    Stories are read one thread at a time, so memory stays bounded by the largest single story.
+    Every run writes a new part file per table and format (<out_dir>/<table>/part-<run_id>.<format>),
+    rows carry thread_id and checkpoint_id so consumers can keep the latest rows per thread.
+    With incremental=True only threads whose latest checkpoint changed since the last incremental run are
+    exported. A full export leaves that watermark as it is.
+    '''
+    formats = formats or ["jsonl"]
+    for fmt in formats:
+        if fmt not in WRITERS:
+            raise ValueError(f"Unknown export format: {fmt}")
+
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+    os.makedirs(out_dir, exist_ok=True)
+    export_state = load_export_state(out_dir) if incremental else {}
+
+    writers = {}
+    for table in TABLES:
+        os.makedirs(os.path.join(out_dir, table), exist_ok=True)
+        for fmt in formats:
+            writers[(table, fmt)] = WRITERS[fmt](os.path.join(out_dir, table, f"part-{run_id}.{fmt}"))
+
+    summary = {"run_id": run_id, "exported": 0, "skipped_unchanged": 0, "skipped_incomplete": 0, "rows": {table: 0 for table in TABLES}}
+
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    try:
+        threads = list(iter_latest_checkpoints(conn))
+        # StorySaver reads compressed checkpoint rows and follows story forks
+        saver = StorySaver(conn)
+
+        for thread_id, checkpoint_id in threads:
+            if incremental and export_state.get(thread_id) == checkpoint_id:
+                summary["skipped_unchanged"] += 1
+                continue
+
+            state = load_story(saver, thread_id, checkpoint_id)
+            if state is None:
+                continue
+
+            if not include_incomplete and not state.get("is_main_goal_achieved", False):
+                summary["skipped_incomplete"] += 1
+                continue
+
+            print(f"Exporting story {thread_id} ({checkpoint_id})...")
+            rows = flatten_story(thread_id, checkpoint_id, state)
+            for table in TABLES:
+                for fmt in formats:
+                    writers[(table, fmt)].write(rows[table])
+                summary["rows"][table] += len(rows[table])
+
+            export_state[thread_id] = checkpoint_id
+            summary["exported"] += 1
+
+            # Drop the deserialized story before loading the next one
+            del state, rows
+    finally:
+        for writer in writers.values():
+            writer.close()
+        conn.close()
+
+    if incremental:
+        save_export_state(out_dir, export_state)
+
+    print(f"Export completed. {summary['exported']} stories exported to {out_dir}.")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export stories from the checkpoint DB for offline analytics.")
+    parser.add_argument("--db", default=DB_PATH, help="Path to the checkpoint database.")
+    parser.add_argument("--out", default="exports", help="Output directory.")
+    parser.add_argument("--format", dest="formats", action="append", choices=FORMATS, help="Output format, can be repeated. Defaults to jsonl.")
+    parser.add_argument("--incremental", action="store_true", help="Only export threads changed since the last run.")
+    parser.add_argument("--all", dest="include_incomplete", action="store_true", help="Also export stories whose main goal is not achieved yet.")
+    args = parser.parse_args()
+
+    summary = export_stories(
+        db_path=args.db,
+        out_dir=args.out,
+        formats=args.formats,
+        incremental=args.incremental,
+        include_incomplete=args.include_incomplete,
+    )
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
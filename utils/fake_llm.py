@@ -0,0 +1,88 @@
+import os
+import threading
+import time
+import typing
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel
+
+
+# LLM_MODE=fake answers every call locally with a schema shaped response, for benchmarks and smoke tests
+FAKE_LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0"))
+# Yes/no answers (scene complete, goal achieved) turn true after this many calls per schema
+FAKE_TURNS = int(os.getenv("FAKE_LLM_TURNS", "3"))
+LIST_SIZE = 3
+
+
+class FakeLLM:
+    '''
+    Offline stand-in for a chat model, answers with_structured_output(schema).invoke(messages) from the
+    schema alone: strings name their field, lists have a few items, index lists point at the first items.
+    Deterministic, so runs with the same inputs produce the same story.
+    '''
+
+    def __init__(self, name: str, latency: float = FAKE_LATENCY, turns: int = FAKE_TURNS):
+        self.name = name
+        self.latency = latency
+        self.turns = turns
+        self.calls: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def with_structured_output(self, schema, **kwargs) -> "FakeRunnable":
+        return FakeRunnable(self, schema)
+
+    def count(self, schema_name: str) -> int:
+        with self._lock:
+            self.calls[schema_name] = self.calls.get(schema_name, 0) + 1
+            return self.calls[schema_name]
+
+
+class FakeRunnable:
+    def __init__(self, owner: FakeLLM, schema):
+        self.owner = owner
+        self.schema = schema
+
+    def invoke(self, messages, config=None, **kwargs):
+        call = self.owner.count(getattr(self.schema, "__name__", str(self.schema)))
+        if self.owner.latency:
+            time.sleep(self.owner.latency)
+        return fake_value(self.schema, "", call, call >= self.owner.turns)
+
+
+def fake_value(annotation, name: str, call: int, yes: bool) -> Any:
+    origin = typing.get_origin(annotation)
+    args = typing.get_args(annotation)
+
+    if origin is typing.Union:
+        return fake_value(next(arg for arg in args if arg is not type(None)), name, call, yes)
+    if origin in (list, List):
+        if args and args[0] is int:
+            return list(range(2))
+        return [fake_value(args[0] if args else str, f"{name} {i + 1}", call, yes) for i in range(LIST_SIZE)]
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return annotation.model_validate({
+            field: fake_value(info.annotation, _item_name(name, field), call, yes)
+            for field, info in annotation.model_fields.items()
+        })
+    if typing.is_typeddict(annotation):
+        return {
+            field: fake_value(hint, _item_name(name, field), call, yes)
+            for field, hint in typing.get_type_hints(annotation).items()
+        }
+    if annotation is bool:
+        return yes
+    if annotation is int:
+        return 0
+    if annotation is float:
+        return 0.5
+    if annotation is dict or origin is dict:
+        return {}
+    if name.endswith("name"):
+        # Names identify characters and entities across calls
+        return name
+    return f"{name} (call {call})" if name else f"call {call}"
+
+
+def _item_name(prefix: Optional[str], field: str) -> str:
+    # "characters 2" + "name" -> "characters 2 name", names stay unique across list items
+    return f"{prefix} {field}".strip()
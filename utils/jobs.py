@@ -0,0 +1,284 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Iterator, List, Optional
+
+from agents.env_agent import env_agent_workflow, initial_state
+from agents.start_agent import get_start_agent_app
+from utils.cancellation import STORY_TIMEOUT, DeadlineExceeded, StoryCancelled, cancel_story, story_run
+from utils.checkpointer import DB_PATH, StorySaver
+
+
+JOBS_DB = "jobs.db"
+# Stories generated at the same time by the whole server, and by a single user
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_USER_LIMIT = int(os.getenv("JOB_USER_LIMIT", "1"))
+
+FINISHED = ("done", "failed", "cancelled")
+_COLUMNS = ("job_id", "thread_id", "user_id", "status", "input_text", "error", "attempts", "created_at", "started_at", "finished_at")
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class JobService:
+    '''
+    Story generation jobs on a SQLite persisted queue, run by a bounded pool of worker threads.
+
+    submit() returns at once with a job_id and the thread_id of the story. A job is queued, running,
+    done, failed or cancelled. Workers take the oldest queued job whose user is under the per-user
+    limit, so one user cannot fill the pool. Every story checkpoints as it goes, so a job that was
+    running when the server stopped is queued again on start and continues from its last checkpoint.
+    '''
+
+    def __init__(self, db_path: str = JOBS_DB, checkpoint_db: str = DB_PATH, workers: int = JOB_WORKERS,
+                 user_limit: int = JOB_USER_LIMIT, recursion_limit: int = 50, story_timeout: Optional[float] = STORY_TIMEOUT):
+        self.workers = workers
+        self.user_limit = user_limit
+        self.recursion_limit = recursion_limit
+        self.story_timeout = story_timeout
+
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                job_id TEXT PRIMARY KEY,
+                thread_id TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                status TEXT NOT NULL,
+                input_text TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT NOT NULL,
+                started_at TEXT,
+                finished_at TEXT
+            );
+            CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+            CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_id, created_at);
+            """
+        )
+        self.conn.commit()
+
+        # One checkpointer and compiled graph for all workers, the saver serializes its DB access
+        self.saver = StorySaver(sqlite3.connect(checkpoint_db, check_same_thread=False))
+        self.app = env_agent_workflow.compile(checkpointer=self.saver)
+
+        self._wakeup = threading.Condition(self.lock)
+        self._threads: List[threading.Thread] = []
+        self._stopping = False
+        # Jobs a user asked to cancel, as opposed to stopping for a deadline or a shutdown
+        self._cancel_requested = set()
+
+    # ---- Queue ----
+
+    def _execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        cur = self.conn.execute(sql, params)
+        self.conn.commit()
+        return cur
+
+    def _row(self, row) -> Optional[dict]:
+        return dict(zip(_COLUMNS, row)) if row else None
+
+    def get(self, job_id: str) -> Optional[dict]:
+        '''
+        Job row with the progress of its story (completed scenes, goal achieved).
+        '''
+        with self.lock:
+            job = self._row(self.conn.execute(f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE job_id = ?", (job_id,)).fetchone())
+        if job is not None:
+            job["scene_count"] = self.saver.visible_scene_count(job["thread_id"])
+        return job
+
+    def list_jobs(self, user_id: Optional[str] = None, limit: int = 50) -> List[dict]:
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE (? IS NULL OR user_id = ?) ORDER BY created_at DESC LIMIT ?",
+                (user_id, user_id, limit),
+            ).fetchall()
+        return [self._row(row) for row in rows]
+
+    def thread_owner(self, thread_id: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute("SELECT user_id FROM jobs WHERE thread_id = ? ORDER BY created_at LIMIT 1", (thread_id,)).fetchone()
+        return row[0] if row else None
+
+    def active_job(self, thread_id: str) -> Optional[dict]:
+        '''
+        Queued or running job of the story, if any.
+        '''
+        with self.lock:
+            row = self.conn.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM jobs WHERE thread_id = ? AND status IN ('queued', 'running')", (thread_id,)
+            ).fetchone()
+        job = self._row(row)
+        if job is not None:
+            job["scene_count"] = self.saver.visible_scene_count(thread_id)
+        return job
+
+    def submit(self, user_id: str, input_text: Optional[str] = None, thread_id: Optional[str] = None) -> dict:
+        '''
+        Queues a story. Without a thread_id a new story is generated from input_text, with the thread_id of
+        a stored story it is continued from its last checkpoint.
+        '''
+        if not input_text and not thread_id:
+            raise ValueError("A job needs the story input or the thread_id of a story to continue")
+        job_id = uuid.uuid4().hex[:12]
+        thread_id = thread_id or f"story_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{job_id[:6]}"
+
+        with self.lock:
+            active = self.conn.execute(
+                "SELECT job_id FROM jobs WHERE thread_id = ? AND status IN ('queued', 'running')", (thread_id,)
+            ).fetchone()
+            if active:
+                raise ValueError(f"Story {thread_id} already has an active job {active[0]}")
+            self._execute(
+                "INSERT INTO jobs (job_id, thread_id, user_id, status, input_text, created_at) VALUES (?, ?, ?, 'queued', ?, ?)",
+                (job_id, thread_id, user_id, input_text, _now()),
+            )
+            self._wakeup.notify()
+        return self.get(job_id)
+
+    def cancel(self, job_id: str) -> bool:
+        '''
+        Cancels a queued job, or stops a running one at its next safe point. It can be resubmitted later.
+        '''
+        with self.lock:
+            row = self.conn.execute("SELECT thread_id, status FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None or row[1] in FINISHED:
+                return False
+            thread_id, status = row
+            if status == "queued":
+                self._execute("UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE job_id = ?", (_now(), job_id))
+                return True
+            self._cancel_requested.add(job_id)
+        cancel_story(thread_id, "cancelled")
+        return True
+
+    def watch(self, job_id: str, interval: float = 1.0) -> Iterator[dict]:
+        '''
+        Yields the job whenever its status or progress changes, until it is finished.
+        '''
+        last = None
+        while True:
+            job = self.get(job_id)
+            if job is None:
+                return
+            state = (job["status"], job["scene_count"])
+            if state != last:
+                last = state
+                yield job
+            if job["status"] in FINISHED:
+                return
+            time.sleep(interval)
+
+    def _claim(self) -> Optional[dict]:
+        # Called with the lock held
+        row = self.conn.execute(
+            f"""
+            SELECT {', '.join(_COLUMNS)} FROM jobs AS job WHERE status = 'queued'
+            AND (SELECT COUNT(*) FROM jobs AS other WHERE other.user_id = job.user_id AND other.status = 'running') < ?
+            ORDER BY created_at LIMIT 1
+            """,
+            (self.user_limit,),
+        ).fetchone()
+        if row is None:
+            return None
+        job = self._row(row)
+        self._execute(
+            "UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1 WHERE job_id = ?",
+            (_now(), job["job_id"]),
+        )
+        return job
+
+    def _finish(self, job_id: str, status: str, error: Optional[str] = None):
+        with self.lock:
+            self._cancel_requested.discard(job_id)
+            finished_at = None if status == "queued" else _now()
+            self._execute("UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE job_id = ?", (status, error, finished_at, job_id))
+            # A user slot is free again
+            self._wakeup.notify_all()
+
+    # ---- Workers ----
+
+    def start(self) -> "JobService":
+        '''
+        Requeues the jobs that were running when the server stopped and starts the workers.
+        '''
+        with self.lock:
+            resumed = self._execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'").rowcount
+        if resumed:
+            print(f"Resuming {resumed} interrupted jobs from their checkpoints.")
+
+        self._stopping = False
+        for index in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"story-worker-{index}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, timeout: Optional[float] = None):
+        '''
+        Stops running stories at their next safe point and requeues them, they continue on the next start.
+        '''
+        with self.lock:
+            self._stopping = True
+            running = self.conn.execute("SELECT thread_id FROM jobs WHERE status = 'running'").fetchall()
+            self._wakeup.notify_all()
+        for (thread_id,) in running:
+            cancel_story(thread_id, "stopped with the server")
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _worker(self):
+        while True:
+            with self.lock:
+                job = None
+                while not self._stopping:
+                    job = self._claim()
+                    if job is not None:
+                        break
+                    self._wakeup.wait()
+                if job is None:
+                    return
+            self._process(job)
+
+    def _process(self, job: dict):
+        try:
+            self._run(job)
+        except DeadlineExceeded as error:
+            self._finish(job["job_id"], "failed", str(error))
+        except StoryCancelled as error:
+            if job["job_id"] in self._cancel_requested:
+                self._finish(job["job_id"], "cancelled", str(error))
+            else:
+                # Server shutdown, continues from its checkpoint on the next start
+                self._finish(job["job_id"], "queued")
+        except Exception as error:
+            print(f"Job {job['job_id']} failed: {error}")
+            self._finish(job["job_id"], "failed", repr(error))
+        else:
+            self._finish(job["job_id"], "done")
+
+    def _run(self, job: dict):
+        thread_id = job["thread_id"]
+        config = {"recursion_limit": self.recursion_limit, "configurable": {"thread_id": thread_id}}
+
+        with story_run(thread_id, timeout=self.story_timeout) as token:
+            if job["job_id"] in self._cancel_requested:
+                # Cancelled between being claimed and starting
+                token.cancel("cancelled")
+            if self.saver.story_exists(thread_id):
+                # Resubmitted or interrupted story, continue from its last checkpoint
+                self.app.invoke(None, config=config, durability="sync")
+                return
+            if not job["input_text"]:
+                raise ValueError(f"No stored story {thread_id} to continue")
+            # The thread_id lets cancellation reach the start agent calls too
+            output = get_start_agent_app().invoke({"input_text": job["input_text"]}, config={"configurable": {"thread_id": thread_id}})
+            self.app.invoke(initial_state(output), config=config, durability="sync")
@@ -1,8 +1,71 @@
-from langchain_google_genai import ChatGoogleGenerativeAI
+import os
+import threading
+
+from utils.cancellation import GuardedLLM
+from utils.cassette import MODES, Cassette, CassetteLLM, default_cassette_path
+from utils.fake_llm import FakeLLM
 from utils.get_env import get_env_variable
 
 
-api_key = get_env_variable("GOOGLE_API_KEY")
+class LazyLLM:
+    '''
+    Builds the client on first use, so importing the agents needs neither the provider SDK nor credentials.
+    '''
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._llm = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._llm is None:
+            with self._lock:
+                if self._llm is None:
+                    self._llm = self._factory()
+        return self._llm
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+
+def gemini(model: str):
+    from langchain_google_genai import ChatGoogleGenerativeAI
+
+    return ChatGoogleGenerativeAI(model=model, api_key=get_env_variable("GOOGLE_API_KEY"))
+
+
+# live: call Gemini, record: call Gemini and write every call to the cassette, replay: answer from the cassette offline,
+# fake: answer locally from the schema (utils/fake_llm.py)
+llm_mode = os.getenv("LLM_MODE", "live")
+if llm_mode not in MODES + ("fake",):
+    raise RuntimeError(f"Unknown LLM_MODE {llm_mode}, expected one of {MODES + ('fake',)}")
+
+cassette = None
+if llm_mode in ("record", "replay"):
+    # LLM_CASSETTE_BUFFER=1 in actor worker processes: calls are recorded in memory and sent back with each
+    # turn, only the coordinator writes the cassette file
+    buffered = llm_mode == "record" and os.getenv("LLM_CASSETTE_BUFFER") == "1"
+    cassette = Cassette(
+        None if buffered else os.getenv("LLM_CASSETTE") or default_cassette_path(),
+        llm_mode,
+        realtime=os.getenv("LLM_REPLAY_REALTIME") == "1",
+        strict=os.getenv("LLM_REPLAY_STRICT") == "1",
+    )
+
+if llm_mode == "fake":
+    lite_llm = FakeLLM("gemini-2.5-flash-lite")
+    advanced_llm = FakeLLM("gemini-2.5-pro")
+elif llm_mode == "replay":
+    lite_llm = CassetteLLM(cassette, "gemini-2.5-flash-lite")
+    advanced_llm = CassetteLLM(cassette, "gemini-2.5-pro")
+else:
+    lite_llm = LazyLLM(lambda: gemini("gemini-2.5-flash-lite"))
+    advanced_llm = LazyLLM(lambda: gemini("gemini-2.5-pro"))
+
+    if cassette is not None:
+        lite_llm = CassetteLLM(cassette, "gemini-2.5-flash-lite", lite_llm)
+        advanced_llm = CassetteLLM(cassette, "gemini-2.5-pro", advanced_llm)
 
-lite_llm = ChatGoogleGenerativeAI(model="gemini-2.5-flash-lite", api_key=api_key)
-advanced_llm = ChatGoogleGenerativeAI(model="gemini-2.5-pro", api_key=api_key)
\ No newline at end of file
+# Every call gets a deadline and stops waiting when its story is cancelled
+lite_llm = GuardedLLM(lite_llm)
+advanced_llm = GuardedLLM(advanced_llm)
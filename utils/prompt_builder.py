@@ -0,0 +1,333 @@
+import logging
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, Hashable, List, Optional
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+from pydantic_bp.core import Character, Entity, Scene
+from utils.prompt_encoding import characters_data, encode, entities_data, get_agent_format, scene_data, scenes_data
+from utils.tokens import estimate_tokens
+
+
+# Segment tiers, prompts are assembled from the most static to the most volatile content so that
+# consecutive calls of an agent share the longest possible prefix (provider side prefix caching).
+STATIC = 0       # instructions, main goal, character profiles
+STABLE = 1       # rosters and entities, change rarely
+APPEND_ONLY = 2  # scene history and moments, only grow at the end
+VOLATILE = 3     # goals, references and questions that change every call
+
+MAX_FRAGMENTS = 4096
+# Prefix keys (one per agent, or per character) whose last prompt is kept to measure the shared prefix
+MAX_PREFIX_KEYS = 256
+
+# Trimming strategies of a segment when the prompt is over the context budget of its agent
+KEEP = "keep"                # never trimmed: instructions, references and questions
+DROP = "drop"                # left out whole
+KEEP_LATEST = "keep_latest"  # oldest lines cut first, for histories and memories that grow at the end
+KEEP_FIRST = "keep_first"    # last lines cut first, for indexed rosters: the indexes of the kept entries stay valid
+
+# Per agent prompt budgets in estimated tokens, overridable with CONTEXT_BUDGET_<AGENT> or CONTEXT_BUDGET
+# for all agents, 0 turns the budget off
+AGENT_BUDGETS = {
+    "character_agent": 8000,
+    "scene_creator": 16000,
+    "scene_validator": 8000,
+    "final_goal_validator": 16000,
+}
+
+_fragments: "OrderedDict[Hashable, str]" = OrderedDict()
+_last_prompts: "OrderedDict[str, str]" = OrderedDict()
+# Prompts are built from job workers, actor threads and the memory consolidation thread at once
+_lock = threading.Lock()
+
+# agent -> {"calls", "prompt_tokens", "shared_prefix_tokens"}
+PREFIX_STATS: Dict[str, Dict[str, int]] = {}
+# agent -> {"calls", "trimmed_calls", "trimmed_tokens", "over_budget_calls"}
+CONTEXT_STATS: Dict[str, Dict[str, int]] = {}
+
+logger = logging.getLogger(__name__)
+
+
+def fragment(key: Hashable, render: Callable[[], str]) -> str:
+    '''
+    Memoized prompt fragment. The key must change whenever the rendered content would change,
+    use the *_version helpers below to build it from the model fields involved.
+    '''
+    with _lock:
+        text = _fragments.get(key)
+        if text is not None:
+            _fragments.move_to_end(key)
+            return text
+    # Rendered outside the lock, two threads may render the same fragment once each
+    text = render()
+    with _lock:
+        _fragments[key] = text
+        if len(_fragments) > MAX_FRAGMENTS:
+            _fragments.popitem(last=False)
+    return text
+
+
+def character_version(character: Character) -> tuple:
+    return (
+        character.name,
+        character.role,
+        tuple(character.longtime_goals),
+        tuple(character.personality),
+        tuple(character.strengths),
+        tuple(character.weaknesses),
+    )
+
+
+def entity_version(entity: Entity) -> tuple:
+    return (entity.name, entity.description)
+
+
+def scene_version(scene: Scene) -> tuple:
+    # Moments are append only, their count and the last situation identify the content
+    last_situation = None
+    if scene.moments and scene.moments[-1].situations:
+        situations = scene.moments[-1].situations
+        last_situation = (len(situations), situations[-1].who_said, situations[-1].dialogue)
+    return (scene.no, scene.description, len(scene.moments), last_situation)
+
+
+def characters_fragment(agent: str, characters: List[Character]) -> str:
+    fmt = get_agent_format(agent)
+    key = ("characters", fmt, tuple(character_version(character) for character in characters))
+    return fragment(key, lambda: encode("characters", characters_data(characters), fmt))
+
+
+def entities_fragment(agent: str, entities: List[Entity]) -> str:
+    fmt = get_agent_format(agent)
+    key = ("entities", fmt, tuple(entity_version(entity) for entity in entities))
+    return fragment(key, lambda: encode("entities", entities_data(entities), fmt))
+
+
+def scene_fragment(agent: str, scene: Scene) -> str:
+    fmt = get_agent_format(agent)
+    return fragment(("scene", fmt, scene_version(scene)), lambda: encode("scenes", scene_data(scene), fmt))
+
+
+def moments_fragment(agent: str, scene: Scene, start: int) -> str:
+    '''
+    The scene with only its moments from position start on, for prompts that already summarized the rest.
+    '''
+    fmt = get_agent_format(agent)
+    partial = Scene.trusted(no=scene.no, description=scene.description, character_ids=scene.character_ids, moments=scene.moments[start:])
+    return fragment(("moments", fmt, scene_version(scene), start), lambda: encode("scenes", scene_data(partial), fmt))
+
+
+def scenes_fragment(agent: str, scenes: List[Scene]) -> str:
+    fmt = get_agent_format(agent)
+    if fmt == "compact" and scenes:
+        # Compact scenes are plain lines, so the history is the join of the per scene fragments
+        # and only a new scene is rendered
+        return "\n".join(scene_fragment(agent, scene) for scene in scenes)
+    key = ("scenes", fmt, tuple(scene_version(scene) for scene in scenes))
+    return fragment(key, lambda: encode("scenes", scenes_data(scenes), fmt))
+
+
+def common_prefix_length(a: str, b: str) -> int:
+    size = min(len(a), len(b))
+    if a[:size] == b[:size]:
+        return size
+    low, high = 0, size
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+def context_budget(agent: str) -> int:
+    budget = os.getenv(f"CONTEXT_BUDGET_{agent.upper()}") or os.getenv("CONTEXT_BUDGET")
+    return int(budget) if budget else AGENT_BUDGETS.get(agent, 0)
+
+
+@dataclass
+class Segment:
+    tier: int
+    text: str
+    name: str = ""
+    # Segments are trimmed from the lowest priority up, only down to what the budget needs
+    priority: int = 0
+    strategy: str = KEEP
+    # Smaller rendering of the same content, tried before any line is cut
+    compact: Optional[Callable[[], str]] = None
+
+
+def _line_tokens(line: str) -> int:
+    # A line costs its tokens and the newline before it
+    return estimate_tokens(line) + 1
+
+
+def truncate(text: str, strategy: str, target: int) -> str:
+    '''
+    The segment cut down by whole lines to about target tokens. The first line is its heading and is kept,
+    a marker line says how many lines were cut. Content rendered on a single line (json_min) can only go whole.
+    '''
+    heading, _, body = text.partition("\n")
+    lines = body.split("\n") if body else []
+    size = estimate_tokens(text)
+    # Room for the marker line
+    target -= _line_tokens("[... 000 earlier lines left out]")
+    cut = 0
+    while lines and size > target:
+        size -= _line_tokens(lines.pop(0 if strategy == KEEP_LATEST else -1))
+        cut += 1
+    if not cut:
+        return text
+    marker = f"[... {cut} {'earlier' if strategy == KEEP_LATEST else 'more'} lines left out]"
+    lines = [marker] + lines if strategy == KEEP_LATEST else lines + [marker]
+    cut_text = "\n".join([heading] + lines)
+    # Cutting a short segment down to the marker would not save anything
+    return cut_text if estimate_tokens(cut_text) < estimate_tokens(text) else text
+
+
+class PromptBuilder:
+    '''
+    Assembles the messages of one LLM call from tiered segments.
+
+    System segments go to the system message, the others to the human message, each ordered by tier.
+    A human message over the context budget of the agent is trimmed first, segment by segment from the
+    lowest priority up: compacted, then cut by lines or dropped as the segment declares. Segments added
+    without a strategy are never trimmed.
+    build() reports how much of the prompt is shared with the previous call of the same prefix key.
+    '''
+
+    def __init__(self, agent: str, prefix_key: Optional[str] = None):
+        self.agent = agent
+        self.prefix_key = prefix_key or agent
+        self.system_segments = []
+        self.human_segments: List[Segment] = []
+
+    def system(self, text: str, tier: int = STATIC) -> "PromptBuilder":
+        self.system_segments.append((tier, text))
+        return self
+
+    def add(
+        self,
+        text: str,
+        tier: int,
+        name: str = "",
+        priority: int = 0,
+        strategy: str = KEEP,
+        compact: Optional[Callable[[], str]] = None,
+    ) -> "PromptBuilder":
+        self.human_segments.append(Segment(tier, text, name, priority, strategy, compact))
+        return self
+
+    def build(self) -> List[BaseMessage]:
+        # sorted() is stable, segments of the same tier keep the order they were added in
+        system_text = "\n".join(text for _, text in sorted(self.system_segments, key=lambda segment: segment[0]))
+        self._fit(system_text)
+        segments = sorted((segment for segment in self.human_segments if segment.text), key=lambda segment: segment.tier)
+        human_text = "\n".join(segment.text for segment in segments)
+
+        self._report(system_text + "\n" + human_text)
+
+        messages = []
+        if system_text:
+            messages.append(SystemMessage(content=system_text))
+        messages.append(HumanMessage(content=human_text))
+        return messages
+
+    def _fit(self, system_text: str):
+        budget = context_budget(self.agent)
+        if budget <= 0:
+            return
+        with _lock:
+            stats = CONTEXT_STATS.setdefault(self.agent, {"calls": 0, "trimmed_calls": 0, "trimmed_tokens": 0, "over_budget_calls": 0})
+            stats["calls"] += 1
+        # A token is at least one character, prompts with fewer characters than the budget are not sized
+        if len(system_text) + sum(len(segment.text) + 1 for segment in self.human_segments) <= budget:
+            return
+
+        system_tokens = estimate_tokens(system_text)
+        sizes = [_line_tokens(segment.text) for segment in self.human_segments]
+        total = system_tokens + sum(sizes)
+        if total <= budget:
+            return
+
+        trimmed: Dict[int, List[str]] = {}
+        before = list(sizes)
+        order = sorted(
+            (i for i, segment in enumerate(self.human_segments) if segment.strategy != KEEP),
+            key=lambda i: (self.human_segments[i].priority, i),
+        )
+        # Passes from the lowest priority up until the prompt fits: a segment is compacted and cut to what is
+        # still over, a segment that cannot get smaller that way is dropped. Only KEEP segments are never trimmed.
+        progress = True
+        while progress and system_tokens + sum(sizes) > budget:
+            progress = False
+            for i in order:
+                excess = system_tokens + sum(sizes) - budget
+                if excess <= 0:
+                    break
+                segment = self.human_segments[i]
+                if not segment.text:
+                    continue
+                actions = trimmed.setdefault(i, [])
+                if segment.compact is not None:
+                    compacted, segment.compact = segment.compact(), None
+                    if _line_tokens(compacted) < sizes[i]:
+                        segment.text = compacted
+                        sizes[i] = _line_tokens(compacted)
+                        actions.append("compacted")
+                        progress = True
+                        excess = system_tokens + sum(sizes) - budget
+                        if excess <= 0:
+                            break
+                cut_text = segment.text if segment.strategy == DROP else truncate(segment.text, segment.strategy, sizes[i] - excess)
+                if cut_text != segment.text:
+                    segment.text = cut_text
+                    sizes[i] = _line_tokens(cut_text)
+                    actions.append("cut")
+                else:
+                    segment.text = ""
+                    sizes[i] = 0
+                    actions.append("dropped")
+                progress = True
+
+        final = system_tokens + sum(sizes)
+        report = "; ".join(
+            f"{self.human_segments[i].name or f'segment {i}'} {before[i]}->{sizes[i]} ({', '.join(dict.fromkeys(actions))})"
+            for i, actions in trimmed.items() if actions
+        )
+        with _lock:
+            if report:
+                stats["trimmed_calls"] += 1
+                stats["trimmed_tokens"] += total - final
+            if final > budget:
+                stats["over_budget_calls"] += 1
+        if final > budget:
+            # Only the instructions, references and questions are left
+            logger.warning("%s: ~%d tokens over the %d budget, trimmed %s, still ~%d over", self.prefix_key, total, budget, report or "nothing", final - budget)
+        else:
+            logger.info("%s: ~%d tokens over the %d budget, trimmed %s", self.prefix_key, total, budget, report)
+
+    def _report(self, prompt: str):
+        with _lock:
+            previous = _last_prompts.pop(self.prefix_key, "")
+            _last_prompts[self.prefix_key] = prompt
+            if len(_last_prompts) > MAX_PREFIX_KEYS:
+                _last_prompts.popitem(last=False)
+
+        shared = prompt[:common_prefix_length(previous, prompt)]
+        prompt_tokens = estimate_tokens(prompt)
+        shared_tokens = estimate_tokens(shared) if shared else 0
+
+        with _lock:
+            stats = PREFIX_STATS.setdefault(self.agent, {"calls": 0, "prompt_tokens": 0, "shared_prefix_tokens": 0})
+            stats["calls"] += 1
+            stats["prompt_tokens"] += prompt_tokens
+            stats["shared_prefix_tokens"] += shared_tokens
+
+        if logger.isEnabledFor(logging.DEBUG):
+            percent = 100 * shared_tokens / prompt_tokens if prompt_tokens else 0
+            logger.debug("%s: ~%d tokens, shared prefix ~%d tokens (%.0f%%)", self.prefix_key, prompt_tokens, shared_tokens, percent)
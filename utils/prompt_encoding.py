@@ -0,0 +1,142 @@
+import json
+import os
+from typing import Callable, Dict, List
+
+from pydantic_bp.core import Character, Entity, Scene
+
+
+def characters_data(characters: List[Character]) -> List[dict]:
+    return [
+        {
+            "name": character.name,
+            "role": character.role,
+            "longtime_goals": character.longtime_goals,
+            "personality": character.personality,
+            "strengths": character.strengths,
+            "weaknesses": character.weaknesses,
+        }
+        for character in characters
+    ]
+
+
+def entities_data(entities: List[Entity]) -> List[dict]:
+    return [entity.model_dump() for entity in entities]
+
+
+def scene_data(scene: Scene) -> dict:
+    return {
+        "no": scene.no,
+        "description": scene.description,
+        "moments": [
+            {
+                "no": moment.no,
+                "situations": [
+                    {
+                        "who_said": situation.who_said,
+                        "who_listens": list(situation.who_listens),
+                        "dialogue": situation.dialogue,
+                        "action": situation.action,
+                    }
+                    for situation in moment.situations
+                ],
+            }
+            for moment in scene.moments
+        ],
+    }
+
+
+def scenes_data(scenes: List[Scene]) -> List[dict]:
+    return [scene_data(scene) for scene in scenes]
+
+
+# ---- Formats ----
+# Every format encodes the same three kinds of data: "characters", "entities" and "scenes"
+# (a single scene dict is encoded like a one element scenes list).
+
+def _json_pretty(kind: str, data) -> str:
+    return json.dumps(data, indent=2)
+
+
+def _json_min(kind: str, data) -> str:
+    return json.dumps(data, separators=(",", ":"), ensure_ascii=False)
+
+
+def _compact_characters(characters: List[dict]) -> str:
+    # Index prefix keeps 0 based references (characters_indexes) unambiguous
+    lines = []
+    for index, character in enumerate(characters):
+        lines.append(f"[{index}] {character['name']} ({character['role']})")
+        for key in ("longtime_goals", "personality", "strengths", "weaknesses"):
+            if character.get(key):
+                lines.append(f"  {key}: {'; '.join(character[key])}")
+    return "\n".join(lines)
+
+
+def _compact_entities(entities: List[dict]) -> str:
+    return "\n".join(f"- {entity['name']}: {entity['description']}" for entity in entities)
+
+
+def _compact_scenes(scenes: List[dict]) -> str:
+    '''
+    One line per situation: speaker -> listeners: "dialogue" [action]
+    '''
+    lines = []
+    for scene in scenes:
+        header = f"Scene {scene['no']}: " if "no" in scene else "Scene: "
+        lines.append(header + scene["description"])
+        for moment in scene["moments"]:
+            lines.append(f" Moment {moment['no']}")
+            for situation in moment["situations"]:
+                listeners = ", ".join(situation["who_listens"]) or "nobody"
+                line = f"  {situation['who_said']} -> {listeners}: \"{situation['dialogue']}\""
+                if situation["action"]:
+                    line += f" [{situation['action']}]"
+                lines.append(line)
+    return "\n".join(lines)
+
+
+def _compact(kind: str, data) -> str:
+    if not data:
+        return "(none)"
+    if kind == "characters":
+        return _compact_characters(data)
+    if kind == "entities":
+        return _compact_entities(data)
+    if kind == "scenes":
+        return _compact_scenes([data] if isinstance(data, dict) else data)
+    raise ValueError(f"Unknown prompt data kind: {kind}")
+
+
+FORMATS: Dict[str, Callable[[str, object], str]] = {
+    "json": _json_pretty,
+    "json_min": _json_min,
+    "compact": _compact,
+}
+
+DEFAULT_FORMAT = "compact"
+
+# Per agent defaults, overridable with PROMPT_FORMAT_<AGENT> or PROMPT_FORMAT for all agents
+AGENT_FORMATS = {
+    "character_agent": "compact",
+    "scene_creator": "compact",
+    "scene_validator": "compact",
+    "final_goal_validator": "compact",
+}
+
+
+def get_agent_format(agent: str) -> str:
+    fmt = os.getenv(f"PROMPT_FORMAT_{agent.upper()}") or os.getenv("PROMPT_FORMAT") or AGENT_FORMATS.get(agent, DEFAULT_FORMAT)
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown prompt format {fmt} for agent {agent}, expected one of {list(FORMATS)}")
+    return fmt
+
+
+def encode(kind: str, data, fmt: str = DEFAULT_FORMAT) -> str:
+    return FORMATS[fmt](kind, data)
+
+
+def encode_for_agent(agent: str, kind: str, data) -> str:
+    '''
+    Encodes prompt data with the format chosen for the given agent.
+    '''
+    return encode(kind, data, get_agent_format(agent))
@@ -0,0 +1,279 @@
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from typing import Dict, List, Optional
+
+# STATE_PROFILE=<report.json> runs main.py stories under the profiler
+STATE_PROFILE = os.getenv("STATE_PROFILE")
+
+# Mean growth per scene, in bytes, a profiled story may have before check_budgets() fails it
+BUDGETS: Dict[str, int] = {
+    "checkpoint": 8_000,
+    "characters": 4_000,
+    "scenes": 4_000,
+    "traced": 1_000_000,
+}
+
+
+def _rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Peak instead of current outside Linux, in KB there (bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class StateProfiler:
+    '''
+    Records how the story state grows while env_agent_workflow runs, after every node:
+    the serialized size of each EnvAgentState field, the memory of every character, the
+    bytes the checkpoint of the step took in the DB, the process RSS and the memory traced
+    by tracemalloc. At the end of each scene a tracemalloc snapshot is compared with the one
+    of the previous scene for the top allocators.
+
+    Sizes are taken with the serde of the checkpointer, so they are what a checkpoint stores.
+    '''
+
+    def __init__(self, saver, top: int = 10, trace: bool = True):
+        self.saver = saver
+        self.top = top
+        self.trace = trace
+        self.nodes: List[dict] = []
+        self.scenes: List[dict] = []
+        self._snapshot = None
+        self._scene_no = None
+        self._started = None
+
+    def _size(self, value) -> int:
+        return len(self.saver.serde.dumps_typed(value)[1])
+
+    def _checkpoint_bytes(self, config: dict) -> Dict[str, int]:
+        configurable = config["configurable"]
+        with self.saver.cursor(transaction=False) as cur:
+            cur.execute(
+                "SELECT length(checkpoint) + length(metadata) FROM checkpoints WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                (configurable["thread_id"], configurable.get("checkpoint_ns", ""), configurable["checkpoint_id"]),
+            )
+            row = cur.fetchone()
+            cur.execute(
+                "SELECT COALESCE(SUM(length(value)), 0) FROM writes WHERE thread_id = ? AND checkpoint_ns = ? AND checkpoint_id = ?",
+                (configurable["thread_id"], configurable.get("checkpoint_ns", ""), configurable["checkpoint_id"]),
+            )
+            writes = cur.fetchone()[0]
+        return {"checkpoint_bytes": row[0] if row else 0, "writes_bytes": writes}
+
+    def _characters(self, characters) -> Dict[str, dict]:
+        return {
+            character.ref: {
+                "shortterm_units": len(character.shortterm_memory),
+                "shortterm_bytes": self._size(character.shortterm_memory),
+                "longterm_units": len(character.longterm_memory),
+                "longterm_bytes": self._size(character.longterm_memory),
+            }
+            for character in characters or []
+        }
+
+    def start(self):
+        self._started = time.perf_counter()
+        if self.trace and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._snapshot = tracemalloc.take_snapshot() if self.trace else None
+
+    def record(self, step: int, node: str, values: dict, config: dict):
+        current_scene = values.get("current_scene")
+        # A step that completes a scene already moved next_scene_no on, it still belongs to that scene
+        scene_no = current_scene.no if current_scene else values.get("next_scene_no", 1) - 1
+        if self._scene_no is not None and scene_no != self._scene_no:
+            self._close_scene()
+        self._scene_no = scene_no
+
+        traced, peak = tracemalloc.get_traced_memory() if self.trace else (0, 0)
+        self.nodes.append({
+            "step": step,
+            "node": node,
+            "scene": scene_no,
+            "fields": {field: self._size(value) for field, value in values.items()},
+            "characters": self._characters(values.get("characters")),
+            **self._checkpoint_bytes(config),
+            "rss_bytes": _rss_bytes(),
+            "traced_bytes": traced,
+            "traced_peak_bytes": peak,
+        })
+
+    def _close_scene(self):
+        nodes = [node for node in self.nodes if node["scene"] == self._scene_no]
+        if not nodes:
+            return
+        last = nodes[-1]
+        previous = self.scenes[-1] if self.scenes else None
+        scene = {
+            "scene": self._scene_no,
+            "steps": len(nodes),
+            "nodes": sorted({node["node"] for node in nodes}),
+            "checkpoint_bytes": last["checkpoint_bytes"],
+            "max_checkpoint_bytes": max(node["checkpoint_bytes"] for node in nodes),
+            "checkpoint_bytes_written": sum(node["checkpoint_bytes"] + node["writes_bytes"] for node in nodes),
+            "fields": last["fields"],
+            "characters": last["characters"],
+            "rss_bytes": last["rss_bytes"],
+            "traced_bytes": last["traced_bytes"],
+            "traced_peak_bytes": max(node["traced_peak_bytes"] for node in nodes),
+        }
+        scene["growth"] = {
+            "checkpoint": scene["checkpoint_bytes"] - (previous["checkpoint_bytes"] if previous else 0),
+            "traced": scene["traced_bytes"] - (previous["traced_bytes"] if previous else 0),
+            **{field: size - (previous["fields"].get(field, 0) if previous else 0) for field, size in scene["fields"].items()},
+        }
+
+        if self.trace:
+            snapshot = tracemalloc.take_snapshot().filter_traces((
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+            ))
+            scene["top_allocators"] = [
+                {"where": str(stat.traceback[0]), "size_diff": stat.size_diff, "count_diff": stat.count_diff, "size": stat.size}
+                for stat in snapshot.compare_to(self._snapshot, "lineno")[:self.top]
+            ]
+            self._snapshot = snapshot
+        self.scenes.append(scene)
+
+    def report(self, include_nodes: bool = False) -> dict:
+        if self._scene_no is not None and (not self.scenes or self.scenes[-1]["scene"] != self._scene_no):
+            self._close_scene()
+        # The first entry holds everything before it (the initial state, or the story so far when resuming)
+        later = self.scenes[1:] or self.scenes
+        mean_growth = {
+            key: round(sum(scene["growth"].get(key, 0) for scene in later) / len(later))
+            for key in (later[0]["growth"] if later else {})
+        }
+        report = {
+            "scenes": self.scenes,
+            "summary": {
+                "scenes": len(self.scenes),
+                "steps": len(self.nodes),
+                "final_checkpoint_bytes": self.scenes[-1]["checkpoint_bytes"] if self.scenes else 0,
+                "checkpoint_bytes_written": sum(scene["checkpoint_bytes_written"] for scene in self.scenes),
+                "mean_growth_per_scene": mean_growth,
+                "wall_time": round(time.perf_counter() - self._started, 3) if self._started is not None else None,
+            },
+        }
+        if include_nodes:
+            report["nodes"] = self.nodes
+        return report
+
+
+def profile_story(app, state, config: dict, profiler: Optional[StateProfiler] = None, **kwargs) -> StateProfiler:
+    '''
+    Runs env_agent_workflow like app.invoke (state None resumes the story) under the profiler.
+    The app needs a SQLite checkpointer (StorySaver), checkpoints are written synchronously so
+    each step is on disk when it is measured.
+    '''
+    profiler = profiler or StateProfiler(app.checkpointer)
+    profiler.start()
+    node = "input"
+    for mode, chunk in app.stream(state, config, stream_mode=["tasks", "checkpoints"], durability="sync", **kwargs):
+        if mode == "tasks":
+            if "result" in chunk:
+                node = chunk["name"]
+        elif chunk["metadata"]["step"] >= 0:
+            profiler.record(chunk["metadata"]["step"], node, chunk["values"], chunk["config"])
+    return profiler
+
+
+def check_budgets(report: dict, budgets: Dict[str, int]) -> List[str]:
+    '''
+    Budgets over the mean growth per scene, checkpoint, traced or any state field. Returns the ones exceeded.
+    '''
+    growth = report["summary"]["mean_growth_per_scene"]
+    return [
+        f"{key}: {growth[key]} bytes/scene over the budget of {budget}"
+        for key, budget in budgets.items() if growth.get(key, 0) > budget
+    ]
+
+
+def save_report(profiler: StateProfiler, path: Optional[str] = None, budgets: Dict[str, int] = BUDGETS,
+                include_nodes: bool = False) -> dict:
+    '''
+    Prints the report of the profiled run, checked against the budgets, and writes it as JSON to path when given.
+    '''
+    report = profiler.report(include_nodes=include_nodes)
+    report["budgets"] = budgets
+    report["over_budget"] = check_budgets(report, budgets)
+    print_report(report)
+    if path:
+        with open(path, "w") as file:
+            json.dump(report, file, indent=2)
+    return report
+
+
+def print_report(report: dict):
+    print(f"{'scene':>5} {'steps':>5} {'checkpoint':>11} {'growth':>9} {'characters':>11} {'scenes':>9} {'rss MB':>7} {'traced MB':>9}")
+    for scene in report["scenes"]:
+        print(
+            f"{scene['scene']:5} {scene['steps']:5} {scene['checkpoint_bytes']:11} {scene['growth']['checkpoint']:9} "
+            f"{scene['fields'].get('characters', 0):11} {scene['fields'].get('scenes', 0):9} "
+            f"{(scene['rss_bytes'] or 0) / 2**20:7.1f} {scene['traced_bytes'] / 2**20:9.1f}"
+        )
+    if report["scenes"] and report["scenes"][-1].get("top_allocators"):
+        print("Top allocators of the last scene:")
+        for stat in report["scenes"][-1]["top_allocators"][:5]:
+            print(f"    {stat['size_diff']:+10} B  {stat['where']}")
+    print("Mean growth per scene: " + ", ".join(f"{key} {value}" for key, value in report["summary"]["mean_growth_per_scene"].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-scene state size and memory growth of a story run with the fake LLM backend.")
+    parser.add_argument("--scenes", type=int, default=6, help="Scenes of the fake story")
+    parser.add_argument("--db", default=":memory:", help="Checkpoint DB")
+    parser.add_argument("--thread", default="profile", help="Thread id, an existing story in --db is resumed")
+    parser.add_argument("--top", type=int, default=10, help="Top allocators per scene")
+    parser.add_argument("--no-trace", action="store_true", help="Skip tracemalloc, it slows the run down")
+    parser.add_argument("--nodes", action="store_true", help="Include every node in the report")
+    parser.add_argument("--out", help="Write the JSON report here")
+    parser.add_argument("--budget", action="append", default=[], help="Override a budget, name=bytes per scene (any state field too)")
+    parser.add_argument("--recursion-limit", type=int, default=500)
+    args = parser.parse_args()
+
+    # The LLM clients are chosen when utils.model is imported, yes answers (scene and goal complete) come after --scenes calls
+    os.environ.setdefault("LLM_MODE", "fake")
+    os.environ.setdefault("FAKE_LLM_TURNS", str(args.scenes))
+    os.environ.setdefault("MEMORY_CONSOLIDATION", "1")
+
+    import sqlite3
+
+    from agents.env_agent import env_agent_workflow, initial_state
+    from agents.start_agent import get_start_agent_app
+    from utils.checkpointer import StorySaver
+
+    budgets = dict(BUDGETS)
+    for override in args.budget:
+        name, size = override.split("=")
+        budgets[name] = int(size)
+
+    saver = StorySaver(sqlite3.connect(args.db, check_same_thread=False))
+    app = env_agent_workflow.compile(checkpointer=saver)
+    config = {"recursion_limit": args.recursion_limit, "configurable": {"thread_id": args.thread}}
+
+    state = None
+    if not saver.story_exists(args.thread):
+        state = initial_state(get_start_agent_app().invoke({"input_text": "A crew of explorers searches the ruins of an old city."}))
+
+    profiler = profile_story(app, state, config, StateProfiler(saver, top=args.top, trace=not args.no_trace))
+    report = save_report(profiler, args.out, budgets, include_nodes=args.nodes)
+    if report["over_budget"]:
+        print("Over budget: " + "; ".join(report["over_budget"]))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
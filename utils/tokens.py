@@ -0,0 +1,28 @@
+import re
+from functools import lru_cache
+
+
+# Words, single punctuation marks and whitespace runs, roughly how BPE tokenizers split text
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]|\s+")
+
+
+@lru_cache(maxsize=1)
+def _get_encoder():
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    return tiktoken.get_encoding("cl100k_base")
+
+
+def estimate_tokens(text: str) -> int:
+    '''
+    Local token estimate of a prompt. Uses tiktoken when installed, otherwise a heuristic
+    that counts long words as one token per ~4 characters. Both only approximate Gemini's tokenizer,
+    good enough to compare prompt encodings and to size budgets.
+    '''
+    encoder = _get_encoder()
+    if encoder is not None:
+        return len(encoder.encode(text))
+
+    return sum(1 if piece.isspace() else (len(piece) + 3) // 4 for piece in _TOKEN_PATTERN.findall(text))